@@ -0,0 +1,103 @@
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from cache import LRUCache
+
+
+class SemanticAnswerCache:
+    def __init__(self,
+                 kb_version_fn: Callable[[], str],
+                 similarity_threshold: float = 0.95,
+                 maxsize: int = 256,
+                 ttl: Optional[float] = 3600):
+        """
+        语义答案缓存：按问题向量的余弦相似度查找以前的回答。
+
+        命中需要同时满足三个条件：检索范围 scope（如所选车型的过滤条件）相同，问题相似度不低于 similarity_threshold，
+        且本次重排后的上下文片段ID与缓存条目完全一致（保证回答依据的知识没有变化）。
+        知识库重新入库（kb_version_fn 的返回值变化）时整个缓存失效。
+
+        参数：
+            kb_version_fn: 返回当前知识库版本标识的函数。
+            similarity_threshold: 判定为同一问题的最小余弦相似度。
+            maxsize: 最多缓存的回答数量，超出时按 LRU 淘汰。
+            ttl: 回答的有效期（秒），None 表示永不过期。
+        """
+        self.kb_version_fn = kb_version_fn
+        self.similarity_threshold = similarity_threshold
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl, name="semantic_answer")
+        self._kb_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_kb_version(self) -> None:
+        version = self.kb_version_fn()
+        if version != self._kb_version:
+            if self._kb_version is not None:
+                print("知识库已更新，清空语义答案缓存。")
+            self._entries.clear()
+            self._kb_version = version
+
+    def _candidates(self, query_embedding: List[float], scope: str = "") -> List[Dict[str, Any]]:
+        """
+        返回同一检索范围内相似度达到阈值的缓存条目，按相似度从高到低排列。
+        """
+        self._check_kb_version()
+        items = [(key, entry) for key, entry in self._entries.items() if entry["scope"] == scope]
+        if not items:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        similarities = np.stack([entry["embedding"] for _, entry in items]) @ query
+        order = np.argsort(-similarities)
+        return [{"key": items[i][0], "similarity": float(similarities[i]), **items[i][1]}
+                for i in order if similarities[i] >= self.similarity_threshold]
+
+    def find(self, query_embedding: List[float], scope: str = "") -> Optional[Dict[str, Any]]:
+        """
+        返回与问题最相似且相似度达到阈值的缓存条目（尚未校验上下文），没有则返回 None。
+        """
+        candidates = self._candidates(query_embedding, scope)
+        return candidates[0] if candidates else None
+
+    def lookup(self, query_embedding: List[float], context_ids: List[str],
+               scope: str = "") -> Optional[Dict[str, Any]]:
+        """
+        查找可复用的回答：检索范围相同、相似度达到阈值且上下文片段ID一致时返回缓存的结果字典，否则返回 None。
+        """
+        for candidate in self._candidates(query_embedding, scope):
+            if candidate["context_ids"] == list(context_ids):
+                self._entries.get(candidate["key"])  # 刷新 LRU 顺序
+                self.hits += 1
+                print(f"命中语义答案缓存：相似度 {candidate['similarity']:.4f}")
+                return candidate["result"]
+        self.misses += 1
+        return None
+
+    def put(self, query_embedding: List[float], context_ids: List[str], intent: str, result: Dict[str, Any],
+            scope: str = "") -> None:
+        self._check_kb_version()
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        self._entries.set(uuid.uuid4().hex, {
+            "embedding": vector,
+            "context_ids": list(context_ids),
+            "scope": scope,
+            "intent": intent,
+            "result": result,
+        })
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "name": "semantic_answer",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
@@ -1,4 +1,5 @@
 import io
+import threading
 import time
 from typing import Iterator
 
@@ -9,7 +10,8 @@ import uuid
 from PIL import Image
 
 from chat import ChatAgent
-from embed import create_db, query_db
+from chunk import DATA_FOLDER, get_file_paths
+from embed import create_db, list_vehicles, query_db
 
 # --- 1. 页面基础设置 (领域适配) ---
 st.set_page_config(
@@ -23,6 +25,17 @@ st.title("🚗 新能源汽车智能诊断与知识助手")
 st.caption("由本地大模型驱动，为您解答关于新能源汽车的使用、保养及故障诊断问题")
 st.markdown("---")
 
+# 侧边栏示例问题，启动时会预先计算它们的回答
+EXAMPLE_QUESTIONS = [
+    "我的车最近续航掉了20%，可能是什么原因？",
+    "如何为我的车辆进行首次保养？",
+    "仪表盘上出现一个黄色的电池图标是什么意思？",
+    "空调制冷效果不佳怎么办？",
+    "P0420故障码是什么意思？",
+    "冬季如何维护电池？",
+    "最近电动汽车自燃事件多发，我的车安全吗？"
+]
+
 # --- 后端初始化 ---
 @st.cache_resource
 def get_chat_agent():
@@ -31,22 +44,21 @@ def get_chat_agent():
     return ChatAgent(local_model_name_via_oneapi="qwen3:4B", # 确保与 One API 配置的 Ollama 渠道模型名称一致
         intent_model_name="qwen3:0.6b",             # 意图识别的本地 Ollama 模型
         online_model_name_via_oneapi="deepseek-chat",    # 确保与 One API 配置的在线模型渠道模型名称一致
-        ollama_base_url="http://localhost:11434"   # 本地 Ollama 服务的基础 URL
+        ollama_base_url="http://localhost:11434",   # 本地 Ollama 服务的基础 URL
+        concurrent_mode=True,                        # 意图识别与检索并发执行
+        retrieval_mode="hybrid"                      # 向量检索与 BM25 倒排索引的结果融合后再重排
     )
 
 
 @st.cache_resource
 def ensure_db_created():
     """检查并创建数据库"""
-    pdf_file_path = "./data/秦plusDMi用户手册.pdf"
-    data_dir = os.path.dirname(pdf_file_path)
-
-    if not os.path.exists(data_dir):
-        st.error(f"错误：数据目录 `{data_dir}` 不存在。请创建该目录并将用户手册PDF文件放入其中。")
+    if not os.path.isdir(DATA_FOLDER):
+        st.error(f"错误：数据目录 `{DATA_FOLDER}` 不存在。请创建该目录并将用户手册放入其中（可按 `车型/年款/` 分子目录）。")
         return False
 
-    if not os.path.exists(pdf_file_path):
-        st.error(f"错误：未找到用户手册PDF文件在路径 `{pdf_file_path}`. 请确保文件存在。")
+    if not get_file_paths(DATA_FOLDER):
+        st.error(f"错误：数据目录 `{DATA_FOLDER}` 中没有文档。请放入用户手册PDF等文件。")
         return False
 
     print("正在检查并创建数据库...")
@@ -58,12 +70,30 @@ def ensure_db_created():
         return False
 
 
+@st.cache_resource
+def start_warmup(_agent):
+    """在后台线程中预加载模型与回答链（每个进程只执行一次），页面无需等待模型加载即可显示"""
+    return _agent.warmup(background=True)
+
+
+@st.cache_resource
+def warm_up_answer_cache(_agent):
+    """在后台线程中预热示例问题的语义答案缓存（每个进程只执行一次）"""
+    thread = threading.Thread(target=_agent.warm_up_answer_cache, args=(EXAMPLE_QUESTIONS,),
+                              kwargs={"n_results": 5}, daemon=True)
+    thread.start()
+    return thread
+
+
 agent = get_chat_agent()
+start_warmup(agent)
 db_created = ensure_db_created()
 
 if not db_created:
     st.stop()
 
+warm_up_answer_cache(agent)
+
 # --- 会话状态管理 ---
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
@@ -82,6 +112,9 @@ if "current_fault_code_input" not in st.session_state:
 if "uploaded_image" not in st.session_state:
     st.session_state.uploaded_image = None
 
+if "vehicle" not in st.session_state:
+    st.session_state.vehicle = None
+
 def query_fault_code_callback():
     fault_code_to_query = st.session_state.fault_code_input_widget_key
     if fault_code_to_query:
@@ -94,16 +127,19 @@ with st.sidebar:
     st.header("💡 使用提示")
     st.info("您可以直接在下方的聊天框中提问，也可以点击下面的示例问题，快速开始体验。")
 
+    vehicles = list_vehicles()
+    if vehicles:
+        st.subheader("🚙 我的车型")
+        # 选定车型后只检索该车型的手册（以及通用资料）
+        st.session_state.vehicle = st.selectbox(
+            "选择车型",
+            options=[None] + vehicles,
+            index=([None] + vehicles).index(st.session_state.vehicle) if st.session_state.vehicle in vehicles else 0,
+            format_func=lambda v: "全部车型" if v is None else f"{v['vehicle_model']} {v['model_year']}".strip()
+        )
+
     st.subheader("❓ 常用问题示例")
-    example_questions = [
-        "我的车最近续航掉了20%，可能是什么原因？",
-        "如何为我的车辆进行首次保养？",
-        "仪表盘上出现一个黄色的电池图标是什么意思？",
-        "空调制冷效果不佳怎么办？",
-        "P0420故障码是什么意思？",
-        "冬季如何维护电池？",
-        "最近电动汽车自燃事件多发，我的车安全吗？"
-    ]
+    example_questions = EXAMPLE_QUESTIONS
 
     # 修改示例问题按钮的逻辑
     for i, q in enumerate(example_questions):
@@ -135,6 +171,9 @@ with st.sidebar:
     st.header("🧠 参考上下文")
     st.session_state.source_container = st.container()
 
+    st.markdown("---")
+    debug_mode = st.checkbox("🔍 显示调试面板（各阶段耗时）", value=False)
+
     st.markdown("---")
     st.header("⚙️ 更多功能 (规划中)")
     st.info("未来版本将支持：")
@@ -188,36 +227,71 @@ if prompt:
             st.image(Image.open(io.BytesIO(image_to_process)), caption="用户上传图片", use_container_width=True)
 
     with st.chat_message("assistant"):
-        with st.spinner("正在知识库中检索并思考..."):
-            try:
-                response_data = agent.rag_chat(prompt, session_id=st.session_state.session_id, n_results=5, image_bytes= image_to_process)
-                context_docs = response_data.get("context", [])
-                sources = response_data.get("sources", [])
-
-                with st.session_state.source_container:
-                    if not context_docs:
-                        st.warning("未能从知识库中找到直接相关的信息。模型的回答将基于其通用知识或网络搜索。")
+        status_box = st.status("正在知识库中检索并思考...", expanded=False)
+        answer_placeholder = st.empty()
+        streamed_text = ""
+        response_data = {}
+        try:
+            # 流式渲染：状态事件写入状态框，回答 token 实时追加到占位符
+            for event in agent.rag_chat_stream(prompt, session_id=st.session_state.session_id, n_results=5,
+                                               image_bytes=image_to_process, vehicle=st.session_state.vehicle):
+                if event["type"] == "status":
+                    status_box.write(event["message"])
+                elif event["type"] == "token":
+                    streamed_text += event["content"]
+                    answer_placeholder.markdown(streamed_text + "▌")
+                elif event["type"] == "reset":
+                    # 模型转而调用工具，之前流出的内容不是最终回答
+                    streamed_text = ""
+                    answer_placeholder.empty()
+                elif event["type"] == "final":
+                    response_data = event["data"]
+            status_box.update(label="回答完成", state="complete")
+
+            context_docs = response_data.get("context", [])
+            sources = response_data.get("sources", [])
+
+            with st.session_state.source_container:
+                if not context_docs:
+                    st.warning("未能从知识库中找到直接相关的信息。模型的回答将基于其通用知识或网络搜索。")
+                else:
+                    st.info("以下是本次回答参考的主要知识片段：")
+                    for i, doc in enumerate(context_docs):
+                        with st.expander(f"参考文档 {i + 1}"):
+                            st.text(doc[:500] + "..." if len(doc) > 500 else doc)
+                    if sources:
+                        st.markdown("---")
+                        st.info("来源信息:")
+                        for source in sources:
+                            st.markdown(f"- {source}")
                     else:
-                        st.info("以下是本次回答参考的主要知识片段：")
-                        for i, doc in enumerate(context_docs):
-                            with st.expander(f"参考文档 {i + 1}"):
-                                st.text(doc[:500] + "..." if len(doc) > 500 else doc)
-                        if sources:
-                            st.markdown("---")
-                            st.info("来源信息:")
-                            for source in sources:
-                                st.markdown(f"- {source}")
-                        else:
-                            st.markdown("---")
-                            st.warning("无明确来源信息。")
-
-                full_response = response_data.get("answer", "无法获取回答。")
-
-            except Exception as e:
-                st.error(f"处理问题时出错: {e}")
-                full_response = "抱歉，我在处理您的请求时遇到了问题。请稍后再试。"
-            finally:
-                st.session_state.uploaded_image = None
-
-        st.write(full_response)
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
+                        st.markdown("---")
+                        st.warning("无明确来源信息。")
+
+            full_response = response_data.get("answer", "无法获取回答。")
+
+            if debug_mode and response_data.get("trace"):
+                trace = response_data["trace"]
+                with st.expander(f"本次请求耗时：{trace['duration_ms']:.0f} ms"):
+                    st.dataframe([{"阶段": stage["name"], "开始 (ms)": stage["start_ms"],
+                                   "耗时 (ms)": stage["duration_ms"]} for stage in trace["stages"]],
+                                 use_container_width=True)
+                    st.json({"tokens": trace["tokens"], "cache": trace["cache"],
+                             "retrieval": response_data.get("retrieval"),
+                             "answer_mode": response_data.get("answer_mode")})
+                with st.expander("累计延迟统计（p50 / p95 / p99）"):
+                    st.dataframe([{"阶段": stage, **stats} for stage, stats in agent.latency.percentiles().items()],
+                                 use_container_width=True)
+                    st.download_button("导出 Prometheus 指标", agent.latency.to_prometheus(),
+                                       file_name="rag_metrics.prom", mime="text/plain")
+
+        except Exception as e:
+            status_box.update(label="处理失败", state="error")
+            st.error(f"处理问题时出错: {e}")
+            full_response = "抱歉，我在处理您的请求时遇到了问题。请稍后再试。"
+        finally:
+            st.session_state.uploaded_image = None
+
+        # 以最终答案替换流式内容（Agent 调用工具前的中间输出不保留）
+        answer_placeholder.markdown(full_response)
+    st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -0,0 +1,64 @@
+import random
+import time
+
+from bm25_index import BM25Index, tokenizer_name
+
+QUESTIONS = ["仪表盘上的黄色电池警告灯亮了怎么办", "P0A80 故障码是什么意思", "充电口无法解锁",
+             "胎压监测系统报警后如何复位", "冬季续航里程下降的原因", "12V 蓄电池亏电如何处理"]
+
+
+def synthetic_text(rng: random.Random, length: int) -> str:
+    """
+    字频服从 Zipf 分布的合成中文文本：常用字组成的二元组会命中大量片段，接近真实手册的倒排表长度。
+    """
+    chars = [chr(code) for code in range(0x4e00, 0x4e00 + 2000)]
+    weights = [1.0 / rank for rank in range(1, len(chars) + 1)]
+    return "".join(rng.choices(chars, weights=weights, k=length))
+
+
+def synthetic_index(chunks: int, chunk_chars: int = 300, seed: int = 0) -> BM25Index:
+    rng = random.Random(seed)
+    index = BM25Index("unused.json")
+    for i in range(chunks):
+        index.add_chunk(str(i), synthetic_text(rng, chunk_chars), {"source": "synthetic"})
+    return index
+
+
+def benchmark(index: BM25Index, questions, rounds: int = 50, top_k: int = 10) -> None:
+    """
+    测量编译倒排表（预热）与单次查询的耗时。
+    """
+    print(f"片段数: {len(index)}，词数: {len(index.postings)}，分词方式: {tokenizer_name()}")
+    start = time.perf_counter()
+    index.warm_up()
+    print(f"编译倒排表: {time.perf_counter() - start:.2f}s")
+
+    latencies = []
+    for _ in range(rounds):
+        for question in questions:
+            start = time.perf_counter()
+            index.search(question, top_k)
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f"查询 {len(latencies)} 次：平均 {sum(latencies) / len(latencies):.2f}ms，"
+          f"p95 {latencies[int(len(latencies) * 0.95)]:.2f}ms，最大 {latencies[-1]:.2f}ms")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure BM25 index query latency.")
+    parser.add_argument("--index", type=str, default="./chroma_db/bm25_index.json",
+                        help="BM25 index file; a synthetic corpus is used if it does not exist")
+    parser.add_argument("--chunks", type=int, default=10000, help="Chunks in the synthetic corpus")
+    parser.add_argument("--rounds", type=int, default=50, help="Passes over the question list")
+    args = parser.parse_args()
+
+    bm25 = BM25Index.load(args.index)
+    if bm25.exists():
+        benchmark(bm25, QUESTIONS, args.rounds)
+    else:
+        # 合成语料的问题取自同一字频分布（15 字），否则问题中的词几乎不会命中
+        print(f"{args.index} 不存在，使用 {args.chunks} 个片段的合成语料。")
+        questions = [synthetic_text(random.Random(i + 1), 15) for i in range(len(QUESTIONS))]
+        benchmark(synthetic_index(args.chunks), questions, args.rounds)
@@ -0,0 +1,38 @@
+import time
+
+_start = time.perf_counter()
+from chat import ChatAgent  # noqa: E402
+IMPORT_SECONDS = time.perf_counter() - _start
+
+
+def benchmark(question: str) -> None:
+    """
+    测量冷启动各阶段的耗时：导入 chat、构造 ChatAgent、同步预热、预热后的首个请求。
+    需在新进程中运行，否则导入耗时不准确。
+    """
+    print(f"导入 chat: {IMPORT_SECONDS:.2f}s")
+
+    start = time.perf_counter()
+    agent = ChatAgent(use_answer_cache=False)
+    print(f"构造 ChatAgent: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    agent.warmup(background=False)
+    print(f"预热: {time.perf_counter() - start:.2f}s")
+    for name, seconds in agent.init_timings.items():
+        print(f"  {name:<36} {seconds:.2f}s")
+
+    start = time.perf_counter()
+    result = agent.rag_chat(question, session_id="bench_cold_start", n_results=5)
+    print(f"首个请求: {time.perf_counter() - start:.2f}s，回答方式 {result.get('answer_mode') or 'online'}")
+    agent.history_store.delete("bench_cold_start")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure ChatAgent cold-start time.")
+    parser.add_argument("--question", type=str, default="如何为我的车辆进行首次保养？", help="Question for the first request")
+    args = parser.parse_args()
+
+    benchmark(args.question)
@@ -0,0 +1,48 @@
+import asyncio
+import time
+from typing import List
+
+from chat import ChatAgent
+
+DEFAULT_QUESTIONS = [
+    "我的车最近续航掉了20%，可能是什么原因？",
+    "如何为我的车辆进行首次保养？",
+    "仪表盘上出现一个黄色的电池图标是什么意思？",
+    "空调制冷效果不佳怎么办？",
+    "冬季如何维护电池？",
+]
+
+
+async def run_sessions(agent: ChatAgent, sessions: int, questions: List[str]) -> float:
+    """
+    模拟 sessions 个会话同时提问（每个会话依次问完 questions），返回总耗时（秒）。
+    """
+    async def one_session(index: int):
+        for question in questions:
+            await agent.arag_chat(question, session_id=f"bench_{sessions}_{index}", n_results=5)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_session(i) for i in range(sessions)))
+    return time.perf_counter() - start
+
+
+async def benchmark(levels: List[int], questions: List[str]) -> None:
+    agent = ChatAgent()
+    for sessions in levels:
+        elapsed = await run_sessions(agent, sessions, questions)
+        total = sessions * len(questions)
+        print(f"并发会话 {sessions:>3}: {total} 个请求，耗时 {elapsed:.1f}s，吞吐 {total / elapsed:.2f} 请求/秒")
+    print("\n各阶段耗时（ms）：")
+    for stage, stats in sorted(agent.latency.percentiles().items()):
+        print(f"  {stage:<20} p50 {stats['p50_ms']:>8.1f}  p95 {stats['p95_ms']:>8.1f}  p99 {stats['p99_ms']:>8.1f}"
+              f"  (n={stats['count']})")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure arag_chat throughput under concurrent sessions.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8], help="Concurrent session counts to test")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args.sessions, DEFAULT_QUESTIONS))
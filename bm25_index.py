@@ -0,0 +1,221 @@
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from vector_store import matches_where
+
+INDEX_VERSION = 2
+
+_CJK_RUN = re.compile("[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+# 数字与字母相连的零件号、故障码、规格（P0420、12V、5W-30）整体作为一个词
+_WORD = re.compile(r"[a-z0-9]+(?:[-./][a-z0-9]+)*")
+
+_jieba = None
+_jieba_checked = False
+
+
+def _get_jieba():
+    global _jieba, _jieba_checked
+    if not _jieba_checked:
+        _jieba_checked = True
+        try:
+            import jieba  # 可选依赖：安装后按词切分中文，否则退回字二元组
+
+            jieba.setLogLevel(60)
+            _jieba = jieba
+        except ImportError:
+            _jieba = None
+    return _jieba
+
+
+def tokenizer_name() -> str:
+    return "jieba" if _get_jieba() is not None else "bigram"
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中文分词：英文单词、数字与编码按整体切分；中文安装了 jieba 时用搜索引擎模式分词，
+    否则切成相邻两字的二元组（单字的片段保留单字）。建索引与查询必须使用同一种分词方式。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = _WORD.findall(text)
+    jieba = _get_jieba()
+    for run in _CJK_RUN.findall(text):
+        if jieba is not None:
+            tokens.extend(word for word in jieba.lcut_for_search(run) if word.strip())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        """
+        片段的 BM25 倒排索引：词 -> {片段ID: 词频}，以及每个片段的来源、页码、车型、年款与长度。
+
+        入库时随片段一起增量维护并持久化为 JSON。查询前把倒排表编译为连续的数组（每个词在数组中的区间、
+        片段下标与预先算好的 BM25 权重），查询只需对问题中每个词的区间做一次向量化累加。用 bench_bm25.py
+        在合成语料（300 字片段、15 字问题、字二元组分词）上实测：2000 个片段平均约 0.15 毫秒，
+        1 万个片段平均约 0.4 毫秒、p95 约 0.5 毫秒；编译一次约 0.5～2 秒，在预热阶段完成。
+        零件名、警告灯名称和编码这类字面匹配正是向量检索的弱项，两者的结果用倒数排名融合。
+
+        参数：
+            path: 索引的 JSON 文件路径。
+            k1 / b: BM25 的词频饱和与长度归一化参数。
+        """
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer_name()
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.docs: Dict[str, Dict] = {}
+        self.stale = False  # 索引文件的版本或分词方式与当前不一致，需要重建
+        self._compiled: Optional[Tuple[List[str], Dict[str, Tuple[int, int]], np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        index = cls(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION and data.get("tokenizer") == index.tokenizer:
+                index.postings, index.docs = data["postings"], data["docs"]
+            else:
+                print("BM25 索引的版本或分词方式已变化，将重建索引。")
+                index.stale = True
+        return index
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) and not self.stale
+
+    def save(self) -> None:
+        """
+        原子地写入索引文件。
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "tokenizer": self.tokenizer,
+                       "docs": self.docs, "postings": self.postings}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.stale = False
+
+    def add_chunk(self, chunk_id: str, text: str, metadata: Dict) -> None:
+        """
+        对片段分词并登记到倒排表，已登记的片段ID会被跳过。
+        """
+        if chunk_id in self.docs:
+            return
+        counts = Counter(tokenize(text))
+        self.docs[chunk_id] = {"source": metadata.get("source"), "page": metadata.get("page"),
+                               "vehicle_model": metadata.get("vehicle_model", ""),
+                               "model_year": metadata.get("model_year", ""),
+                               "length": sum(counts.values())}
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[chunk_id] = tf
+        self._compiled = None
+
+    def remove_source(self, source: str) -> None:
+        """
+        移除某个来源文件的全部片段（文件被删除或内容变化时调用）。
+        """
+        removed = {cid for cid, doc in self.docs.items() if doc["source"] == source}
+        if not removed:
+            return
+        for cid in removed:
+            del self.docs[cid]
+        for term in list(self.postings):
+            entries = self.postings[term]
+            for cid in removed.intersection(entries):
+                del entries[cid]
+            if not entries:
+                del self.postings[term]
+        self._compiled = None
+
+    def clear(self) -> None:
+        self.postings, self.docs = {}, {}
+        self._compiled = None
+
+    def _compile(self) -> Tuple[List[str], Dict[str, Tuple[int, int]], np.ndarray, np.ndarray]:
+        """
+        预先计算每个 (词, 片段) 的 BM25 权重：idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * 长度 / 平均长度))。
+
+        返回 (片段ID列表, 词 -> 在数组中的区间 [start, end), 片段下标数组, 权重数组)，
+        所有词的倒排表首尾相接存放在两个数组中。
+        """
+        if self._compiled is None:
+            doc_ids = list(self.docs)
+            position = {cid: i for i, cid in enumerate(doc_ids)}
+            lengths = np.array([self.docs[cid]["length"] for cid in doc_ids], dtype=np.float64)
+            avg_length = lengths.mean() if len(doc_ids) else 1.0
+            spans, doc_index, tfs, dfs = {}, [], [], []
+            for term, entries in self.postings.items():
+                start = len(doc_index)
+                doc_index.extend(position[cid] for cid in entries)
+                tfs.extend(entries.values())
+                spans[term] = (start, len(doc_index))
+                dfs.append(len(entries))
+            doc_index = np.array(doc_index, dtype=np.int32)
+            tfs = np.array(tfs, dtype=np.float64)
+            dfs = np.array(dfs, dtype=np.float64)
+            idf = np.repeat(np.log(1 + (len(doc_ids) - dfs + 0.5) / (dfs + 0.5)), dfs.astype(np.int64))
+            weights = idf * tfs * (self.k1 + 1) / (
+                tfs + self.k1 * (1 - self.b + self.b * lengths[doc_index] / avg_length))
+            self._compiled = (doc_ids, spans, doc_index, weights.astype(np.float32))
+        return self._compiled
+
+    def warm_up(self) -> None:
+        self._compile()
+
+    def search(self, query: str, top_k: int = 10, where: Optional[Dict] = None) -> List[Tuple[str, float]]:
+        """
+        返回 BM25 得分最高的 top_k 个 (片段ID, 得分)，按得分从高到低排列；问题中的重复词只计一次。
+        where 为 Chroma 风格的过滤条件（如车型），按片段登记的元数据过滤。
+        """
+        if top_k <= 0:
+            return []
+        doc_ids, spans, doc_index, weights = self._compile()
+        scores = np.zeros(len(doc_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            span = spans.get(term)
+            if span is not None:
+                # 同一个词的倒排表中片段下标互不相同，可以直接按下标累加
+                scores[doc_index[span[0]:span[1]]] += weights[span[0]:span[1]]
+        candidates = np.flatnonzero(scores)
+        if not where and len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        results = []
+        for i in ranked:
+            # 带过滤条件时按得分从高到低检查元数据，凑满 top_k 个即停止
+            if where and not matches_where(self.docs[doc_ids[i]], where):
+                continue
+            results.append((doc_ids[i], float(scores[i])))
+            if len(results) == top_k:
+                break
+        return results
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合（RRF）：每个片段的得分为它在各个排名列表中 1 / (k + 名次) 之和，按得分从高到低返回。
+    只依赖名次，不需要把向量距离与 BM25 得分换算到同一尺度。
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, start=1):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,163 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+_MISSING = object()
+_PURGE_INTERVAL = 600  # 磁盘层清理过期条目的最小间隔（秒）
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None,
+                 persist_path: Optional[str] = None, name: str = "cache", disk_maxsize: Optional[int] = None):
+        """
+        线程安全的进程内 LRU 缓存，支持 TTL 过期和可选的 SQLite 磁盘层。
+
+        内存层超过 maxsize 时淘汰最久未使用的条目；条目写入超过 ttl 秒后视为过期。
+        提供 persist_path 时，所有写入同时落盘，内存未命中会回退查询磁盘层，
+        因此进程重启后仍可命中。磁盘层的键为 str(key)，值用 pickle 序列化。
+        磁盘层同样有上限：行数超过 disk_maxsize 时删除最早写入的条目（一次删到上限的 90%，摊薄删除开销），
+        过期条目在打开时以及之后写入时（至多每 10 分钟一次）被清除。
+
+        参数：
+            maxsize: 内存层最多保存的条目数。
+            ttl: 条目有效期（秒），None 表示永不过期。
+            persist_path: SQLite 文件路径，None 表示不启用磁盘层。
+            name: 缓存名称，仅用于日志和统计。
+            disk_maxsize: 磁盘层最多保存的条目数，None 表示与 maxsize 相同。
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self.disk_maxsize = maxsize if disk_maxsize is None else disk_maxsize
+        self._db = None
+        self._disk_rows = 0  # 磁盘层行数的上界（覆盖写入同一个键时会多计，修剪时重新统计）
+        self._last_purge = 0.0
+        if persist_path:
+            directory = os.path.dirname(persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(persist_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+            with self._lock:
+                self._trim_disk()
+            self._db.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _trim_disk(self) -> None:
+        """
+        删除磁盘层的过期条目，行数超过 disk_maxsize 时再删除最早写入的条目，直到上限的 90%。调用方需持有锁并提交。
+        """
+        now = time.time()
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        self._last_purge = now
+        self._disk_rows = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if self._disk_rows > self.disk_maxsize:
+            excess = self._disk_rows - int(self.disk_maxsize * 0.9)
+            self._db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created LIMIT ?)",
+                             (excess,))
+            self._disk_rows -= excess
+
+    def _store(self, key: Hashable, value: Any, created: float) -> None:
+        self._data[key] = (value, created)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                value, created = item
+                if not self._expired(created):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM cache WHERE key = ?", (str(key),)).fetchone()
+                if row is not None:
+                    if not self._expired(row[1]):
+                        value = pickle.loads(row[0])
+                        self._store(key, value, row[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    self._db.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+                    self._db.commit()
+
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            created = time.time()
+            self._store(key, value, created)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                                 (str(key), pickle.dumps(value), created))
+                self._disk_rows += 1
+                if self._disk_rows > self.disk_maxsize or created - self._last_purge > _PURGE_INTERVAL:
+                    self._trim_disk()
+                self._db.commit()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+                self._db.commit()
+            return default if item is _MISSING else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache")
+                self._db.commit()
+                self._disk_rows = 0
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """
+        返回内存层中未过期条目的快照，不影响 LRU 顺序，也不计入命中统计。
+        """
+        with self._lock:
+            return [(key, value) for key, (value, created) in self._data.items() if not self._expired(created)]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            return item is not _MISSING and not self._expired(item[1])
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回命中/未命中计数及当前大小。
+        """
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "disk_rows": self._disk_rows if self._db is not None else 0,
+        }
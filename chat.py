@@ -1,77 +1,289 @@
+import asyncio
 import base64
+import contextlib
+import contextvars
+import json
 import os
-from typing import List, Any, Dict, Union
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, Callable, Dict, Generator, Iterator, Optional, Tuple, Union
 
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import BaseMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_models import ChatOllama
-from langchain_community.tools import TavilySearchResults
-from langchain.agents import AgentExecutor, create_tool_calling_agent
 
 
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
-from embed import query_db
-from load_key import load_key
+from chunk import extract_fault_codes
+from answer_cache import SemanticAnswerCache
+from context_packer import pack_context
+from config import get_setting, require_setting
+from embed import (aembed_text, aquery_db, embed_text, embed_texts, fuse_results, get_bm25_index, get_kb_version,
+                   get_vector_store, lexical_search, lookup_fault_codes, match_warning_light, query_db,
+                   vehicle_filter)
+from history_store import SessionHistoryStore
+from intent_classifier import IntentClassifier
 
-from sentence_transformers import CrossEncoder
+from reranker import RerankerService
+from tracing import LatencyRecorder, Trace, TraceCallbackHandler, current_trace, record_cache, trace_stage
 
-from multimodal_model import MultimodalModel
+# 重量级依赖（langchain_openai、Agent、Tavily、多模态模型）在首次使用时才导入，见 ChatAgent._lazy
+# ONE_API_BASE_URL（例如 http://localhost:3000/v1）、ONE_API_KEY、TAVILY_API_KEY
+# 通过 config.get_setting 读取：环境变量优先，其次是 Keys.json，不会交互式提示
 
-ONE_API_BASE_URL = load_key("ONE_API_BASE_URL") # 例如: http://localhost:3000/v1
-ONE_API_KEY = load_key("ONE_API_KEY") # One API 的访问令牌
 
-os.environ["TAVILY_API_KEY"] = load_key("TAVILY_API_KEY")
+# 车辆问题助手的系统提示词：开头 + 信息来源说明（Agent 与直答链不同）+ 回答要求
+VEHICLE_PROMPT_HEADER = """您是一位专业且富有同理心的新能源汽车诊断与知识助手。
+                您的目标是帮助车主理解和解决他们的问题。
+
+                """
+
+AGENT_TOOL_GUIDANCE = """请您综合利用您拥有的“上下文信息”和可用的“工具”来回答用户的问题。
+                重要：如果“上下文信息”为空或没有直接相关的答案，请您优先尝试使用“工具”进行网络搜索以获取最新或更广泛的信息。如果工具也未能提供相关信息，则请您根据自己的通用知识进行回答。**
+                如果您使用了工具，请在回答中清晰地说明您是如何获取到这些信息的。
+
+"""
+
+DIRECT_ANSWER_GUIDANCE = """请您依据下面的“上下文信息”回答用户的问题。
+                如果“上下文信息”不足以完整回答，请坦诚说明哪些部分缺少依据，再根据您的通用知识给出谨慎的建议。
+
+"""
+
+VEHICLE_PROMPT_BODY = """                如果涉及故障诊断，请提供易懂的解释、可能的故障原因、初步的排查建议，以及后续的行动指南（如是否需要立即检修、是否可以继续行驶等）。
+                请确保您的回答：
+                1. 人性化和有同理心：开头可以使用亲切的语气，理解用户的困扰。
+                2. 易懂且具体：避免过于专业的术语，用生活化语言解释复杂概念。
+                3. 可执行：给出明确的行动步骤或建议，让用户知道“下一步该做什么”。
+                4. 有信任感：提供必要的警示（如安全风险）、推荐专业服务，并在信息不足时坦诚告知。
+                5. 故障码处理（重要）：如果用户提及故障码，请务必提供：
+                    - 故障码的白话文解释。
+                    - 可能的根本原因。
+                    - 您基于现有知识的初步判断（例如，是否常见、是否紧急）。
+                    - 初步的排查或缓解措施（如果存在）。
+                    - 明确的维修建议和潜在费用范围（如果信息充足，可以预估一个大致范围）。
+                6. 保养/功能咨询：提供详细的步骤、注意事项和最佳实践。
+                7. 避免编造信息：如果您不确定，请坦诚告知用户，并建议他们咨询专业人士。
+
+                上下文信息:
+                {context}
+                回答时，如果你的答案基于“上下文信息”，请在相关句子末尾使用 [来源: 页码 X] 的格式进行引用。
+                """
+
+
+class _StreamingEventHandler(BaseCallbackHandler):
+    """
+    把 Agent 执行过程中的 token 与工具调用事件转发到队列，供流式生成器读取。
+
+    只有最终回答应当显示给用户：qwen3 在 <think>...</think> 中的推理内容不转发；
+    Agent 决定调用工具的那次模型调用结束时（输出中带有 tool_calls），若已转发过 token，
+    发出 reset 事件，界面据此清空已显示的中间输出，随后的 token 来自下一次模型调用。
+    """
+
+    def __init__(self, events: "queue.Queue"):
+        self.events = events
+        self._thinking: Dict[Any, bool] = {}  # run_id -> 是否处于 <think> 块中
+        self._streamed: set = set()  # 已转发过 token 的 run_id
+
+    def on_llm_new_token(self, token: str, *, run_id: Any = None, **kwargs: Any) -> None:
+        visible = []
+        while token:
+            if self._thinking.get(run_id):
+                _, closed, token = token.partition("</think>")
+                if closed:
+                    self._thinking[run_id] = False
+                else:
+                    token = ""
+            else:
+                text, opened, token = token.partition("<think>")
+                visible.append(text)
+                if opened:
+                    self._thinking[run_id] = True
+        content = "".join(visible)
+        if content.strip() or (content and run_id in self._streamed):
+            self._streamed.add(run_id)
+            self.events.put({"type": "token", "content": content})
+
+    def on_llm_end(self, response: Any, *, run_id: Any = None, **kwargs: Any) -> None:
+        self._thinking.pop(run_id, None)
+        if run_id not in self._streamed:
+            return
+        self._streamed.discard(run_id)
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if getattr(message, "tool_calls", None) or getattr(message, "tool_call_chunks", None):
+                    self.events.put({"type": "reset"})
+                    return
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        tool_name = (serialized or {}).get("name", "工具")
+        self.events.put({"type": "status", "message": f"正在调用工具 {tool_name}：{input_str}"})
+
+    def on_tool_end(self, output: Any, **kwargs: Any) -> None:
+        self.events.put({"type": "status", "message": "工具调用完成，正在整理回答..."})
+
+
+def _run_to_completion(generator: Generator) -> Any:
+    """消费生成器产出的全部事件，返回其 return 值。"""
+    while True:
+        try:
+            next(generator)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _step(op: str, *args: Any) -> Dict[str, Any]:
+    """
+    步骤生成器请求执行的一个操作：同步路径调用 ChatAgent._<op>，异步路径等待 ChatAgent._a<op>
+    （没有异步版本时在线程中执行同步版本），结果通过 send 交回生成器。
+    """
+    return {"type": "call", "op": op, "args": args}
 
 
 class ChatAgent:
+    # arag_chat 中各后端的默认并发上限：本地 CPU 推理（重排）最紧，在线模型最宽松
+    DEFAULT_BACKEND_CONCURRENCY = {
+        "intent": 4,
+        "multimodal": 2,
+        "retrieval": 8,
+        "rerank": 2,
+        "local_llm": 4,
+        "online_llm": 16,
+    }
+
+    # 自适应检索策略的默认参数（距离为 Chroma 返回的平方 L2 距离，得分为重排模型的 0~1 相关性）
+    DEFAULT_RETRIEVAL_POLICY = {
+        "base_candidates": 10,  # 首次向量检索的候选数
+        "max_candidates": 20,  # 距离分布平坦时扩大到的候选数
+        "flat_spread": 0.05,  # 候选距离的极差小于该值视为“平坦”，需要扩大候选池
+        "skip_margin": 0.15,  # 第1名比第2名的距离领先超过该值时跳过重排
+        "shrink_margin": 0.08,  # 第 n_results 名与下一名的距离差超过该值时只重排前 n_results + shrink_extra 个
+        "shrink_extra": 2,
+        "min_rerank_score": 0.1,  # 重排得分低于该值的片段视为不相关并丢弃
+        "lexical_candidates": 10,  # 混合检索时 BM25 的候选数
+        "hybrid_candidates": 6,  # 混合检索融合后送去重排的候选数
+        "rrf_k": 60,  # 倒数排名融合的平滑常数
+    }
+
     def __init__(self,
                  local_model_name_via_oneapi: str = "qwen3:4B",  # 在 One API 中为 Ollama 渠道配置的模型名称
                  intent_model_name: str = "qwen3:0.6b",  # 用于意图识别的本地 Ollama 模型
                  online_model_name_via_oneapi: str = "deepseek-chat",  # 在 One API 中为在线模型渠道配置的模型名称
-                 ollama_base_url: str = "http://localhost:11434"):  # 本地 Ollama 服务的基础 URL):
+                 ollama_base_url: str = "http://localhost:11434",  # 本地 Ollama 服务的基础 URL
+                 use_intent_classifier: bool = True,  # 是否先用本地分类器判断意图，置信度不足时再调用意图大模型
+                 intent_decision_threshold: float = 0.06,  # 本地分类器直接给出结论所需的最小得分
+                 concurrent_mode: bool = False,  # 是否在意图识别的同时推测性地执行检索与重排
+                 backend_concurrency: Optional[Dict[str, int]] = None,  # arag_chat 中各后端的最大并发数
+                 use_answer_cache: bool = True,  # 是否启用语义答案缓存
+                 answer_cache_similarity: float = 0.95,  # 复用缓存回答所需的最小问题相似度
+                 answer_cache_size: int = 256,  # 最多缓存的回答数量
+                 answer_cache_ttl: Optional[float] = 3600,  # 缓存回答的有效期（秒）
+                 reranker_backend: Optional[str] = None,  # 重排推理后端：torch / onnx / onnx-int8
+                 reranker_threads: Optional[int] = None,  # 重排推理使用的CPU线程数
+                 retrieval_policy: Optional[Dict[str, float]] = None,  # 自适应检索策略参数
+                 retrieval_mode: str = "vector",  # 检索方式：vector / hybrid（向量 + BM25 倒数排名融合）
+                 direct_answer_threshold: Optional[float] = 0.7,  # 重排最高分达到该值时跳过 Agent，直接单次调用回答
+                 search_cache_ttl: Optional[float] = 1800,  # Tavily 搜索结果的缓存有效期（秒）
+                 history_db_path: str = "./cache/chat_history.sqlite",  # 会话历史的 SQLite 文件
+                 history_window_turns: int = 6,  # 提示词中保留的最近对话轮数
+                 history_summary: bool = False,  # 是否把滑出窗口的早期对话压缩为滚动摘要
+                 max_sessions_in_memory: int = 256,  # 内存中最多保留的会话数
+                 session_idle_ttl: Optional[float] = 3600,  # 会话在内存中的空闲有效期（秒）
+                 context_token_budget: Optional[int] = 2048,  # 提示词中上下文片段的 token 预算
+                 context_dedup_threshold: float = 0.9,  # 判定上下文片段近似重复的相似度
+                 image_max_size: int = 1024,  # 发送给多模态模型的图片最长边像素数
+                 icon_match_distance: Optional[int] = 10,  # 图片与手册警告灯图标匹配的最大感知哈希距离
+                 icon_match_margin: int = 3,  # 最佳图标须比第二名（不同说明）的距离至少小这么多
+                 trace_log_path: Optional[str] = None):  # 每次请求的追踪记录追加写入的 JSONL 文件
         """
         初始化聊天智能体
 
         Args:
             model_name: 使用的Ollama模型名称
             base_url: Ollama服务的基础URL
+            use_intent_classifier: 是否启用基于向量与关键词的本地意图分类快速通道
+            intent_decision_threshold: 本地意图分类的置信度阈值，调大则更多问题交给意图大模型
+            concurrent_mode: 启用后检索与重排在后台线程中与意图识别同时进行，车辆问题的关键路径耗时
+                约为二者的最大值而非之和；若最终路由到在线模型，推测得到的检索结果会被丢弃
+            backend_concurrency: arag_chat 中每个后端同时在途的最大调用数，键为
+                intent / multimodal / retrieval / rerank / local_llm / online_llm，未给出的使用默认值
+            use_answer_cache: 启用后，相似问题且重排后上下文片段一致时直接复用以前的回答，跳过 Agent 调用；
+                只用于会话的第一轮，且只在所选车型相同时复用
+            answer_cache_similarity / answer_cache_size / answer_cache_ttl: 语义答案缓存的阈值、容量与有效期
+            reranker_backend: 重排模型的推理后端，CPU 节点上可选 "onnx-int8"（ONNX Runtime 动态量化）；
+                未给出时读取配置项 RERANKER_BACKEND，默认为 "torch"
+            reranker_threads: 重排推理的CPU线程数
+            retrieval_policy: 自适应候选数与提前结束重排的参数，键见 DEFAULT_RETRIEVAL_POLICY，未给出的使用默认值
+            retrieval_mode: "hybrid" 时把向量检索的候选与 BM25 倒排索引的候选用倒数排名融合，
+                零件名、警告灯名称等字面匹配的片段更容易进入候选，重排的候选池随之缩小到 hybrid_candidates 个
+            direct_answer_threshold: 本地上下文置信度足够（重排最高分达到该值，或命中故障码索引、向量检索明显领先）时
+                使用不带工具的单次调用链，其余情况仍走可联网搜索的 Agent；None 表示总是使用 Agent
+            search_cache_ttl: 同一搜索查询在该时间内复用缓存结果
+            history_db_path: 会话历史持久化到该 SQLite 文件，进程重启或会话被淘汰后仍可恢复
+            history_window_turns: 只把最近若干轮对话放入提示词，0 表示不截断
+            history_summary: 启用后由意图模型在后台把滑出窗口的对话压缩为摘要，随历史一起放入提示词
+            max_sessions_in_memory / session_idle_ttl: 内存中会话的数量上限与空闲有效期，超出后仅保留在磁盘上
+            context_token_budget: 重排后的片段先合并同页重叠内容、去除近似重复，再按得分填充该预算；
+                None 表示不限制预算
+            context_dedup_threshold: 上下文片段之间的相似度达到该值时只保留得分较高的一个
+            image_max_size: 上传图片在描述前缩小到该尺寸以内并去掉 EXIF，同一张图片的描述会被缓存
+            icon_match_distance: 上传图片先与手册中提取的警告灯图标比对，距离不超过该值时直接使用图标说明，
+                不再调用多模态模型；None 表示不做图标匹配
+            icon_match_margin: 最佳匹配与说明不同的第二名距离差小于该值时视为无法区分，仍交给多模态模型描述
+            trace_log_path: 每次请求都会记录各阶段耗时、token 数与缓存命中，随结果字典的 "trace" 字段返回，
+                并汇总到 self.latency（可导出 p50/p95/p99 的 JSONL 与 Prometheus 文本）；提供路径时同时逐条落盘
         """
-        self.store = {}
-        print("初始化Re-ranking中...")
-        self.reranker = CrossEncoder('BAAI/bge-reranker-base')
-        print("Re-ranking初始化完成.")
-
-        #one api分法的多模态模型
-        self.multimodal_model = MultimodalModel(model_name="qwen2.5vl:3b", base_url=ollama_base_url)
-
-        # --- 意图识别模型 (直接调用本地 Ollama) ---
-        self.intent_llm = ChatOllama(model=intent_model_name, base_url=ollama_base_url, temperature=0.1)
-
-        # --- 通过 One API 调用本地大模型 (用于车辆问题) ---
-        # 注意：这里使用 ChatOpenAI，但它的 base_url 指向 One API
-        # model_name 对应 One API 中配置的 Ollama 渠道的模型名称
-        self.local_model_for_vehicle_via_oneapi = ChatOpenAI(
-            openai_api_base=ONE_API_BASE_URL,
-            openai_api_key=ONE_API_KEY,
-            model_name=local_model_name_via_oneapi,
-            temperature=0.3,
-            max_tokens=2000  # 可以根据需要调整
-        )
-        self.local_llm_chain = self._build_local_chain()
-
-        # --- 通过 One API 调用在线大模型 (用于非车辆问题) ---
-        # model_name 对应 One API 中在线模型渠道的模型名称
-        self.online_llm_via_oneapi = ChatOpenAI(
-            openai_api_base=ONE_API_BASE_URL,
-            openai_api_key=ONE_API_KEY,
-            model_name=online_model_name_via_oneapi,
-            temperature=0.7,
-            max_tokens=2000  # 可以根据需要调整
+        self.context_token_budget = context_token_budget
+        self.icon_match_distance = icon_match_distance
+        self.icon_match_margin = icon_match_margin
+        self.latency = LatencyRecorder(trace_log_path=trace_log_path)
+        self.context_dedup_threshold = context_dedup_threshold
+        self.history_store = SessionHistoryStore(
+            db_path=history_db_path,
+            max_sessions=max_sessions_in_memory,
+            idle_ttl=session_idle_ttl,
+            window_turns=history_window_turns,
+            summarizer=self._summarize_history if history_summary else None
         )
+        self.concurrent_mode = concurrent_mode
+        self.backend_concurrency = {**self.DEFAULT_BACKEND_CONCURRENCY, **(backend_concurrency or {})}
+        self.retrieval_policy = {**self.DEFAULT_RETRIEVAL_POLICY, **(retrieval_policy or {})}
+        if retrieval_mode not in ("vector", "hybrid"):
+            raise ValueError(f"未知的检索方式：{retrieval_mode}（可选 vector / hybrid）")
+        self.retrieval_mode = retrieval_mode
+        self.direct_answer_threshold = direct_answer_threshold
+        self.search_cache_ttl = search_cache_ttl
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._semaphore_loop = None
+        self.answer_cache = SemanticAnswerCache(
+            kb_version_fn=get_kb_version,
+            similarity_threshold=answer_cache_similarity,
+            maxsize=answer_cache_size,
+            ttl=answer_cache_ttl
+        ) if use_answer_cache else None
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-speculative") if concurrent_mode else None
+        self.intent_classifier = IntentClassifier(
+            embed_fn=embed_text,
+            embed_batch_fn=embed_texts,
+            decision_threshold=intent_decision_threshold
+        ) if use_intent_classifier else None
+        # 模型、客户端与链都在首次使用时创建（或由 warmup() 在后台提前创建），构造 ChatAgent 本身几乎不耗时
+        self.local_model_name_via_oneapi = local_model_name_via_oneapi
+        self.intent_model_name = intent_model_name
+        self.online_model_name_via_oneapi = online_model_name_via_oneapi
+        self.ollama_base_url = ollama_base_url
+        self.reranker_backend = reranker_backend or get_setting("RERANKER_BACKEND", "torch")
+        self.reranker_threads = reranker_threads
+        self.image_max_size = image_max_size
+        self._resources: Dict[str, Any] = {}
+        self._resource_locks: Dict[str, threading.Lock] = {}
+        self._resource_guard = threading.Lock()
+        self.init_timings: Dict[str, float] = {}
 
         # 用于意图识别的Prompt
         self.intent_prompt_template = ChatPromptTemplate.from_messages([
@@ -95,28 +307,184 @@ class ChatAgent:
         ])
         print("ChatAgent 初始化完成.")
 
+    # --- 按需创建的组件 ---
+    def _lazy(self, name: str, factory: Callable[[], Any]) -> Any:
+        """
+        首次访问时创建并缓存组件，记录创建耗时到 init_timings。
+        每个组件有独立的锁：后台预热加载重排模型时，请求线程仍可创建其他组件。
+        """
+        resource = self._resources.get(name)
+        if resource is not None:
+            return resource
+        with self._resource_guard:
+            lock = self._resource_locks.setdefault(name, threading.Lock())
+        with lock:
+            resource = self._resources.get(name)
+            if resource is None:
+                start = time.perf_counter()
+                resource = factory()
+                self.init_timings[name] = round(time.perf_counter() - start, 3)
+                self._resources[name] = resource
+                print(f"{name} 初始化完成，耗时 {self.init_timings[name]:.2f}s")
+        return resource
+
+    def _create_one_api_llm(self, model_name: str, **kwargs: Any) -> Any:
+        # 注意：这里使用 ChatOpenAI，但它的 base_url 指向 One API
+        # model_name 对应 One API 中配置的渠道的模型名称
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(
+            openai_api_base=require_setting("ONE_API_BASE_URL"),
+            openai_api_key=require_setting("ONE_API_KEY"),
+            model_name=model_name,
+            max_tokens=2000,  # 可以根据需要调整
+            **kwargs
+        )
+
+    @property
+    def reranker(self) -> RerankerService:
+        return self._lazy("reranker", lambda: RerankerService('BAAI/bge-reranker-base', backend=self.reranker_backend,
+                                                              num_threads=self.reranker_threads))
+
+    @property
+    def multimodal_model(self) -> Any:
+        def create():
+            from multimodal_model import MultimodalModel
+
+            return MultimodalModel(model_name="qwen2.5vl:3b", base_url=self.ollama_base_url,
+                                   max_image_size=self.image_max_size)
+        return self._lazy("multimodal_model", create)
+
+    @property
+    def intent_llm(self) -> Any:
+        # --- 意图识别模型 (直接调用本地 Ollama) ---
+        def create():
+            from langchain_community.chat_models import ChatOllama
+
+            return ChatOllama(model=self.intent_model_name, base_url=self.ollama_base_url, temperature=0.1)
+        return self._lazy("intent_llm", create)
+
+    @property
+    def local_model_for_vehicle_via_oneapi(self) -> Any:
+        # --- 通过 One API 调用本地大模型 (用于车辆问题) ---
+        return self._lazy("local_model_for_vehicle_via_oneapi", lambda: self._create_one_api_llm(
+            self.local_model_name_via_oneapi,
+            temperature=0.3,
+            streaming=True  # 逐 token 回调，供 rag_chat_stream 使用
+        ))
+
+    @property
+    def online_llm_via_oneapi(self) -> Any:
+        # --- 通过 One API 调用在线大模型 (用于非车辆问题) ---
+        return self._lazy("online_llm_via_oneapi", lambda: self._create_one_api_llm(
+            self.online_model_name_via_oneapi, temperature=0.7))
+
+    @property
+    def local_llm_chain(self) -> Any:
+        return self._lazy("local_llm_chain", self._build_local_chain)
+
+    @property
+    def direct_rag_chain(self) -> Any:
+        return self._lazy("direct_rag_chain", self._build_direct_chain)
+
+    def warmup(self, background: bool = True) -> Optional[threading.Thread]:
+        """
+        预先创建全部组件并完成首次调用的准备：打开知识库、嵌入示例问题、加载并试跑重排模型、构建回答链。
+
+        background=True 时在守护线程中执行并立即返回该线程，界面可以先开始服务；
+        预热完成前到达的请求会在各组件的锁上等待或自行创建，不会重复加载。
+        各步骤耗时记入 init_timings。
+        """
+        steps = [
+            ("knowledge_base", lambda: get_vector_store().count()),
+            ("query_embedding", lambda: embed_text("预热")),
+            ("lexical_index", lambda: self.retrieval_mode == "hybrid" and get_bm25_index().warm_up()),
+            ("intent_classifier", lambda: self.intent_classifier and self.intent_classifier.warm_up()),
+            ("reranker_inference", lambda: self.reranker.score("预热", ["预热"])),
+            ("intent_llm", lambda: self.intent_llm),
+            ("direct_rag_chain", lambda: self.direct_rag_chain),
+            ("local_llm_chain", lambda: self.local_llm_chain),
+            ("online_llm_via_oneapi", lambda: self.online_llm_via_oneapi),
+            ("multimodal_model", lambda: self.multimodal_model),
+        ]
+
+        def run():
+            start = time.perf_counter()
+            for name, step in steps:
+                step_start = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    print(f"预热 {name} 失败：{e}")
+                    continue
+                self.init_timings.setdefault(name, round(time.perf_counter() - step_start, 3))
+            print(f"ChatAgent 预热完成，耗时 {time.perf_counter() - start:.2f}s：{self.init_timings}")
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="chat-agent-warmup", daemon=True)
+        thread.start()
+        return thread
+
     def _get_session_history(self, session_id: str) -> BaseChatMessageHistory:
-        """获取或创建会话历史"""
-        if session_id not in self.store:
-            self.store[session_id] = ChatMessageHistory()
-        return self.store[session_id]
+        """获取或创建会话历史（只包含最近的窗口与滚动摘要）"""
+        return self.history_store.get(session_id)
+
+    def _summarize_history(self, previous_summary: str, messages: List[BaseMessage]) -> str:
+        """
+        把滑出窗口的对话与已有摘要合并为新的摘要。
+        """
+        lines = []
+        for message in messages:
+            content = message.content
+            if isinstance(content, list):  # 多模态消息只取文本部分
+                content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+            lines.append(f"{'用户' if message.type == 'human' else '助手'}：{content}")
+        prompt = (
+            "请把以下对话内容与已有摘要合并，输出一段不超过200字的中文摘要，"
+            "保留车型、故障现象、故障码和已给出的结论，不要添加其他说明。\n\n"
+            f"已有摘要：{previous_summary or '无'}\n\n新增对话：\n" + "\n".join(lines)
+        )
+        return self.intent_llm.invoke(prompt).content.strip()
+
+    def _classify_intent_locally(self, question: str, query_embedding: List[float] = None) -> Optional[str]:
+        """
+        使用本地意图分类器判断意图，置信度不足或未启用时返回 None。
+        """
+        if not self.intent_classifier:
+            return None
+        decision = self.intent_classifier.classify(question, query_embedding=query_embedding)
+        print(f"本地意图分类: {decision}")
+        if decision["intent"]:
+            print(f"意图识别为: {'车辆问题' if decision['intent'] == 'vehicle' else '通用问题'}（本地分类器）")
+            return decision["intent"]
+        print("本地意图分类置信度不足，交由意图识别模型判断。")
+        return None
+
+    @staticmethod
+    def _parse_intent_response(content: str) -> str:
+        intent = content.strip().lower()
+        print(intent)
+        if "车辆问题" in intent:
+            print("意图识别为: 车辆问题")
+            return "vehicle"
+        else:
+            print("意图识别为: 通用问题")
+            return "general"
 
     def _determine_intent(self, question: str) -> str:
         """
         判断用户问题的意图。
         """
         print(f"正在判断用户意图：{question}")
+        intent = self._classify_intent_locally(question)
+        if intent:
+            return intent
         try:
             intent_chain = self.intent_prompt_template | self.intent_llm
             response = intent_chain.invoke({"question": question})
-            intent = response.content.strip().lower()
-            print(intent)
-            if "车辆问题" in intent:
-                print("意图识别为: 车辆问题")
-                return "vehicle"
-            else:
-                print("意图识别为: 通用问题")
-                return "general"
+            return self._parse_intent_response(response.content)
         except Exception as e:
             print(f"意图识别失败，默认为通用问题: {e}")
             return "general"  # 失败时默认使用通用模型
@@ -126,7 +494,12 @@ class ChatAgent:
         """
         构建用于处理本地大模型的链（即RAG Agent），该模型通过 One API 调用。
         """
-        tavily_tool = TavilySearchResults(max_results=3)
+        from langchain.agents import AgentExecutor, create_tool_calling_agent
+        from search_tool import build_cached_tavily_tool
+
+        if not os.environ.get("TAVILY_API_KEY"):
+            os.environ["TAVILY_API_KEY"] = require_setting("TAVILY_API_KEY")
+        tavily_tool = build_cached_tavily_tool(max_results=3, ttl=self.search_cache_ttl)
         tools = [tavily_tool]
         # 使用通过 One API 调用的本地大模型
         agent_llm = self.local_model_for_vehicle_via_oneapi
@@ -134,32 +507,7 @@ class ChatAgent:
         # 3. 定义Agent的提示模板
         prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", """您是一位专业且富有同理心的新能源汽车诊断与知识助手。
-                您的目标是帮助车主理解和解决他们的问题。
-
-                请您综合利用您拥有的“上下文信息”和可用的“工具”来回答用户的问题。
-                重要：如果“上下文信息”为空或没有直接相关的答案，请您优先尝试使用“工具”进行网络搜索以获取最新或更广泛的信息。如果工具也未能提供相关信息，则请您根据自己的通用知识进行回答。**
-                如果您使用了工具，请在回答中清晰地说明您是如何获取到这些信息的。
-
-                如果涉及故障诊断，请提供易懂的解释、可能的故障原因、初步的排查建议，以及后续的行动指南（如是否需要立即检修、是否可以继续行驶等）。
-                请确保您的回答：
-                1. 人性化和有同理心：开头可以使用亲切的语气，理解用户的困扰。
-                2. 易懂且具体：避免过于专业的术语，用生活化语言解释复杂概念。
-                3. 可执行：给出明确的行动步骤或建议，让用户知道“下一步该做什么”。
-                4. 有信任感：提供必要的警示（如安全风险）、推荐专业服务，并在信息不足时坦诚告知。
-                5. 故障码处理（重要）：如果用户提及故障码，请务必提供：
-                    - 故障码的白话文解释。
-                    - 可能的根本原因。
-                    - 您基于现有知识的初步判断（例如，是否常见、是否紧急）。
-                    - 初步的排查或缓解措施（如果存在）。
-                    - 明确的维修建议和潜在费用范围（如果信息充足，可以预估一个大致范围）。
-                6. 保养/功能咨询：提供详细的步骤、注意事项和最佳实践。
-                7. 避免编造信息：如果您不确定，请坦诚告知用户，并建议他们咨询专业人士。
-
-                上下文信息:
-                {context}
-                回答时，如果你的答案基于“上下文信息”，请在相关句子末尾使用 [来源: 页码 X] 的格式进行引用。
-                """),
+                ("system", VEHICLE_PROMPT_HEADER + AGENT_TOOL_GUIDANCE + VEHICLE_PROMPT_BODY),
                 MessagesPlaceholder(variable_name="chat_history"),
                 ("human", "{question}"),
                 MessagesPlaceholder(variable_name="agent_scratchpad"),
@@ -181,99 +529,738 @@ class ChatAgent:
         )
         return chain_with_history
 
-    def rag_chat(self, question: str, session_id: str, n_results: int = 3, image_bytes: bytes = None) -> Dict[str, Any]:
+    def _build_direct_chain(self) -> Any:
         """
-        完整的RAG聊天流程，集成了重排机制以提高上下文精度。
-        支持多模态的输入，并根据意图分发到不同的大模型。
+        构建单次调用的 RAG 链（不带工具）：上下文足以回答时使用，省去 Agent 规划工具调用的额外往返。
+        """
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", VEHICLE_PROMPT_HEADER + DIRECT_ANSWER_GUIDANCE + VEHICLE_PROMPT_BODY),
+                MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "{question}"),
+            ]
+        )
+        chain = prompt | self.local_model_for_vehicle_via_oneapi | StrOutputParser()
+        return RunnableWithMessageHistory(
+            chain,
+            self._get_session_history,
+            input_messages_key="question",
+            history_messages_key="chat_history",
+        )
+
+    def _lookup_fault_codes(self, question: str, n_results: int, where: Optional[Dict] = None):
+        """
+        故障码快速通道：问题中出现故障码且索引中有对应片段时，直接返回这些片段及其元数据。
+        未命中时返回 None，由常规的意图识别 + 向量检索流程处理。
+        """
+        fault_codes = extract_fault_codes(question)
+        if not fault_codes:
+            return None
+        results = lookup_fault_codes(fault_codes, n_results=n_results, where=where)
+        if not results["documents"]:
+            print(f"故障码索引中未找到 {', '.join(fault_codes)}，使用常规流程。")
+            return None
+        print(f"命中故障码索引: {', '.join(fault_codes)}，跳过意图识别与重排。")
+        strategy = {"strategy": "fault_code_index", "codes": fault_codes, "candidates": len(results["ids"]),
+                    "reranked": 0, "dropped": 0, "top_score": None}
+        return results["documents"], results["metadatas"], results["ids"], strategy
+
+    def _plan_retrieval(self, retrieved_results: dict, n_results: int) -> Dict[str, Any]:
+        """
+        根据首次向量检索的距离分布选择策略：
+            skip_rerank  第1名的距离明显领先，直接按向量顺序取前 n_results 个
+            shrink       前 n_results 个与其后的候选拉开差距，只重排前 n_results + shrink_extra 个
+            expand       候选距离几乎一样（平坦），扩大候选池后全部重排
+            full         其余情况，重排全部候选
+        """
+        policy = self.retrieval_policy
+        distances = (retrieved_results.get("distances") or [[]])[0]
+        plan = {"strategy": "full", "candidates": len(distances)}
+        if len(distances) < 2:
+            return plan
+        gap = distances[1] - distances[0]
+        spread = distances[-1] - distances[0]
+        plan.update(gap=round(gap, 4), spread=round(spread, 4))
+        if gap >= policy["skip_margin"]:
+            plan["strategy"] = "skip_rerank"
+        elif spread < policy["flat_spread"] and len(distances) >= policy["base_candidates"]:
+            plan["strategy"] = "expand"
+            plan["candidates"] = int(policy["max_candidates"])
+        elif len(distances) > n_results and distances[n_results] - distances[n_results - 1] >= policy["shrink_margin"]:
+            plan["strategy"] = "shrink"
+            plan["candidates"] = min(len(distances), n_results + int(policy["shrink_extra"]))
+        return plan
+
+    def _retrieval_steps(self, question: str, n_results: int,
+                         where: Optional[Dict] = None) -> Generator[Dict, Any, Tuple]:
+        """
+        自适应地向量检索候选文档并用 CrossEncoder 重排，
+        返回最终的文档、元数据、片段ID以及本次采用的检索策略。where 限定检索范围（如所选车型）。
+
+        以步骤生成器的形式编写（见 _run_steps），同步与异步检索共用同一套决策逻辑。
+        """
+        initial_retrieval_count = int(self.retrieval_policy["base_candidates"])
+        print(f"向量检索中，获取 {initial_retrieval_count} 个候选文档...")
+        retrieved_results = yield _step("query_candidates", question, initial_retrieval_count, where)
+        plan = self._plan_retrieval(retrieved_results, n_results)
+        if plan["strategy"] == "expand":
+            print(f"候选距离分布平坦，扩大候选池到 {plan['candidates']} 个...")
+            retrieved_results = yield _step("query_candidates", question, plan["candidates"], where)
+        if self.retrieval_mode == "hybrid":
+            retrieved_results, plan = yield _step("fuse_lexical", question, retrieved_results, n_results, plan, where)
+
+        return (yield _step("rerank_candidates", question, retrieved_results, n_results, plan))
+
+    def _retrieve_and_rerank(self, question: str, n_results: int, where: Optional[Dict] = None):
+        return _run_to_completion(self._run_steps(self._retrieval_steps(question, n_results, where)))
+
+    @staticmethod
+    def _query_candidates(question: str, n_results: int, where: Optional[Dict] = None) -> dict:
+        return query_db(question, n_results=n_results, where=where)
+
+    def _fuse_lexical(self, question: str, retrieved_results: dict, n_results: int,
+                      plan: Dict[str, Any], where: Optional[Dict] = None) -> Tuple[dict, Dict[str, Any]]:
+        """
+        混合检索：取 BM25 候选与向量候选做倒数排名融合，只保留前 hybrid_candidates 个送去重排。
+        向量检索明显领先（skip_rerank）且融合后第1名不变时仍跳过重排，否则重排全部融合候选。
+        """
+        policy = self.retrieval_policy
+        lexical_hits = lexical_search(question, top_k=int(policy["lexical_candidates"]), where=where)
+        if not lexical_hits:
+            return retrieved_results, plan
+        candidates = max(n_results, int(policy["hybrid_candidates"]))
+        fused = fuse_results(retrieved_results, lexical_hits, candidates, rrf_k=int(policy["rrf_k"]))
+        vector_ids = retrieved_results["ids"][0]
+        fused_ids = fused["ids"][0]
+        plan = {**plan, "lexical_hits": len(lexical_hits),
+                "lexical_only": len([cid for cid in fused_ids if cid not in vector_ids])}
+        if not (plan["strategy"] == "skip_rerank" and fused_ids[:1] == vector_ids[:1]):
+            plan["strategy"] = "hybrid"
+        plan["candidates"] = len(fused_ids)
+        print(f"混合检索：BM25 命中 {len(lexical_hits)} 个，融合后保留 {len(fused_ids)} 个候选"
+              f"（其中 {plan['lexical_only']} 个仅来自 BM25）")
+        return fused, plan
+
+    def _rerank_candidates(self, question: str, retrieved_results: dict, n_results: int, plan: Dict[str, Any]):
+        """
+        按检索策略用 CrossEncoder 对候选文档重排（CPU 密集），丢弃得分低于 min_rerank_score 的片段，
+        返回得分最高的 n_results 个文档及其元数据、片段ID，以及记录了策略细节的字典。
+        """
+        initial_docs = retrieved_results["documents"][0]
+        initial_metadatas = retrieved_results.get("metadatas", [[]])[0]
+        initial_ids = retrieved_results["ids"][0]
+        strategy = {**plan, "reranked": 0, "dropped": 0, "top_score": None}
+
+        if not initial_docs:
+            print("未能从知识库检索到任何相关文档。")
+            return [], [], [], strategy
+
+        if plan["strategy"] == "skip_rerank":
+            print(f"首个候选明显领先（差距 {plan['gap']}），跳过重排。")
+            final_ids = initial_ids[:n_results]
+            print(f"检索策略: {strategy}")
+            return initial_docs[:n_results], initial_metadatas[:n_results], final_ids, strategy
+
+        rerank_count = plan["candidates"] if plan["strategy"] == "shrink" else len(initial_docs)
+        print(f"计算相关性得分（{rerank_count} 个候选）...")
+        scores = self.reranker.score(question, initial_docs[:rerank_count], initial_ids[:rerank_count])
+        strategy["reranked"] = rerank_count
+
+        print("按相关性得分排序...")
+        docs_with_scores_and_metadata = list(zip(initial_docs, initial_metadatas, scores, initial_ids))
+        docs_with_scores_and_metadata.sort(key=lambda x: x[2], reverse=True)
+        strategy["top_score"] = round(float(docs_with_scores_and_metadata[0][2]), 4)
+
+        relevant = [item for item in docs_with_scores_and_metadata if item[2] >= self.retrieval_policy["min_rerank_score"]]
+        strategy["dropped"] = len(docs_with_scores_and_metadata) - len(relevant)
+
+        print(f"筛选出得分最高的 {n_results} 个文档。")
+        final_docs_with_metadata = relevant[:n_results]
+        final_context_docs = [item[0] for item in final_docs_with_metadata]
+        final_metadatas = [item[1] for item in final_docs_with_metadata]
+        final_ids = [item[3] for item in final_docs_with_metadata]
+        print(f"检索策略: {strategy}")
+        return final_context_docs, final_metadatas, final_ids, strategy
+
+    @staticmethod
+    def _format_context(docs: List[str], metadatas: List[Dict]) -> str:
+        """
+        将上下文片段格式化为带来源与页码的文本，供提示词中的引用使用。
+        """
+        if not docs:
+            return "无"
+        formatted_context_list = []
+        for i, doc in enumerate(docs):
+            metadata = metadatas[i] or {}
+            source = metadata.get('source', '未知文档')
+            page = metadata.get('page', 'N/A')
+            formatted_context_list.append(
+                f"内容片段 {i + 1} (来源: {os.path.basename(source)}, 页码 {page}):\n{doc}")
+        return "\n\n".join(formatted_context_list)
+
+    def _match_warning_light(self, image_bytes: bytes, where: Optional[Dict] = None) -> Optional[str]:
+        """
+        用手册中的警告灯图标索引识别上传的图片，命中时返回可代替图片描述的文字，否则返回 None。
+        只有最佳匹配在 icon_match_distance 以内、且明显领先于说明不同的第二名时才跳过多模态模型。
+        """
+        if self.icon_match_distance is None:
+            return None
+        with trace_stage("icon_match") as stage:
+            # 多取 margin 的距离范围，才能判断第二名是否离得足够远
+            matches = match_warning_light(image_bytes, max_distance=self.icon_match_distance + self.icon_match_margin,
+                                          top_k=2, where=where)
+            best = matches[0] if matches else None
+            if best is not None and best["distance"] > self.icon_match_distance:
+                best = None
+            if best is not None and len(matches) > 1 and \
+                    matches[1]["distance"] - best["distance"] < self.icon_match_margin:
+                print(f"图标匹配不明确：{best['caption']}（{best['distance']}）与 "
+                      f"{matches[1]['caption']}（{matches[1]['distance']}），交给多模态模型。")
+                best = None
+            stage["matched"] = best is not None
+        if best is None:
+            return None
+        print(f"图片匹配到警告灯图标：{best['caption']}（距离 {best['distance']}）")
+        return (f"仪表盘警告灯，手册中的说明为“{best['caption']}”"
+                f"（来源: {os.path.basename(best['source'])}, 页码 {best['page']}）")
+
+    def _answer_cacheable(self, session_id: str, image_bytes: bytes = None) -> bool:
+        """
+        语义答案缓存只用于会话的第一轮：有历史（或摘要）时回答依赖上文，相同的问题也不能复用别处的回答。
+        """
+        if self.answer_cache is None or image_bytes or session_id is None:
+            return False
+        return not self._get_session_history(session_id).messages
+
+    @staticmethod
+    def _cache_scope(where: Optional[Dict]) -> str:
+        # 检索范围（所选车型）作为缓存键的一部分，不同车型的相似问题不会共用回答
+        return json.dumps(where, sort_keys=True, ensure_ascii=False) if where else ""
+
+    def _prepare_turn(self, question: str, n_results: int, image_bytes: bytes = None,
+                      where: Optional[Dict] = None, session_id: Optional[str] = None) -> Generator[Dict, Any, Dict]:
+        """
+        生成回答之前的全部步骤：图片描述、故障码快速通道、意图识别、检索与重排。
+        where 限定图标匹配、故障码与检索的范围（所选车型的手册及通用资料）。
+        session_id 用于判断本轮能否使用语义答案缓存（见 _answer_cacheable）。
+
+        以步骤生成器形式编写：产出状态事件与待执行的操作（见 _step），最终 return 本轮的状态字典。
+        同步路径由 _run_steps 驱动（rag_chat、rag_chat_stream），异步路径由 _arun_steps 驱动（arag_chat），
+        两者只在操作的执行方式上不同。
         """
         original_question = question
         image_description = None
         if image_bytes:
-            # 多模态处理，直接调用本地 Ollama
-            image_description = self.multimodal_model.describe_image(image_bytes)
+            # 先与手册中的警告灯图标比对，未匹配时再调用本地 Ollama 多模态模型
+            image_description = yield _step("match_warning_light", image_bytes, where)
+            if image_description is None:
+                with trace_stage("image_description"):
+                    image_description = yield _step("describe_image", image_bytes)
             # 根据原始问题是否为空，拼接问题
             if not question.strip():  # 如果用户只上传图片没有文字问题
                 question = f"用户上传了一张图片，描述为：'{image_description}'。"
             else:  # 如果用户上传了图片也有文字问题
                 question = f"用户上传了一张图片，描述为：'{image_description}'。\n用户的问题是：{question}"
             print(f"结合图片描述后的问题: {question}")
+            yield {"type": "status", "message": "图片描述完成"}
+
+        # --- 故障码快速通道 ---
+        fault_code_hits = None
+        if not image_bytes:
+            with trace_stage("fault_code_lookup"):
+                fault_code_hits = yield _step("lookup_fault_codes", question, n_results, where)
+
+        # --- 语义答案缓存：相似问题以前被判为车辆问题时沿用该意图，跳过意图识别 ---
+        cacheable = yield _step("answer_cacheable", session_id, image_bytes)
+        cache_scope = self._cache_scope(where)
+        cached_candidate = None
+        if cacheable and not fault_code_hits:
+            cached_candidate = yield _step("find_cached_answer", question, cache_scope)
+
+        # --- 推测执行：检索不依赖意图结果，可与意图识别同时进行 ---
+        pending_retrieval = None
+        if not fault_code_hits:
+            pending_retrieval = yield _step("start_retrieval", question, n_results, where)
 
         # --- 意图识别 ---
         # 使用结合图片描述后的问题来判断意图
-        intent = self._determine_intent(question)
+        if fault_code_hits:
+            intent = "vehicle"
+        elif cached_candidate:
+            intent = cached_candidate["intent"]
+        else:
+            with trace_stage("intent") as stage:
+                intent = yield _step("determine_intent", question)
+                stage["intent"] = intent
+        yield {"type": "status", "message": f"意图识别完成：{'车辆问题' if intent == 'vehicle' else '通用问题'}"}
         final_context_docs = []
-        sources = []
+        final_metadatas = []
+        final_ids = []
+        retrieval_strategy = None
+        cached_result = None
+
+        if intent != "vehicle" and pending_retrieval is not None:
+            yield _step("cancel_retrieval", pending_retrieval)
 
         if intent == "vehicle":
-            print("意图为车辆问题，使用本地大模型(通过One API)进行RAG...")
             # --- RAG 流程开始 ---
-            initial_retrieval_count = 10
-            print(f"向量检索中，获取 {initial_retrieval_count} 个候选文档...")
-            retrieved_results = query_db(question, n_results=initial_retrieval_count)
+            if fault_code_hits:
+                final_context_docs, final_metadatas, final_ids, retrieval_strategy = fault_code_hits
+            else:
+                with trace_stage("retrieval_wait" if pending_retrieval is not None else "retrieval"):
+                    final_context_docs, final_metadatas, final_ids, retrieval_strategy = \
+                        yield _step("collect_retrieval", pending_retrieval, question, n_results, where)
+            # --- RAG 流程结束 ---
+            yield {"type": "status", "message": f"检索完成，找到 {len(final_context_docs)} 个参考片段"}
+            if cacheable:
+                cached_result = yield _step("lookup_cached_answer", question, final_ids, cache_scope)
+                record_cache("answer", cached_result is not None)
 
-            initial_docs = retrieved_results["documents"][0]
-            initial_metadatas = retrieved_results.get("metadatas", [[]])[0]
+        return {
+            "original_question": original_question,
+            "question": question,
+            "intent": intent,
+            "context_docs": final_context_docs,
+            "metadatas": final_metadatas,
+            "context_ids": final_ids,
+            "retrieval_strategy": retrieval_strategy,
+            "cacheable": cacheable,
+            "cache_scope": cache_scope,
+            "cached_result": cached_result,
+        }
 
-            if not initial_docs:
-                print("未能从知识库检索到任何相关文档。")
-                formatted_context = "无"
+    def _run_steps(self, steps: Generator) -> Generator[Dict, None, Any]:
+        """
+        同步驱动步骤生成器：直接调用请求的操作 self._<op>，状态事件原样产出，最终 return 生成器的返回值。
+        """
+        result = None
+        while True:
+            try:
+                event = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = None
+            if event["type"] == "call":
+                result = getattr(self, f"_{event['op']}")(*event["args"])
             else:
-                print("准备重排数据...")
-                rerank_pairs = []
-                for doc in initial_docs:
-                    rerank_pairs.append([question, doc])
-
-                print("计算相关性得分...")
-                scores = self.reranker.predict(rerank_pairs)
-
-                print("按相关性得分排序...")
-                docs_with_scores_and_metadata = list(zip(initial_docs, initial_metadatas, scores))
-                docs_with_scores_and_metadata.sort(key=lambda x: x[2], reverse=True)
-
-                print(f"筛选出得分最高的 {n_results} 个文档。")
-                final_docs_with_metadata = docs_with_scores_and_metadata[:n_results]
-                final_context_docs = [item[0] for item in final_docs_with_metadata]
-                final_metadatas = [item[1] for item in final_docs_with_metadata]
-
-                formatted_context_list = []
-                for i, doc in enumerate(final_context_docs):
-                    metadata = final_metadatas[i] or {}
-                    source = metadata.get('source', '未知文档')
-                    page = metadata.get('page', 'N/A')
-                    formatted_context_list.append(
-                        f"内容片段 {i + 1} (来源: {os.path.basename(source)}, 页码 {page}):\n{doc}")
-                formatted_context = "\n\n".join(formatted_context_list)
-            # --- RAG 流程结束 ---
+                yield event
+
+    # --- 步骤生成器请求的同步操作 ---
+    def _describe_image(self, image_bytes: bytes) -> str:
+        return self.multimodal_model.describe_image(image_bytes)
+
+    def _find_cached_answer(self, question: str, cache_scope: str) -> Optional[Dict]:
+        return self.answer_cache.find(embed_text(question), cache_scope)
+
+    def _lookup_cached_answer(self, question: str, context_ids: List[str], cache_scope: str) -> Optional[Dict]:
+        return self.answer_cache.lookup(embed_text(question), context_ids, cache_scope)
+
+    def _start_retrieval(self, question: str, n_results: int, where: Optional[Dict] = None):
+        """并发模式下把检索提交到线程池（继承当前追踪），返回 Future；否则返回 None，检索在需要时再执行。"""
+        if not self.concurrent_mode:
+            return None
+        print("并发模式：在意图识别的同时开始检索与重排...")
+        return self._executor.submit(contextvars.copy_context().run,
+                                     self._retrieve_and_rerank, question, n_results, where)
+
+    @staticmethod
+    def _cancel_retrieval(pending_retrieval) -> None:
+        if not pending_retrieval.cancel():
+            print("意图为通用问题，丢弃推测执行的检索结果。")
+
+    def _collect_retrieval(self, pending_retrieval, question: str, n_results: int, where: Optional[Dict] = None):
+        if pending_retrieval is not None:
+            return pending_retrieval.result()
+        return self._retrieve_and_rerank(question, n_results, where)
+
+    def _local_chain_inputs(self, state: Dict) -> Dict[str, Any]:
+        human_message_content = [{"type": "text", "text": state["question"]}]
+        new_human_message = HumanMessage(content=human_message_content)
+        context_docs, metadatas = state["context_docs"], state["metadatas"]
+        if context_docs:
+            # 合并同页重叠片段、去重并控制上下文长度，缩短本地模型的 prefill 时间
+            with trace_stage("context_packing", chunks=len(context_docs)):
+                context_docs, metadatas = pack_context(context_docs, metadatas,
+                                                       token_budget=self.context_token_budget,
+                                                       dedup_threshold=self.context_dedup_threshold)
+        return {
+            "question": new_human_message,
+            "context": self._format_context(context_docs, metadatas)
+        }
+
+    def _select_vehicle_chain(self, state: Dict) -> Any:
+        """
+        根据本地上下文的置信度选择回答链，并把选择结果记入 state["answer_mode"]：
+        置信度足够时使用单次调用的直答链（"direct"），否则使用可调用工具的 Agent（"agent"）。
+        """
+        strategy = state["retrieval_strategy"] or {}
+        confident = False
+        if self.direct_answer_threshold is not None and state["context_docs"]:
+            if strategy.get("strategy") in ("fault_code_index", "skip_rerank"):
+                confident = True
+            elif strategy.get("top_score") is not None:
+                confident = strategy["top_score"] >= self.direct_answer_threshold
+        state["answer_mode"] = "direct" if confident else "agent"
+        print(f"回答方式: {'单次调用直答' if confident else 'Agent（可调用工具）'}")
+        return self.direct_rag_chain if confident else self.local_llm_chain
+
+    @staticmethod
+    def _chain_output(response: Any) -> str:
+        # Agent 返回 {"output": ...}，直答链返回字符串
+        if isinstance(response, dict):
+            return response.get("output", "无法获取回答。")
+        return response or "无法获取回答。"
+
+    @staticmethod
+    def _build_result(state: Dict, full_response: str, sources: List[str]) -> Dict[str, Any]:
+        return {
+            "question": state["original_question"],  # 返回原始问题，未结合图片描述
+            "answer": full_response,
+            "context": state["context_docs"],
+            "sources": list(set(sources)),  # 确保来源唯一
+            "retrieval": state["retrieval_strategy"],  # 本次检索采用的策略，None 表示未检索
+            "answer_mode": state.get("answer_mode")  # direct / agent，通用问题为 None
+        }
+
+    def _replay_cached_answer(self, state: Dict, session_id: str) -> Dict[str, Any]:
+        """
+        复用语义答案缓存中的回答，并把这一轮对话补记到会话历史中。
+        """
+        history = self._get_session_history(session_id)
+        history.add_user_message(state["question"])
+        history.add_ai_message(state["cached_result"]["answer"])
+        return {**state["cached_result"], "question": state["original_question"],
+                "retrieval": state["retrieval_strategy"]}
+
+    def _remember_answer(self, state: Dict, result: Dict[str, Any]) -> None:
+        """
+        把车辆问题的回答写入语义答案缓存（只缓存有上下文依据的回答）。
+        """
+        if state["cacheable"] and state["intent"] == "vehicle" and state["context_ids"]:
+            self.answer_cache.put(embed_text(state["question"]), state["context_ids"], state["intent"], result,
+                                  state["cache_scope"])
+
+    def warm_up_answer_cache(self, questions: List[str], n_results: int = 3) -> None:
+        """
+        预先回答一组常见问题（如侧边栏示例问题），把答案写入语义答案缓存。
+
+        每个问题使用独立的临时会话，完成后丢弃其历史。n_results 需与线上调用保持一致，
+        否则上下文片段ID不同，缓存不会被命中。
+        """
+        if not self.answer_cache:
+            return
+        print(f"正在预热语义答案缓存（{len(questions)} 个问题）...")
+        try:
+            embed_texts(questions)  # 一次批量嵌入所有问题，之后逐个回答时查询向量直接命中缓存
+        except Exception as e:
+            print(f"批量嵌入预热问题失败：{e}")
+        for i, question in enumerate(questions):
+            session_id = f"__warmup_{i}__"
+            try:
+                self.rag_chat(question, session_id=session_id, n_results=n_results)
+            except Exception as e:
+                print(f"预热问题失败：{question}：{e}")
+            finally:
+                self.history_store.delete(session_id)
+        print(f"语义答案缓存预热完成：{self.answer_cache.stats()}")
+
+    @staticmethod
+    def _trace_callbacks() -> List[BaseCallbackHandler]:
+        trace = current_trace()
+        return [TraceCallbackHandler(trace)] if trace is not None else []
+
+    def _finish_trace(self, result: Dict[str, Any], trace: Trace) -> Dict[str, Any]:
+        """
+        结束本次请求的追踪，计入延迟统计，并把追踪记录附加到结果字典。
+        """
+        self.latency.observe(trace)
+        return {**result, "trace": trace.to_dict()}
+
+    def rag_chat(self, question: str, session_id: str, n_results: int = 3, image_bytes: bytes = None,
+                 vehicle: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        完整的RAG聊天流程，集成了重排机制以提高上下文精度。
+        支持多模态的输入，并根据意图分发到不同的大模型。
+        故障码查询命中索引时直接检索对应片段，跳过意图识别与重排。
+        vehicle 为会话所选的车型（{"vehicle_model": ..., "model_year": ...}，见 embed.list_vehicles），
+        提供时只检索该车型的手册及通用资料。
+        返回的字典中 "trace" 字段记录了本次请求各阶段的耗时、token 数与缓存命中情况。
+        """
+        trace = Trace("rag_chat")
+        with trace.activate():
+            result = self._rag_chat(question, session_id, n_results, image_bytes, vehicle_filter(**(vehicle or {})))
+        return self._finish_trace(result, trace)
 
-            human_message_content = [{"type": "text", "text": question}]
-            new_human_message = HumanMessage(content=human_message_content)
+    def _rag_chat(self, question: str, session_id: str, n_results: int, image_bytes: bytes,
+                  where: Optional[Dict] = None) -> Dict[str, Any]:
+        state = _run_to_completion(self._run_steps(
+            self._prepare_turn(question, n_results, image_bytes, where, session_id)))
+        if state["cached_result"]:
+            return self._replay_cached_answer(state, session_id)
+        sources = []
 
-            inputs = {
-                "question": new_human_message,
-                "context": formatted_context
-            }
+        if state["intent"] == "vehicle":
+            print("意图为车辆问题，使用本地大模型(通过One API)进行RAG...")
             # 调用本地大模型链 (通过One API)
-            response = self.local_llm_chain.invoke(inputs, config={"configurable": {"session_id": session_id}})
-            full_response = response.get("output", "无法获取回答。")
-            sources = ["来源: 本地知识库"] if final_context_docs else []
+            chain = self._select_vehicle_chain(state)
+            inputs = self._local_chain_inputs(state)
+            with trace_stage("answer", mode=state["answer_mode"]):
+                response = chain.invoke(inputs, config={"configurable": {"session_id": session_id},
+                                                        "callbacks": self._trace_callbacks()})
+            full_response = self._chain_output(response)
+            sources = ["来源: 本地知识库"] if state["context_docs"] else []
+            result = self._build_result(state, full_response, sources)
+            self._remember_answer(state, result)
+            return result
 
         else:  # intent == "general"
             print("意图为通用问题，使用在线大模型(通过One API)进行回答...")
             try:
                 # 直接调用在线大模型 (通过One API)
-                response_online = self.online_llm_via_oneapi.invoke(question)
+                with trace_stage("answer", mode="online"):
+                    response_online = self.online_llm_via_oneapi.invoke(
+                        state["question"], config={"callbacks": self._trace_callbacks()})
                 full_response = response_online.content
                 sources = ["来源: 在线知识"]
             except Exception as e:
                 print(f"调用在线大模型失败: {e}")
                 full_response = "抱歉，在线服务暂时无法响应您的通用问题。"
 
-        return {
-            "question": original_question,  # 返回原始问题，未结合图片描述
-            "answer": full_response,
-            "context": final_context_docs,
-            "sources": list(set(sources))  # 确保来源唯一
-        }
+        return self._build_result(state, full_response, sources)
+
+    def rag_chat_stream(self, question: str, session_id: str, n_results: int = 3,
+                        image_bytes: bytes = None,
+                        vehicle: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        rag_chat 的流式版本，按发生顺序产出事件字典：
+            {"type": "status", "message": ...}  阶段进展（图片描述、意图、检索完成、工具调用等）
+            {"type": "token", "content": ...}   回答的增量文本（不含 qwen3 的 <think> 推理内容）
+            {"type": "reset"}                   之前流出的内容来自决定调用工具的模型调用，应清空后继续接收 token
+            {"type": "final", "data": ...}      与 rag_chat 返回值相同的完整结果（含 "trace"），总是最后一个事件
+        """
+        trace = Trace("rag_chat_stream")
+        with trace.activate():
+            for event in self._rag_chat_stream(question, session_id, n_results, image_bytes,
+                                               vehicle_filter(**(vehicle or {}))):
+                if event["type"] == "final":
+                    event = {"type": "final", "data": self._finish_trace(event["data"], trace)}
+                yield event
+
+    def _rag_chat_stream(self, question: str, session_id: str, n_results: int,
+                         image_bytes: bytes, where: Optional[Dict] = None) -> Iterator[Dict[str, Any]]:
+        state = yield from self._run_steps(
+            self._prepare_turn(question, n_results, image_bytes, where, session_id))
+        if state["cached_result"]:
+            result = self._replay_cached_answer(state, session_id)
+            yield {"type": "status", "message": "命中语义答案缓存"}
+            yield {"type": "token", "content": result["answer"]}
+            yield {"type": "final", "data": result}
+            return
+        sources = []
+
+        if state["intent"] == "vehicle":
+            print("意图为车辆问题，使用本地大模型(通过One API)进行流式RAG...")
+            events: "queue.Queue" = queue.Queue()
+            chain = self._select_vehicle_chain(state)
+            inputs = self._local_chain_inputs(state)
+            config = {"configurable": {"session_id": session_id},
+                      "callbacks": [_StreamingEventHandler(events)] + self._trace_callbacks()}
+
+            def run_agent():
+                try:
+                    with trace_stage("answer", mode=state["answer_mode"]):
+                        response = chain.invoke(inputs, config=config)
+                    events.put({"type": "done", "response": response})
+                except Exception as e:
+                    events.put({"type": "error", "error": e})
+
+            # 回答链在后台线程中执行（继承当前追踪），token 与工具事件经回调写入队列
+            threading.Thread(target=contextvars.copy_context().run, args=(run_agent,), daemon=True).start()
+            while True:
+                event = events.get()
+                if event["type"] == "done":
+                    full_response = self._chain_output(event["response"])
+                    break
+                if event["type"] == "error":
+                    raise event["error"]
+                yield event
+            sources = ["来源: 本地知识库"] if state["context_docs"] else []
+            result = self._build_result(state, full_response, sources)
+            self._remember_answer(state, result)
+            yield {"type": "final", "data": result}
+            return
+
+        else:  # intent == "general"
+            print("意图为通用问题，使用在线大模型(通过One API)进行流式回答...")
+            parts = []
+            try:
+                with trace_stage("answer", mode="online"):
+                    for chunk in self.online_llm_via_oneapi.stream(state["question"],
+                                                                   config={"callbacks": self._trace_callbacks()}):
+                        if chunk.content:
+                            parts.append(chunk.content)
+                            yield {"type": "token", "content": chunk.content}
+                full_response = "".join(parts)
+                sources = ["来源: 在线知识"]
+            except Exception as e:
+                print(f"调用在线大模型失败: {e}")
+                full_response = "抱歉，在线服务暂时无法响应您的通用问题。"
+
+        yield {"type": "final", "data": self._build_result(state, full_response, sources)}
+
+    # --- 异步接口 ---
+    async def _aresource(self, name: str) -> Any:
+        """
+        异步路径中取得按需创建的组件：尚未创建时在线程中创建（导入模块、构建模型与链），不阻塞事件循环。
+        """
+        resource = self._resources.get(name)
+        if resource is None:
+            resource = await asyncio.to_thread(getattr, self, name)
+        return resource
+
+    def _semaphore(self, backend: str) -> asyncio.Semaphore:
+        """
+        获取某个后端的并发信号量。信号量与事件循环绑定，事件循环变化时重新创建。
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.backend_concurrency.items()}
+            self._semaphore_loop = loop
+        return self._semaphores[backend]
+
+    async def _adetermine_intent(self, question: str) -> str:
+        """
+        _determine_intent 的异步版本。
+        """
+        print(f"正在判断用户意图：{question}")
+        if self.intent_classifier:
+            # 先异步取得（并缓存）问题向量，本地分类器不会再发起阻塞的嵌入请求
+            try:
+                query_embedding = await aembed_text(question)
+            except Exception as e:
+                print(f"问题嵌入失败: {e}")
+                query_embedding = None
+            # 首次分类需要嵌入示例问题，嵌入失败时还会同步嵌入问题本身，因此放到线程中执行
+            intent = await asyncio.to_thread(self._classify_intent_locally, question, query_embedding)
+            if intent:
+                return intent
+        try:
+            intent_chain = self.intent_prompt_template | await self._aresource("intent_llm")
+            async with self._semaphore("intent"):
+                response = await intent_chain.ainvoke({"question": question})
+            return self._parse_intent_response(response.content)
+        except Exception as e:
+            print(f"意图识别失败，默认为通用问题: {e}")
+            return "general"  # 失败时默认使用通用模型
+
+    async def _arun_steps(self, steps: Generator) -> Any:
+        """
+        异步驱动步骤生成器（见 _run_steps）：等待操作的异步版本 self._a<op>；
+        没有异步版本的操作（索引查询、SQLite、嵌入缓存等阻塞调用）在线程中执行（继承当前追踪），
+        不阻塞事件循环。状态事件被丢弃。
+        """
+        result = None
+        while True:
+            try:
+                event = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = None
+            if event["type"] != "call":
+                continue
+            async_op = getattr(self, f"_a{event['op']}", None)
+            if async_op is not None:
+                result = await async_op(*event["args"])
+            else:
+                result = await asyncio.to_thread(getattr(self, f"_{event['op']}"), *event["args"])
+
+    async def _aretrieve_and_rerank(self, question: str, n_results: int, where: Optional[Dict] = None):
+        return await self._arun_steps(self._retrieval_steps(question, n_results, where))
+
+    # --- 步骤生成器请求的异步操作（受各后端并发上限约束） ---
+    async def _adescribe_image(self, image_bytes: bytes) -> str:
+        multimodal_model = await self._aresource("multimodal_model")
+        async with self._semaphore("multimodal"):
+            return await multimodal_model.adescribe_image(image_bytes)
+
+    async def _aquery_candidates(self, question: str, n_results: int, where: Optional[Dict] = None) -> dict:
+        async with self._semaphore("retrieval"):
+            return await aquery_db(question, n_results=n_results, where=where)
+
+    async def _arerank_candidates(self, question: str, retrieved_results: dict, n_results: int,
+                                  plan: Dict[str, Any]):
+        async with self._semaphore("rerank"):
+            return await asyncio.to_thread(self._rerank_candidates, question, retrieved_results, n_results, plan)
+
+    async def _astart_retrieval(self, question: str, n_results: int, where: Optional[Dict] = None) -> asyncio.Task:
+        # 异步路径中检索总是与意图识别并发进行
+        return asyncio.create_task(self._aretrieve_and_rerank(question, n_results, where))
+
+    @staticmethod
+    async def _acancel_retrieval(pending_retrieval: asyncio.Task) -> None:
+        pending_retrieval.cancel()
+        # 等待任务真正结束，避免线程池中的重排与未取回的异常残留；被丢弃的检索出错也不影响本轮回答
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await pending_retrieval
+
+    @staticmethod
+    async def _acollect_retrieval(pending_retrieval: asyncio.Task, question: str, n_results: int,
+                                  where: Optional[Dict] = None):
+        return await pending_retrieval
+
+    async def arag_chat(self, question: str, session_id: str, n_results: int = 3,
+                        image_bytes: bytes = None, vehicle: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        rag_chat 的异步版本，便于单个进程同时服务多个会话。
+
+        模型调用使用 ainvoke，Chroma 查询与 CrossEncoder 重排在线程池中执行，
+        每个后端的并发数由 backend_concurrency 限制。检索总是与意图识别并发进行，
+        路由到在线模型时取消检索任务。
+        """
+        trace = Trace("arag_chat")
+        with trace.activate():
+            result = await self._arag_chat(question, session_id, n_results, image_bytes,
+                                           vehicle_filter(**(vehicle or {})))
+        return self._finish_trace(result, trace)
+
+    async def _arag_chat(self, question: str, session_id: str, n_results: int, image_bytes: bytes,
+                         where: Optional[Dict] = None) -> Dict[str, Any]:
+        state = await self._arun_steps(self._prepare_turn(question, n_results, image_bytes, where, session_id))
+        if state["cached_result"]:
+            # 补记会话历史会写 SQLite，放到线程中执行
+            return await asyncio.to_thread(self._replay_cached_answer, state, session_id)
+        sources = []
+
+        if state["intent"] == "vehicle":
+            print("意图为车辆问题，使用本地大模型(通过One API)进行RAG...")
+            # 回答链在首次使用时构建（导入 LangChain 组件并创建 Agent），放到线程中执行
+            chain = await asyncio.to_thread(self._select_vehicle_chain, state)
+            inputs = self._local_chain_inputs(state)
+            async with self._semaphore("local_llm"):
+                with trace_stage("answer", mode=state["answer_mode"]):
+                    response = await chain.ainvoke(inputs, config={"configurable": {"session_id": session_id},
+                                                                   "callbacks": self._trace_callbacks()})
+            full_response = self._chain_output(response)
+            sources = ["来源: 本地知识库"] if state["context_docs"] else []
+            result = self._build_result(state, full_response, sources)
+            await asyncio.to_thread(self._remember_answer, state, result)
+            return result
+
+        else:  # intent == "general"
+            print("意图为通用问题，使用在线大模型(通过One API)进行回答...")
+            try:
+                online_llm = await self._aresource("online_llm_via_oneapi")
+                async with self._semaphore("online_llm"):
+                    with trace_stage("answer", mode="online"):
+                        response_online = await online_llm.ainvoke(
+                            state["question"], config={"callbacks": self._trace_callbacks()})
+                full_response = response_online.content
+                sources = ["来源: 在线知识"]
+            except Exception as e:
+                print(f"调用在线大模型失败: {e}")
+                full_response = "抱歉，在线服务暂时无法响应您的通用问题。"
+
+        return self._build_result(state, full_response, sources)
 
 
 def main():
@@ -1,42 +1,155 @@
 import os
-from typing import List
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from langchain_community.document_loaders import PyMuPDFLoader, UnstructuredMarkdownLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 
-# 获取pdf文件内容
-def get_pdf_text():
-    folder_path = "/home/yu/zjh/my_app/data"
-    # 获取folder_path下所有⽂件路径，储存在file_paths⾥
+from config import get_setting
+
+# 知识库文档目录，可通过配置项 DATA_FOLDER 修改。按车型分目录存放：data/<车型>/<年款>/手册.pdf，
+# 年款一级可省略；直接放在 data/ 下的文档视为通用资料，对所有车型生效
+DATA_FOLDER = get_setting("DATA_FOLDER", "./data")
+
+MODEL_YEAR_PATTERN = re.compile(r"^(19|20)\d{2}$")
+
+# OBD-II 风格的故障码：P/B/C/U + 4 位（首位 0-3，其余为十六进制），例如 P0420、U0100、B1A2F
+FAULT_CODE_PATTERN = re.compile(r"(?<![A-Za-z0-9])([PBCU][0-3][0-9A-F]{3})(?![A-Za-z0-9])", re.IGNORECASE)
+
+
+# 获取数据目录下所有文件路径
+def get_file_paths(folder_path: str = DATA_FOLDER) -> List[str]:
+    # 获取folder_path下所有⽂件路径，储存在file_paths⾥（排序保证每次遍历顺序一致）
     file_paths = []
     for root, dirs, files in os.walk(folder_path):
-        for file in files:
+        dirs.sort()
+        for file in sorted(files):
             file_path = os.path.join(root, file)
             file_paths.append(file_path)
-    print(file_paths[:3])
-    # 遍历⽂件路径并把实例化的loader存放在loaders⾥
-    loaders = []
-    for file_path in file_paths:
-        file_type = file_path.split('.')[-1]
-        if file_type == 'pdf':
-            loaders.append(PyMuPDFLoader(file_path))
-        elif file_type == 'md':
-            loaders.append(UnstructuredMarkdownLoader(file_path))
-        elif file_type == 'txt':
-            loaders.append(TextLoader(file_path, encoding='utf-8'))
+    return file_paths
+
+
+# 根据文件在数据目录中的位置推断车型与年款，无法推断的字段为空字符串（通用资料）
+def infer_vehicle(file_path: str, folder_path: str = DATA_FOLDER) -> Dict[str, str]:
+    parts = os.path.relpath(file_path, folder_path).split(os.sep)[:-1]
+    vehicle = {"vehicle_model": "", "model_year": ""}
+    if parts and parts[0] not in (".", ".."):
+        vehicle["vehicle_model"] = parts[0]
+        vehicle["model_year"] = next((part for part in parts[1:] if MODEL_YEAR_PATTERN.match(part)), "")
+    return vehicle
 
+
+# 根据文件类型实例化loader，不支持的类型返回None
+# （文档加载器按需导入：查询路径只用到故障码提取，不必在启动时加载整套 loader）
+def get_loader(file_path: str):
+    from langchain_community.document_loaders import PyMuPDFLoader, UnstructuredMarkdownLoader, TextLoader
+
+    file_type = file_path.split('.')[-1]
+    if file_type == 'pdf':
+        return PyMuPDFLoader(file_path)
+    elif file_type == 'md':
+        return UnstructuredMarkdownLoader(file_path)
+    elif file_type == 'txt':
+        return TextLoader(file_path, encoding='utf-8')
+    return None
+
+
+# 加载单个文件
+def load_file(file_path: str) -> List[Document]:
+    return list(iter_file_documents(file_path))
+
+
+# 惰性加载单个文件，PDF 按页逐个产出，避免一次性把整本手册读入内存
+def iter_file_documents(file_path: str) -> Iterator[Document]:
+    loader = get_loader(file_path)
+    if loader is None:
+        return
+    yield from loader.lazy_load()
+
+
+# 获取pdf文件内容
+def get_pdf_text(folder_path: str = DATA_FOLDER):
+    file_paths = get_file_paths(folder_path)
+    print(file_paths[:3])
     texts = []
-    for loader in loaders:
-        texts.extend(loader.load())
+    for file_path in file_paths:
+        texts.extend(load_file(file_path))
     return texts
 
 
 # 拆分文本
-def get_text_chunks():
-    docs = get_pdf_text()
+def split_documents(docs: List[Document]) -> List[Document]:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1024, chunk_overlap=100)
-    chunks = text_splitter.split_documents(docs)
-    return chunks
+    return text_splitter.split_documents(docs)
+
+
+# 逐页加载并拆分单个文件，内存占用只与单页大小有关
+def iter_split_file(file_path: str) -> Iterator[Document]:
+    for doc in iter_file_documents(file_path):
+        yield from split_documents([doc])
+
+
+# 加载并拆分单个文件（定义在模块顶层，便于进程池序列化）
+def load_and_split_file(file_path: str) -> List[Document]:
+    return list(iter_split_file(file_path))
+
+
+def iter_file_chunks(file_paths: List[str], workers: Optional[int] = 1) -> Iterator[Tuple[str, Iterable[Document]]]:
+    """
+    按输入顺序逐个产出 (文件路径, 片段序列)。
+
+    workers 为 1 时在当前进程串行处理，片段序列是逐页惰性生成的；大于 1 时使用进程池在多个CPU核心上
+    并行解析与拆分，为 None 或 0 时使用全部CPU核心。结果按提交顺序取回，因此片段顺序及其元数据
+    （source、page）与串行模式完全一致。
+
+    并行时每个文件的片段整体返回，同一时刻最多有 workers * 2 个文件在解析或等待取回，
+    内存占用与这些文件的片段总量成正比（而不是整个目录）。
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(file_paths))
+    if workers <= 1:
+        for file_path in file_paths:
+            yield file_path, iter_split_file(file_path)
+        return
+
+    print(f"使用 {workers} 个进程并行解析 {len(file_paths)} 个文件...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # executor.map 会一次提交全部文件并缓存其结果，这里只保持有限个任务在途
+        pending = deque()
+        remaining = iter(file_paths)
+        for file_path in islice(remaining, workers * 2):
+            pending.append((file_path, executor.submit(load_and_split_file, file_path)))
+        while pending:
+            file_path, future = pending.popleft()
+            chunks = future.result()
+            for next_path in islice(remaining, 1):
+                pending.append((next_path, executor.submit(load_and_split_file, next_path)))
+            yield file_path, chunks
+
+
+# 提取文本中出现的故障码（统一为大写，按首次出现顺序去重）
+def extract_fault_codes(text: str) -> List[str]:
+    codes = []
+    for match in FAULT_CODE_PATTERN.finditer(text):
+        code = match.group(1).upper()
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+# 以生成器形式逐个产出整个数据目录的片段
+def iter_text_chunks(folder_path: str = DATA_FOLDER, workers: Optional[int] = 1) -> Iterator[Document]:
+    for _, file_chunks in iter_file_chunks(get_file_paths(folder_path), workers):
+        yield from file_chunks
+
+
+def get_text_chunks(folder_path: str = DATA_FOLDER, workers: Optional[int] = 1):
+    return list(iter_text_chunks(folder_path, workers))
 
 if __name__ == "__main__":
     data = get_pdf_text()
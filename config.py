@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+KEYS_FILE = "Keys.json"
+
+_settings: Optional[Dict[str, Any]] = None
+_settings_lock = threading.Lock()
+
+
+def _load_settings() -> Dict[str, Any]:
+    """
+    读取一次 Keys.json 并缓存。文件不存在或无法解析时视为空配置。
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                settings = {}
+                if os.path.exists(KEYS_FILE):
+                    try:
+                        with open(KEYS_FILE, "r") as file:
+                            settings = json.load(file)
+                    except (OSError, ValueError) as e:
+                        print(f"读取 {KEYS_FILE} 失败：{e}")
+                _settings = settings
+    return _settings
+
+
+def get_setting(name: str, default: Any = None) -> Any:
+    """
+    获取配置项：环境变量优先，其次是 Keys.json，都没有时返回 default。
+
+    与 load_key 不同，这里从不交互式提示输入，可以在服务进程和后台线程中安全调用。
+    """
+    value = os.environ.get(name)
+    if value:
+        return value
+    value = _load_settings().get(name)
+    return value if value else default
+
+
+def require_setting(name: str) -> Any:
+    """
+    获取必需的配置项，缺失时抛出 RuntimeError（提示通过环境变量或 `python load_key.py` 配置）。
+    """
+    value = get_setting(name)
+    if value is None:
+        raise RuntimeError(f"缺少配置项 {name}：请设置同名环境变量，或运行 `python load_key.py` 写入 {KEYS_FILE}。")
+    return value
+
+
+def reload_settings() -> None:
+    """
+    丢弃已缓存的 Keys.json 内容，下次访问时重新读取。
+    """
+    global _settings
+    with _settings_lock:
+        _settings = None
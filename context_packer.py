@@ -0,0 +1,135 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的 token 数：每个中日韩字符（含全角标点）按 1 个 token 计，其余字符按 4 个字符 1 个 token 计。
+    对 qwen 系列分词器而言偏保守，足以用于控制上下文预算。
+    """
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    text = re.sub(r"\s+", "", text)
+    return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+
+def _similarity(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _overlap_length(left: str, right: str, min_overlap: int, max_overlap: int) -> int:
+    """
+    返回 left 的结尾与 right 的开头重合的字符数（切分时 chunk_overlap 产生的重叠），不重合返回 0。
+    """
+    if len(left) < min_overlap or len(right) < min_overlap:
+        return 0
+    head = right[:min_overlap]
+    start = max(0, len(left) - max_overlap)
+    idx = left.find(head, start)
+    while idx != -1:
+        if right.startswith(left[idx:]):
+            return len(left) - idx
+        idx = left.find(head, idx + 1)
+    return 0
+
+
+def _merge_text(existing: str, new: str, min_overlap: int, max_overlap: int) -> str:
+    """
+    把同一页的另一个片段并入已有文本：首尾重叠时去掉重复部分拼接，否则换行拼接。
+    """
+    overlap = _overlap_length(existing, new, min_overlap, max_overlap)
+    if overlap:
+        return existing + new[overlap:]
+    overlap = _overlap_length(new, existing, min_overlap, max_overlap)
+    if overlap:
+        return new + existing[overlap:]
+    return existing + "\n" + new
+
+
+def _truncate_to_budget(text: str, budget: int) -> str:
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def pack_context(docs: List[str],
+                 metadatas: List[Dict],
+                 token_budget: Optional[int] = 2048,
+                 dedup_threshold: float = 0.9,
+                 min_overlap: int = 20,
+                 max_overlap: int = 200,
+                 min_truncated_tokens: int = 128) -> Tuple[List[str], List[Dict]]:
+    """
+    在重排之后、构建提示词之前整理上下文片段，减少发给模型的重复文本。
+
+    docs 须已按重排得分从高到低排列。处理步骤：
+        1. 同一来源同一页码的片段合并为一段（去掉切分时 chunk_overlap 产生的重叠部分），
+           合并后的段落排在其中得分最高的片段的位置，因此 [来源: 页码 X] 的引用保持准确；
+        2. 与已选片段高度相似（字符 3-gram Jaccard 相似度不低于 dedup_threshold）或被其完整包含的片段视为重复并丢弃；
+        3. 按得分顺序填充 token 预算，放不下的片段跳过；得分最高的一段超出预算时截断保留。
+
+    参数：
+        docs: 上下文片段文本。
+        metadatas: 与 docs 对应的元数据，使用其中的 source 与 page。
+        token_budget: 上下文的 token 预算（按 estimate_tokens 估计），None 表示不限制。
+        dedup_threshold: 判定为近似重复的最小相似度。
+        min_overlap / max_overlap: 识别首尾重叠时要求的最小重叠长度与查找范围（字符）。
+        min_truncated_tokens: 剩余预算不少于该值时，放不下的片段截断后保留。
+
+    返回：
+        整理后的 (docs, metadatas)。
+    """
+    blocks = []  # {"key", "text", "metadata", "shingles"}
+    by_page = {}
+    duplicates = 0
+    for doc, metadata in zip(docs, metadatas):
+        metadata = metadata or {}
+        if not doc or not doc.strip():
+            continue
+        key = (metadata.get("source"), metadata.get("page"))
+        shingles = _shingles(doc)
+        if any(doc in block["text"] or _similarity(shingles, block["shingles"]) >= dedup_threshold
+               for block in blocks):
+            duplicates += 1
+            continue
+        if key in by_page:
+            block = by_page[key]
+            block["text"] = _merge_text(block["text"], doc, min_overlap, max_overlap)
+            block["shingles"] |= shingles
+        else:
+            block = {"text": doc, "metadata": metadata, "shingles": shingles}
+            by_page[key] = block
+            blocks.append(block)
+
+    packed_docs, packed_metadatas = [], []
+    used = 0
+    for block in blocks:
+        tokens = estimate_tokens(block["text"])
+        text = block["text"]
+        if token_budget is not None and used + tokens > token_budget:
+            remaining = token_budget - used
+            if packed_docs and remaining < min_truncated_tokens:
+                continue
+            text = _truncate_to_budget(text, remaining)
+            if not text:
+                continue
+            tokens = estimate_tokens(text)
+        packed_docs.append(text)
+        packed_metadatas.append(block["metadata"])
+        used += tokens
+
+    print(f"上下文整理：{len(docs)} 个片段 -> {len(packed_docs)} 段（去重 {duplicates} 个），"
+          f"约 {used} tokens")
+    return packed_docs, packed_metadatas
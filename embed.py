@@ -1,14 +1,105 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import chromadb
-from langchain_ollama import OllamaEmbeddings
+from langchain_core.documents import Document
 
-from chunk import get_text_chunks
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from cache import LRUCache
+from chunk import DATA_FOLDER, get_file_paths, infer_vehicle, iter_file_chunks
+from config import get_setting
+from embedding_client import OllamaEmbeddingClient
+from fault_code_index import FaultCodeIndex
+from icon_index import IconIndex
+from tracing import record_cache, trace_stage
+from vector_store import create_vector_store, matches_where
+
+EMBEDDING_MODEL = "nomic-embed-text:latest"
+MANIFEST_PATH = "./chroma_db/ingest_manifest.json"
+MANIFEST_VERSION = 2  # 2：片段元数据带有车型与年款
+FAULT_CODE_INDEX_PATH = "./chroma_db/fault_code_index.json"
+ICON_INDEX_PATH = "./chroma_db/icon_index.json"
+BM25_INDEX_PATH = "./chroma_db/bm25_index.json"
+CHROMA_PATH = "./chroma_db"
+COLLECTION_NAME = "my_collection"
+NUMPY_STORE_PATH = "./vector_store"
+
+# 嵌入客户端、向量存储与各索引都在首次使用时才创建，import embed 不会连接数据库或读取索引文件
+_resources: Dict[str, Any] = {}
+_resource_lock = threading.RLock()
+
+
+def _get_resource(name: str, factory: Callable[[], Any]) -> Any:
+    resource = _resources.get(name)
+    if resource is None:
+        with _resource_lock:
+            resource = _resources.get(name)
+            if resource is None:
+                resource = _resources[name] = factory()
+    return resource
+
+
+def get_embedding_client() -> OllamaEmbeddingClient:
+    # 共享长连接池的嵌入客户端：每个请求最多 16 条文本，最多 4 个请求同时在途
+    return _get_resource("embedding", lambda: OllamaEmbeddingClient(
+        model=EMBEDDING_MODEL, base_url=get_setting("OLLAMA_BASE_URL", "http://localhost:11434"),
+        batch_size=16, max_concurrency=4))
+
+
+def get_vector_store_backend() -> str:
+    """
+    当前使用的向量存储后端，由配置项 VECTOR_STORE_BACKEND 指定："chroma"（默认）、"numpy" 或 "numpy-int8"。
+    """
+    return get_setting("VECTOR_STORE_BACKEND", "chroma")
+
+
+def get_vector_store():
+    def create():
+        backend = get_vector_store_backend()
+        if backend == "chroma":
+            return create_vector_store(backend, CHROMA_PATH, collection_name=COLLECTION_NAME)
+        return create_vector_store(backend, NUMPY_STORE_PATH)
+    return _get_resource("vector_store", create)
+
+
+def get_fault_code_index() -> FaultCodeIndex:
+    return _get_resource("fault_code_index", lambda: FaultCodeIndex.load(FAULT_CODE_INDEX_PATH))
+
+
+def get_icon_index() -> IconIndex:
+    return _get_resource("icon_index", lambda: IconIndex.load(ICON_INDEX_PATH))
+
+
+def get_bm25_index() -> BM25Index:
+    return _get_resource("bm25_index", lambda: BM25Index.load(BM25_INDEX_PATH))
+
+
+def get_query_embedding_cache() -> LRUCache:
+    # 查询向量缓存：内存 LRU + 磁盘层，重复的问题（示例问题、故障码查询）无需再请求 Ollama
+    return _get_resource("query_embedding_cache", lambda: LRUCache(
+        maxsize=2048, ttl=7 * 24 * 3600, persist_path="./cache/query_embeddings.sqlite", name="query_embedding"))
+
+
+def normalize_query(text: str) -> str:
+    """
+    规范化查询文本：全角/半角统一、去除首尾空白、合并连续空白并转为小写。
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _query_cache_key(text: str) -> str:
+    return f"{EMBEDDING_MODEL}\x00{normalize_query(text)}"
 
-embedding = OllamaEmbeddings(model="nomic-embed-text:latest", base_url="http://localhost:11434")
 
 def embed_text(text: str) -> list:
     """
-    使用Ollama模型嵌入文本。
+    使用Ollama模型嵌入文本，结果按（嵌入模型, 规范化文本）缓存。
 
     Args:
         text (str): 要嵌入的文本。
@@ -16,52 +107,575 @@ def embed_text(text: str) -> list:
     Returns:
         list: 嵌入后的文本向量。
     """
-    return embedding.embed_query(text)
+    key, cache = _query_cache_key(text), get_query_embedding_cache()
+    vector = cache.get(key)
+    record_cache("query_embedding", vector is not None)
+    if vector is None:
+        with trace_stage("query_embedding"):
+            vector = get_embedding_client().embed_query(text)
+        cache.set(key, vector)
+    return vector
+
+
+async def aembed_text(text: str) -> list:
+    """
+    embed_text 的异步版本，与其共享同一个缓存。
+    """
+    key, cache = _query_cache_key(text), get_query_embedding_cache()
+    vector = cache.get(key)
+    record_cache("query_embedding", vector is not None)
+    if vector is None:
+        with trace_stage("query_embedding"):
+            vector = await get_embedding_client().aembed_query(text)
+        cache.set(key, vector)
+    return vector
+
+
+def _cached_vectors(texts: List[str]) -> Tuple[List[str], List[Optional[list]], List[int]]:
+    """
+    查询向量缓存，返回 (缓存键, 向量列表, 未命中的下标)。同一批中重复的文本只算一次未命中。
+    """
+    keys = [_query_cache_key(text) for text in texts]
+    cache = get_query_embedding_cache()
+    vectors = [cache.get(key) for key in keys]
+    missing, seen = [], set()
+    for i, (key, vector) in enumerate(zip(keys, vectors)):
+        if vector is None and key not in seen:
+            seen.add(key)
+            missing.append(i)
+    record_cache("query_embedding", True, len(texts) - sum(vector is None for vector in vectors))
+    record_cache("query_embedding", False, len(missing))
+    return keys, vectors, missing
+
+
+def _fill_vectors(keys: List[str], vectors: List[Optional[list]], missing: List[int],
+                  embedded: List[list]) -> List[list]:
+    computed, cache = {}, get_query_embedding_cache()
+    for i, vector in zip(missing, embedded):
+        computed[keys[i]] = vector
+        cache.set(keys[i], vector)
+    return [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+
+
+def embed_texts(texts: List[str]) -> List[list]:
+    """
+    批量嵌入多个查询文本，与 embed_text 共享缓存；未命中的文本一次性交给嵌入客户端，
+    由其按批并发请求 Ollama。返回的向量顺序与 texts 一致。
+    """
+    keys, vectors, missing = _cached_vectors(texts)
+    if missing:
+        with trace_stage("query_embedding", count=len(missing)):
+            embedded = get_embedding_client().embed_documents([texts[i] for i in missing])
+    else:
+        embedded = []
+    return _fill_vectors(keys, vectors, missing, embedded)
+
+
+async def aembed_texts(texts: List[str]) -> List[list]:
+    """
+    embed_texts 的异步版本。
+    """
+    keys, vectors, missing = _cached_vectors(texts)
+    if missing:
+        with trace_stage("query_embedding", count=len(missing)):
+            embedded = await get_embedding_client().aembed_documents([texts[i] for i in missing])
+    else:
+        embedded = []
+    return _fill_vectors(keys, vectors, missing, embedded)
+
+
+def file_sha256(file_path: str) -> str:
+    """
+    分块读取文件并计算其 SHA-256 摘要，用于判断文件内容是否发生变化。
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def chunk_id(source: str, content: str, occurrence: int = 0) -> str:
+    """
+    根据来源文件与片段内容生成稳定的片段ID。
+
+    同一文件中内容完全相同的片段通过 occurrence（出现序号）区分，
+    因此只要文件内容不变，重复入库得到的ID也完全一致。
+    """
+    key = f"{source}\x00{occurrence}\x00{content}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _manifest_path() -> str:
+    """
+    入库清单与向量存储放在一起，切换后端时各自独立地判断需要入库的文件。
+    """
+    if get_vector_store_backend() == "chroma":
+        return MANIFEST_PATH
+    return os.path.join(NUMPY_STORE_PATH, "ingest_manifest.json")
+
+
+def get_kb_version() -> str:
+    """
+    返回知识库版本标识（入库清单的修改时间）。每次入库写入数据都会改变它，
+    依赖知识库内容的缓存据此判断是否需要失效。
+    """
+    try:
+        return str(os.stat(_manifest_path()).st_mtime_ns)
+    except FileNotFoundError:
+        return "0"
+
+
+def load_manifest() -> Dict:
+    """
+    读取入库清单；不存在或模型/版本不一致时返回空清单。
+    """
+    manifest_path = _manifest_path()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION and manifest.get("embedding_model") == EMBEDDING_MODEL:
+            return manifest
+        print("入库清单版本或嵌入模型已变化，将重建数据库。")
+    return {"version": MANIFEST_VERSION, "embedding_model": EMBEDDING_MODEL, "files": {}}
+
+
+def save_manifest(manifest: Dict) -> None:
+    """
+    原子地写入入库清单，避免中途崩溃留下损坏的文件。
+    """
+    manifest_path = _manifest_path()
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _checkpoint(manifest: Dict, save_indexes: bool = False) -> None:
+    """
+    写入清单；save_indexes 为 True 时先写故障码、图标与 BM25 索引再写清单。
+
+    索引文件随语料增大，只在每个文件完成或删除了旧片段时整体写入，每批只写清单。
+    中途崩溃后，已写入数据库但未写入索引的片段会在断点续传时重新登记（索引按片段ID去重）。
+    """
+    if save_indexes:
+        get_fault_code_index().save()
+        get_icon_index().save()
+        get_bm25_index().save()
+    save_manifest(manifest)
+
+
+def _delete_chunks(ids: List[str]) -> None:
+    if ids:
+        get_vector_store().delete(ids)
+
+
+def _rebuild_fault_code_index() -> None:
+    """
+    根据数据库中已有的片段重建故障码索引（用于升级前已入库、尚无索引文件的数据库）。
+    """
+    print("正在根据已有片段重建故障码索引...")
+    index = get_fault_code_index()
+    index.clear()
+    existing = get_vector_store().get()
+    for cid, doc, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"]):
+        index.add_chunk(cid, doc, metadata or {})
+    index.save()
+    print(f"故障码索引重建完成，共 {len(index)} 个故障码。")
+
+
+def _rebuild_bm25_index() -> None:
+    """
+    根据数据库中已有的片段重建 BM25 索引（用于升级前已入库的数据库，或分词方式发生变化时）。
+    """
+    print("正在根据已有片段重建 BM25 索引...")
+    index = get_bm25_index()
+    index.clear()
+    existing = get_vector_store().get()
+    for cid, doc, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"]):
+        index.add_chunk(cid, doc, metadata or {})
+    index.save()
+    print(f"BM25 索引重建完成，共 {len(index)} 个片段。")
 
 
-chromadb_client = chromadb.PersistentClient("./chroma_db")
-chromadb_connection = chromadb_client.get_or_create_collection("my_collection")
-def create_db() -> None:
+def _index_icons(file_path: str) -> None:
     """
-    创建一个新的ChromaDB集合，并将嵌入的文本存储在其中。
+    重新提取 PDF 中的警告灯图标及其说明文字，登记到图标索引。
     """
-    if chromadb_connection.count() > 0:
-        print("数据库已存在，跳过创建。")
+    if not file_path.lower().endswith(".pdf"):
         return
-    document_chunks = get_text_chunks()
+    index = get_icon_index()
+    index.remove_source(file_path)
+    try:
+        added = index.add_pdf(file_path)
+    except Exception as e:
+        print(f"提取图标失败: {file_path}：{e}")
+        return
+    print(f"  已登记 {added} 个图标。")
 
-    ids = []
-    docs_to_embed = []
-    metadatas = []
 
-    for idx, chunk in enumerate(document_chunks):
-        ids.append(str(idx))
-        docs_to_embed.append(chunk.page_content)
-        metadatas.append(chunk.metadata)  # Get metadata from the Document object
+def _rebuild_icon_index(file_paths: Iterable[str]) -> None:
+    """
+    为已入库的 PDF 补建图标索引（用于升级前已入库、尚无索引文件的数据库）。
+    """
+    print("正在为已入库的文档提取图标...")
+    index = get_icon_index()
+    index.clear()
+    for path in file_paths:
+        _index_icons(path)
+    index.save()
+    print(f"图标索引重建完成，共 {len(index)} 个图标。")
+
+
+def _iter_batches(file_path: str, chunks: Iterable[Document], batch_size: int) -> Iterator[Tuple[List[str], List[Document]]]:
+    """
+    为片段分配稳定ID，并按 batch_size 分批产出 (ID列表, 片段列表)。
+    """
+    ids, batch = [], []
+    seen = {}
+    for chunk in chunks:
+        content = chunk.page_content
+        occurrence = seen.get(content, 0)
+        seen[content] = occurrence + 1
+        ids.append(chunk_id(file_path, content, occurrence))
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield ids, batch
+            ids, batch = [], []
+    if batch:
+        yield ids, batch
+
+
+def _ingest_file(file_path: str, chunks: Iterable[Document], entry: Dict, manifest: Dict,
+                 batch_size: int) -> None:
+    """
+    流式嵌入单个文件的片段：每凑满一批就嵌入并写入数据库，随后把该批ID记入清单。
+    每个片段的元数据都带上 entry["vehicle"] 中的车型与年款，供检索时按车型过滤。
+
+    entry["chunk_ids"] 中已有的片段（上次中途崩溃前已写入的批次）会被跳过，
+    因此重新运行时可以从断点继续，而不会重复嵌入；这些片段只重新登记到故障码与 BM25 索引，
+    补上崩溃前尚未写入索引文件的部分。
+    """
+    done = set(entry["chunk_ids"])
+    for ids, batch in _iter_batches(file_path, chunks, batch_size):
+        pending = []
+        for cid, chunk in zip(ids, batch):
+            if cid in done:
+                metadata = {**chunk.metadata, **entry["vehicle"]}
+                get_fault_code_index().add_chunk(cid, chunk.page_content, metadata)
+                get_bm25_index().add_chunk(cid, chunk.page_content, metadata)
+            else:
+                pending.append((cid, chunk))
+        if not pending:
+            continue
+
+        pending_ids = [cid for cid, _ in pending]
+        docs_to_embed = [chunk.page_content for _, chunk in pending]
+        metadatas = [{**chunk.metadata, **entry["vehicle"]} for _, chunk in pending]
+        embedded_vectors = get_embedding_client().embed_documents(docs_to_embed)
+
+        # upsert 保证重复执行时幂等
+        get_vector_store().upsert(
+            ids=pending_ids,
+            documents=docs_to_embed,
+            embeddings=embedded_vectors,
+            metadatas=metadatas
+        )
+        for cid, doc, metadata in zip(pending_ids, docs_to_embed, metadatas):
+            get_fault_code_index().add_chunk(cid, doc, metadata)
+            get_bm25_index().add_chunk(cid, doc, metadata)
+        entry["chunk_ids"].extend(pending_ids)
+        done.update(pending_ids)
+        _checkpoint(manifest)
+        print(f"  已写入 {len(entry['chunk_ids'])} 个片段...")
+
+
+def create_db(folder_path: str = DATA_FOLDER, workers: Optional[int] = 1, batch_size: int = 128) -> None:
+    """
+    增量、流式地创建/更新向量存储（ChromaDB 集合或 NumPy 向量矩阵，见 get_vector_store）。
+
+    通过入库清单记录每个文件的内容哈希与片段ID：只嵌入新增或内容发生变化的文件，
+    并删除已被移除或已变化文件的旧片段。片段按文件所在目录标记车型与年款（见 chunk.infer_vehicle）。
+    文档按页加载、拆分，再按批嵌入和写入，
+    串行时峰值内存只取决于 batch_size 而不是语料规模；workers 大于 1 时还要加上最多 workers * 2 个文件的
+    全部片段（见 chunk.iter_file_chunks）。每批写入后都会更新清单，每个文件完成后写入索引，
+    中途崩溃后重新运行会从未完成的文件断点处继续。
+
+    Args:
+        folder_path (str): 知识库文档目录。
+        workers (Optional[int]): 解析与拆分文档的进程数，1 为串行，None 为使用全部CPU核心。
+        batch_size (int): 每批嵌入并写入数据库的片段数量；一批会被嵌入客户端拆成多个请求并发发送。
+    """
+    manifest = load_manifest()
+    tracked = manifest["files"]
+
+    store = get_vector_store()
+    if not tracked and store.count() > 0:
+        # 旧版本按位置编号写入的数据无法追踪，清空后重新入库一次
+        print("检测到未被清单追踪的旧数据，清空后重新入库...")
+        _delete_chunks(store.all_ids())
+        get_fault_code_index().clear()
+        get_icon_index().clear()
+        get_bm25_index().clear()
+    elif tracked and not get_fault_code_index().exists():
+        _rebuild_fault_code_index()
+    if tracked and not get_bm25_index().exists():
+        _rebuild_bm25_index()
+    if tracked and not get_icon_index().exists():
+        _rebuild_icon_index([path for path, entry in tracked.items() if entry.get("complete", True)])
+
+    current = {path: file_sha256(path) for path in get_file_paths(folder_path)}
+
+    removed = [path for path in tracked if path not in current]
+    for path in removed:
+        _delete_chunks(tracked.pop(path)["chunk_ids"])
+        get_fault_code_index().remove_source(path)
+        get_icon_index().remove_source(path)
+        get_bm25_index().remove_source(path)
+        print(f"已删除移除文件的片段: {path}")
+
+    changed = [path for path, digest in current.items()
+               if path not in tracked
+               or tracked[path]["sha256"] != digest
+               or not tracked[path].get("complete", True)]
+    if not changed and not removed:
+        print("数据库已是最新，无需更新。")
+        return
+    if removed:
+        _checkpoint(manifest, save_indexes=True)
 
-    # Embed all documents at once
-    embedded_vectors = embedding.embed_documents(docs_to_embed)
+    for index, (path, chunks) in enumerate(iter_file_chunks(changed, workers), start=1):
+        old = tracked.get(path)
+        if old and old["sha256"] == current[path]:
+            print(f"[{index}/{len(changed)}] 从断点继续入库: {path}（已完成 {len(old['chunk_ids'])} 个片段）")
+            entry = old
+        else:
+            if old:
+                _delete_chunks(old["chunk_ids"])
+                get_fault_code_index().remove_source(path)
+                get_bm25_index().remove_source(path)
+            print(f"[{index}/{len(changed)}] 正在入库: {path}")
+            entry = {"sha256": current[path], "chunk_ids": [], "complete": False,
+                     "vehicle": infer_vehicle(path, folder_path)}
+            tracked[path] = entry
+            # 删除了旧片段时索引需要与清单一起写入，否则续传时不会再移除它们
+            _checkpoint(manifest, save_indexes=old is not None)
 
-    # Add to the database with metadata
-    chromadb_connection.add(
-        ids=ids,
-        documents=docs_to_embed,
-        embeddings=embedded_vectors,
-        metadatas=metadatas  # <-- This is the crucial addition
-    )
-    print("数据库创建成功，已存储嵌入向量。")
+        _ingest_file(path, chunks, entry, manifest, batch_size)
+        _index_icons(path)
+        entry["complete"] = True
+        _checkpoint(manifest, save_indexes=True)
+        print(f"[{index}/{len(changed)}] 已入库: {path}（{len(entry['chunk_ids'])} 个片段）")
 
-def query_db(query: str, n_results: int = 3) -> dict:
+    print(f"数据库更新完成：新增/更新 {len(changed)} 个文件，删除 {len(removed)} 个文件。")
+
+def query_db(query: str, n_results: int = 3, where: Optional[Dict] = None) -> dict:
     """
-    查询ChromaDB，并返回文档及其元数据。
+    查询向量存储，并返回文档及其元数据（与 Chroma 的查询结果结构相同）。
+    where 为 Chroma 风格的元数据过滤条件。
     """
     query_embed = embed_text(query)
-    results = chromadb_connection.query(
-        query_embeddings=[query_embed],
-        n_results=n_results
-    )
+    store = get_vector_store()
+    with trace_stage("vector_query", n_results=n_results, backend=store.name):
+        results = store.query(
+            query_embeddings=[query_embed],
+            n_results=n_results,
+            where=where
+        )
     return results # 直接返回整个 results 字典
 
+
+async def aquery_db(query: str, n_results: int = 3, where: Optional[Dict] = None) -> dict:
+    """
+    query_db 的异步版本：异步嵌入问题，向量检索放到线程池中执行，避免阻塞事件循环。
+    """
+    query_embed = await aembed_text(query)
+    store = get_vector_store()
+    with trace_stage("vector_query", n_results=n_results, backend=store.name):
+        return await asyncio.to_thread(
+            store.query,
+            query_embeddings=[query_embed],
+            n_results=n_results,
+            where=where
+        )
+
+
+def _split_results(results: dict, count: int) -> List[dict]:
+    """
+    把一次多查询的结果拆成每个查询各自的结果字典，结构与 query_db 的返回值相同。
+    """
+    keys = [key for key in ("ids", "documents", "metadatas", "distances") if results.get(key) is not None]
+    return [{key: [results[key][i]] for key in keys} for i in range(count)]
+
+
+def query_db_many(queries: List[str], n_results: int = 3, where: Optional[Dict] = None,
+                  batch_size: int = 256) -> List[dict]:
+    """
+    批量检索多个问题（离线评测、缓存预热、查询扩展等）：先一次性嵌入所有问题，
+    再每 batch_size 个问题发起一次带多个 query_embeddings 的向量检索。
+
+    Args:
+        queries (List[str]): 问题列表。
+        n_results (int): 每个问题返回的片段数。
+        where (Optional[Dict]): Chroma 风格的元数据过滤条件，对所有问题生效。
+        batch_size (int): 每次向量检索携带的问题数，限制单次检索的结果规模。
+
+    Returns:
+        List[dict]: 与 queries 一一对应的结果，每个结果的结构与 query_db 的返回值相同。
+    """
+    if not queries:
+        return []
+    query_embeds = embed_texts(queries)
+    store = get_vector_store()
+    per_query = []
+    with trace_stage("vector_query", n_results=n_results, backend=store.name, queries=len(queries)):
+        for start in range(0, len(query_embeds), batch_size):
+            batch = query_embeds[start:start + batch_size]
+            results = store.query(query_embeddings=batch, n_results=n_results, where=where)
+            per_query.extend(_split_results(results, len(batch)))
+    return per_query
+
+
+async def aquery_db_many(queries: List[str], n_results: int = 3, where: Optional[Dict] = None,
+                         batch_size: int = 256) -> List[dict]:
+    """
+    query_db_many 的异步版本，向量检索放到线程池中执行。
+    """
+    if not queries:
+        return []
+    query_embeds = await aembed_texts(queries)
+    store = get_vector_store()
+    per_query = []
+    with trace_stage("vector_query", n_results=n_results, backend=store.name, queries=len(queries)):
+        for start in range(0, len(query_embeds), batch_size):
+            batch = query_embeds[start:start + batch_size]
+            results = await asyncio.to_thread(store.query, query_embeddings=batch, n_results=n_results, where=where)
+            per_query.extend(_split_results(results, len(batch)))
+    return per_query
+
+
+def get_chunks_by_ids(ids: List[str]) -> dict:
+    """
+    按片段ID直接从向量存储取回文档及其元数据，返回顺序与 ids 一致（不存在的ID会被忽略）。
+    """
+    if not ids:
+        return {"ids": [], "documents": [], "metadatas": []}
+    fetched = get_vector_store().get(ids=ids)
+    by_id = {cid: (doc, metadata) for cid, doc, metadata in
+             zip(fetched["ids"], fetched["documents"], fetched["metadatas"])}
+    ordered = [cid for cid in ids if cid in by_id]
+    return {
+        "ids": ordered,
+        "documents": [by_id[cid][0] for cid in ordered],
+        "metadatas": [by_id[cid][1] for cid in ordered],
+    }
+
+
+def lexical_search(query: str, top_k: int = 10, where: Optional[Dict] = None) -> List[Tuple[str, float]]:
+    """
+    用 BM25 倒排索引检索片段，返回得分最高的 top_k 个 (片段ID, 得分)。
+    """
+    with trace_stage("lexical_query", top_k=top_k) as attrs:
+        hits = get_bm25_index().search(query, top_k=top_k, where=where)
+        attrs["hits"] = len(hits)
+    return hits
+
+
+def fuse_results(vector_results: dict, lexical_hits: List[Tuple[str, float]], n_results: int,
+                 rrf_k: int = 60) -> dict:
+    """
+    用倒数排名融合合并向量检索结果与 BM25 结果，返回前 n_results 个片段，结构与 query_db 的返回值相同
+    （不含 distances，另附 rrf_scores）。只出现在 BM25 结果中的片段从向量存储按ID取回。
+    """
+    vector_ids = vector_results["ids"][0]
+    fused = reciprocal_rank_fusion([vector_ids, [cid for cid, _ in lexical_hits]], k=rrf_k)[:n_results]
+    known = {cid: (doc, metadata) for cid, doc, metadata in
+             zip(vector_ids, vector_results["documents"][0], vector_results["metadatas"][0])}
+    missing = [cid for cid, _ in fused if cid not in known]
+    if missing:
+        fetched = get_chunks_by_ids(missing)
+        known.update({cid: (doc, metadata) for cid, doc, metadata in
+                      zip(fetched["ids"], fetched["documents"], fetched["metadatas"])})
+    fused = [(cid, score) for cid, score in fused if cid in known]
+    return {
+        "ids": [[cid for cid, _ in fused]],
+        "documents": [[known[cid][0] for cid, _ in fused]],
+        "metadatas": [[known[cid][1] for cid, _ in fused]],
+        "rrf_scores": [[round(score, 6) for _, score in fused]],
+    }
+
+
+def hybrid_query_db(query: str, n_results: int = 3, lexical_results: Optional[int] = None,
+                    rrf_k: int = 60, where: Optional[Dict] = None) -> dict:
+    """
+    混合检索：向量检索与 BM25 检索各取候选，用倒数排名融合后返回前 n_results 个片段。
+
+    Args:
+        query (str): 问题。
+        n_results (int): 返回的片段数，也是向量检索的候选数。
+        lexical_results (Optional[int]): BM25 的候选数，默认与 n_results 相同。
+        rrf_k (int): RRF 的平滑常数，越大则排名靠后的候选权重下降得越慢。
+        where (Optional[Dict]): 元数据过滤条件，同时作用于两路检索。
+    """
+    vector_results = query_db(query, n_results=n_results, where=where)
+    lexical_hits = lexical_search(query, top_k=lexical_results or n_results, where=where)
+    return fuse_results(vector_results, lexical_hits, n_results, rrf_k)
+
+
+def lookup_fault_codes(codes: List[str], n_results: int = 3, where: Optional[Dict] = None) -> dict:
+    """
+    通过故障码精确索引检索片段，跳过向量检索。
+
+    按 codes 的顺序收集提到这些故障码的片段（去重），只保留满足 where 条件的片段，最多返回 n_results 个。
+    """
+    ids = []
+    for code in codes:
+        for entry in get_fault_code_index().lookup(code):
+            if entry["id"] not in ids:
+                ids.append(entry["id"])
+    if not where:
+        return get_chunks_by_ids(ids[:n_results])
+    fetched = get_chunks_by_ids(ids)
+    kept = [i for i, metadata in enumerate(fetched["metadatas"]) if matches_where(metadata or {}, where)][:n_results]
+    return {key: [fetched[key][i] for i in kept] for key in ("ids", "documents", "metadatas")}
+
+
+def match_warning_light(image_bytes: bytes, max_distance: int = 10, top_k: int = 3,
+                        where: Optional[Dict] = None) -> List[Dict]:
+    """
+    用图标索引识别上传图片中的警告灯，返回匹配的图标条目（caption / source / page / distance），未匹配返回空列表。
+    where 不为空时只比对所选车型手册（及通用资料）中的图标。
+    """
+    sources = None
+    if where:
+        sources = {path for path, entry in load_manifest()["files"].items()
+                   if matches_where(entry.get("vehicle", {}), where)}
+    return get_icon_index().match(image_bytes, max_distance=max_distance, top_k=top_k, sources=sources)
+
+
+def list_vehicles() -> List[Dict[str, str]]:
+    """
+    返回知识库中已入库的车型与年款（来自入库清单），按车型、年款排序，不含通用资料。
+    """
+    vehicles = {(entry["vehicle"]["vehicle_model"], entry["vehicle"]["model_year"])
+                for entry in load_manifest()["files"].values()
+                if entry.get("vehicle", {}).get("vehicle_model")}
+    return [{"vehicle_model": model, "model_year": year} for model, year in sorted(vehicles)]
+
+
+def vehicle_filter(vehicle_model: Optional[str] = None, model_year: Optional[str] = None) -> Optional[Dict]:
+    """
+    构造只检索某个车型（及年款）手册的 where 条件；通用资料（车型为空）始终包含在内。
+    未指定车型时返回 None，即检索整个知识库。
+    """
+    if not vehicle_model:
+        return None
+    condition = {"vehicle_model": {"$in": [vehicle_model, ""]}}
+    if model_year:
+        condition = {"$and": [condition, {"model_year": {"$in": [model_year, ""]}}]}
+    return condition
+
 if __name__ == "__main__":
     # 测试嵌入数据库创建
     print("正在创建嵌入数据库...")
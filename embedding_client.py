@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import httpx
+from langchain_core.embeddings import Embeddings
+
+# 这些状态码通常是服务端暂时过载，值得重试
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class OllamaEmbeddingClient(Embeddings):
+    def __init__(self,
+                 model: str = "nomic-embed-text:latest",
+                 base_url: str = "http://localhost:11434",
+                 batch_size: int = 16,
+                 max_concurrency: int = 4,
+                 max_retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout: float = 120.0,
+                 keep_alive: str = "5m"):
+        """
+        面向 Ollama /api/embed 接口的批量、并发嵌入客户端。
+
+        文本按 batch_size 分批，同时在途的请求数不超过 max_concurrency；
+        同步与异步接口各自复用一个长连接池，失败的请求按指数退避重试。
+
+        参数：
+            model: Ollama 嵌入模型名称。
+            base_url: Ollama 服务的基础 URL。
+            batch_size: 单个请求携带的文本数量。
+            max_concurrency: 同时在途的最大请求数（也是连接池大小）。
+            max_retries: 单个请求失败后的最大重试次数。
+            backoff: 首次重试前的等待秒数，之后每次翻倍并加入随机抖动。
+            timeout: 单个请求的超时秒数。
+            keep_alive: 让 Ollama 在请求之间保持模型常驻内存的时长。
+        """
+        self.model = model
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+
+        self._limits = httpx.Limits(max_connections=max_concurrency,
+                                    max_keepalive_connections=max_concurrency)
+        self._client = httpx.Client(base_url=base_url, timeout=timeout, limits=self._limits)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ollama-embed")
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _payload(self, texts: List[str]) -> dict:
+        return {"model": self.model, "input": texts, "keep_alive": self.keep_alive}
+
+    def _retry_delay(self, attempt: int) -> float:
+        return self.backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+
+    @staticmethod
+    def _should_retry(error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in RETRYABLE_STATUS_CODES
+        return isinstance(error, httpx.TransportError)
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    # --- 同步接口 ---
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._client.post("/api/embed", json=self._payload(texts))
+                response.raise_for_status()
+                return response.json()["embeddings"]
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if attempt >= self.max_retries or not self._should_retry(e):
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"嵌入请求失败（{e}），{delay:.2f} 秒后第 {attempt + 1} 次重试...")
+                time.sleep(delay)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量嵌入文本，返回的向量顺序与输入一致。
+        """
+        if not texts:
+            return []
+        batches = self._batches(texts)
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+        vectors = []
+        # 线程池大小即最大并发数，map 按提交顺序返回结果
+        for batch_vectors in self._executor.map(self._embed_batch, batches):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0]
+
+    # --- 异步接口 ---
+    def _get_async_client(self) -> httpx.AsyncClient:
+        # AsyncClient 和 Semaphore 都与事件循环绑定，事件循环变化时需要重新创建
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self._limits)
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._async_loop = loop
+        return self._async_client
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        client = self._get_async_client()
+        async with self._async_semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.post("/api/embed", json=self._payload(texts))
+                    response.raise_for_status()
+                    return response.json()["embeddings"]
+                except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                    if attempt >= self.max_retries or not self._should_retry(e):
+                        raise
+                    delay = self._retry_delay(attempt)
+                    print(f"异步嵌入请求失败（{e}），{delay:.2f} 秒后第 {attempt + 1} 次重试...")
+                    await asyncio.sleep(delay)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        results = await asyncio.gather(*(self._aembed_batch(batch) for batch in self._batches(texts)))
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self._aembed_batch([text]))[0]
+
+    def close(self) -> None:
+        """
+        关闭连接池与线程池。
+        """
+        self._client.close()
+        self._executor.shutdown(wait=False)
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
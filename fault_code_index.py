@@ -0,0 +1,76 @@
+import json
+import os
+from typing import Dict, List
+
+from chunk import extract_fault_codes
+
+
+class FaultCodeIndex:
+    def __init__(self, path: str):
+        """
+        故障码精确匹配索引：故障码 -> 提到该故障码的片段（ID、来源文件、页码）。
+
+        入库时随片段一起增量维护，查询时按故障码直接定位片段，
+        不依赖语义相似度（P0420 这类编码的向量检索效果很差）。
+
+        参数：
+            path: 索引的 JSON 文件路径。
+        """
+        self.path = path
+        self.codes: Dict[str, List[Dict]] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "FaultCodeIndex":
+        index = cls(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                index.codes = json.load(f)
+        return index
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self) -> None:
+        """
+        原子地写入索引文件。
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.codes, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def add_chunk(self, chunk_id: str, text: str, metadata: Dict) -> None:
+        """
+        提取片段中的故障码并登记到索引。
+        """
+        for code in extract_fault_codes(text):
+            entries = self.codes.setdefault(code, [])
+            if all(entry["id"] != chunk_id for entry in entries):
+                entries.append({
+                    "id": chunk_id,
+                    "source": metadata.get("source"),
+                    "page": metadata.get("page"),
+                })
+
+    def remove_source(self, source: str) -> None:
+        """
+        移除某个来源文件的全部登记项（文件被删除或内容变化时调用）。
+        """
+        for code in list(self.codes):
+            remaining = [entry for entry in self.codes[code] if entry["source"] != source]
+            if remaining:
+                self.codes[code] = remaining
+            else:
+                del self.codes[code]
+
+    def clear(self) -> None:
+        self.codes = {}
+
+    def lookup(self, code: str) -> List[Dict]:
+        return self.codes.get(code.upper(), [])
+
+    def __len__(self) -> int:
+        return len(self.codes)
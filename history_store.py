@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, message_to_dict, messages_from_dict
+
+from cache import LRUCache
+
+# summarizer(已有摘要, 滑出窗口的消息) -> 更新后的摘要
+Summarizer = Callable[[str, List[BaseMessage]], str]
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    单个会话的历史记录：完整记录写入 SQLite，提供给提示词的 messages 只包含最近的若干轮，
+    以及（启用时）对更早对话的滚动摘要。
+    """
+
+    def __init__(self, store: "SessionHistoryStore", session_id: str, messages: List[BaseMessage],
+                 summary: str = "", summarized_upto: int = 0):
+        self.store = store
+        self.session_id = session_id
+        self._messages = messages
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+        self._lock = threading.Lock()
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        window = self.store.window_messages
+        recent = self._messages[-window:] if window else list(self._messages)
+        if self.summary:
+            return [SystemMessage(content=f"此前对话的摘要：{self.summary}")] + recent
+        return recent
+
+    @property
+    def all_messages(self) -> List[BaseMessage]:
+        return list(self._messages)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with self._lock:
+            start = len(self._messages)
+            self._messages.extend(messages)
+            self.store._append(self.session_id, start, messages)
+        self.store._maybe_summarize(self)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._messages = []
+            self.summary = ""
+            self.summarized_upto = 0
+            self.store._delete(self.session_id)
+
+
+class SessionHistoryStore:
+    def __init__(self,
+                 db_path: str = "./cache/chat_history.sqlite",
+                 max_sessions: int = 256,
+                 idle_ttl: Optional[float] = 3600,
+                 window_turns: int = 6,
+                 summarizer: Optional[Summarizer] = None,
+                 retention: Optional[float] = 30 * 24 * 3600):
+        """
+        有界、可持久化的会话历史存储。
+
+        内存中只保留最近活跃的 max_sessions 个会话，空闲超过 idle_ttl 秒的会话被淘汰；
+        所有消息同时写入 SQLite，被淘汰或进程重启后的会话在下次访问时从磁盘重新加载。
+        提供给提示词的历史只包含最近 window_turns 轮（每轮一问一答），更早的对话可由 summarizer
+        在后台压缩为滚动摘要，使提示词长度不再随对话轮数线性增长。
+
+        参数：
+            db_path: SQLite 文件路径。
+            max_sessions: 内存中最多保留的会话数。
+            idle_ttl: 会话在内存中的空闲有效期（秒）。
+            window_turns: 提示词中保留的最近对话轮数，0 表示不截断。
+            summarizer: 滚动摘要函数，None 表示不生成摘要。
+            retention: 磁盘上超过该时长未更新的会话会在启动时被清理（秒），None 表示永久保留。
+        """
+        self.window_messages = window_turns * 2
+        self.summarizer = summarizer
+        self._sessions = LRUCache(maxsize=max_sessions, ttl=idle_ttl, name="chat_sessions")
+        self._session_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary") \
+            if summarizer else None
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(session_id TEXT PRIMARY KEY, summary TEXT, summarized_upto INTEGER, updated REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages "
+                         "(session_id TEXT, idx INTEGER, message TEXT, PRIMARY KEY (session_id, idx))")
+        self._db.commit()
+        if retention is not None:
+            self.purge(retention)
+
+    def get(self, session_id: str) -> WindowedChatMessageHistory:
+        """
+        获取会话历史：优先从内存取，未命中时从 SQLite 加载（不存在则新建）。
+        """
+        with self._session_lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = self._load(session_id)
+            # 重新写入以刷新空闲计时
+            self._sessions.set(session_id, history)
+            return history
+
+    def delete(self, session_id: str) -> None:
+        with self._session_lock:
+            self._sessions.pop(session_id)
+            self._delete(session_id)
+
+    def purge(self, older_than: float) -> None:
+        """
+        删除磁盘上超过 older_than 秒未更新的会话。
+        """
+        cutoff = time.time() - older_than
+        with self._db_lock:
+            stale = [row[0] for row in self._db.execute("SELECT session_id FROM sessions WHERE updated < ?", (cutoff,))]
+            for session_id in stale:
+                self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+        if stale:
+            print(f"已清理 {len(stale)} 个过期会话。")
+
+    def stats(self):
+        return self._sessions.stats()
+
+    # --- SQLite 读写 ---
+    def _load(self, session_id: str) -> WindowedChatMessageHistory:
+        with self._db_lock:
+            rows = self._db.execute("SELECT message FROM messages WHERE session_id = ? ORDER BY idx",
+                                    (session_id,)).fetchall()
+            meta = self._db.execute("SELECT summary, summarized_upto FROM sessions WHERE session_id = ?",
+                                    (session_id,)).fetchone()
+        messages = messages_from_dict([json.loads(row[0]) for row in rows])
+        summary, summarized_upto = meta if meta else ("", 0)
+        return WindowedChatMessageHistory(self, session_id, messages, summary or "", summarized_upto or 0)
+
+    def _append(self, session_id: str, start: int, messages: Sequence[BaseMessage]) -> None:
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages (session_id, idx, message) VALUES (?, ?, ?)",
+                [(session_id, start + i, json.dumps(message_to_dict(m), ensure_ascii=False))
+                 for i, m in enumerate(messages)])
+            self._touch(session_id)
+            self._db.commit()
+
+    def _touch(self, session_id: str, summary: Optional[str] = None, summarized_upto: Optional[int] = None) -> None:
+        self._db.execute("INSERT OR IGNORE INTO sessions (session_id, summary, summarized_upto, updated) "
+                         "VALUES (?, '', 0, ?)", (session_id, time.time()))
+        if summary is None:
+            self._db.execute("UPDATE sessions SET updated = ? WHERE session_id = ?", (time.time(), session_id))
+        else:
+            self._db.execute("UPDATE sessions SET summary = ?, summarized_upto = ?, updated = ? WHERE session_id = ?",
+                             (summary, summarized_upto, time.time(), session_id))
+
+    def _delete(self, session_id: str) -> None:
+        with self._db_lock:
+            self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    # --- 滚动摘要 ---
+    def _maybe_summarize(self, history: WindowedChatMessageHistory) -> None:
+        if not self.summarizer or not self.window_messages:
+            return
+        if len(history.all_messages) - self.window_messages > history.summarized_upto:
+            self._summary_executor.submit(self._summarize, history)
+
+    def _summarize(self, history: WindowedChatMessageHistory) -> None:
+        messages = history.all_messages
+        upto = len(messages) - self.window_messages
+        if upto <= history.summarized_upto:
+            return
+        try:
+            summary = self.summarizer(history.summary, messages[history.summarized_upto:upto])
+        except Exception as e:
+            print(f"生成对话摘要失败：{e}")
+            return
+        history.summary, history.summarized_upto = summary, upto
+        with self._db_lock:
+            self._touch(history.session_id, summary, upto)
+            self._db.commit()
@@ -0,0 +1,184 @@
+import json
+import os
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from image_utils import dhash, hamming_distance, open_image
+
+HASH_BITS = 64
+
+
+def _caption_for_image(image: Dict, lines: List[Dict], tolerance: float = 4.0, max_gap: float = 120.0) -> str:
+    """
+    查找紧邻图标的说明文字：优先取与图标处于同一水平带、位于其右侧且距离最近的文本行，
+    其次取图标正下方最近的文本行。
+    """
+    top, bottom = image["top"] - tolerance, image["bottom"] + tolerance
+    right_of = [line for line in lines
+                if top <= (line["top"] + line["bottom"]) / 2 <= bottom
+                and line["x0"] >= image["x1"] - tolerance
+                and line["x0"] - image["x1"] <= max_gap]
+    if right_of:
+        return min(right_of, key=lambda line: line["x0"])["text"].strip()
+    below = [line for line in lines
+             if 0 <= line["top"] - image["bottom"] <= 3 * tolerance
+             and line["x0"] < image["x1"] and line["x1"] > image["x0"]]
+    if below:
+        return min(below, key=lambda line: line["top"])["text"].strip()
+    return ""
+
+
+def extract_pdf_icons(pdf_path: str, max_icon_size: float = 60.0, min_icon_size: float = 6.0,
+                      resolution: int = 150) -> Iterator[Tuple[Image.Image, str, int]]:
+    """
+    从 PDF 中提取小尺寸的嵌入图片（仪表盘警告灯等图标）及其旁边的说明文字。
+
+    参数：
+        pdf_path: PDF 文件路径。
+        max_icon_size / min_icon_size: 视为图标的图片宽高范围（PDF 点），过滤插图和装饰线条。
+        resolution: 裁剪图标时的渲染分辨率。
+
+    返回：
+        逐个产出 (图标图像, 说明文字, 页码)，页码从 0 开始，与入库片段的 page 元数据一致。
+    """
+    import pdfplumber  # 只在入库时需要
+
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_number, page in enumerate(pdf.pages):
+            icons = [img for img in page.images
+                     if min_icon_size <= img["width"] <= max_icon_size
+                     and min_icon_size <= img["height"] <= max_icon_size
+                     and max(img["width"], img["height"]) <= 3 * min(img["width"], img["height"])]
+            if not icons:
+                continue
+            lines = page.extract_text_lines()
+            for img in icons:
+                caption = _caption_for_image(img, lines)
+                if not caption:
+                    continue
+                bbox = (max(img["x0"], 0), max(img["top"], 0),
+                        min(img["x1"], page.width), min(img["bottom"], page.height))
+                try:
+                    icon = page.crop(bbox).to_image(resolution=resolution).original
+                except Exception as e:
+                    print(f"裁剪图标失败（{pdf_path} 第 {page_number} 页）：{e}")
+                    continue
+                yield icon, caption, page_number
+
+
+class IconIndex:
+    def __init__(self, path: str):
+        """
+        警告灯图标索引：手册中嵌入的图标 -> 感知哈希、说明文字、来源文件与页码。
+
+        入库时从 PDF 中提取，查询时用上传图片的感知哈希与索引比对。
+        仪表盘上点亮的警告灯通常是深色背景上的亮色图案，与手册中白底深色的图标明暗相反，
+        因此比对时同时计算反相图片的哈希。
+
+        参数：
+            path: 索引的 JSON 文件路径。
+        """
+        self.path = path
+        self.icons: List[Dict] = []
+
+    @classmethod
+    def load(cls, path: str) -> "IconIndex":
+        index = cls(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                index.icons = json.load(f)
+        return index
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self) -> None:
+        """
+        原子地写入索引文件。
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.icons, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def add_pdf(self, pdf_path: str) -> int:
+        """
+        提取 PDF 中的图标并登记到索引，同一页上哈希与说明都相同的图标只登记一次。返回新增的图标数。
+        """
+        seen = {(entry["hash"], entry["caption"], entry["page"]) for entry in self.icons
+                if entry["source"] == pdf_path}
+        added = 0
+        for icon, caption, page_number in extract_pdf_icons(pdf_path):
+            key = (format(dhash(icon), "016x"), caption, page_number)
+            if key in seen:
+                continue
+            seen.add(key)
+            self.icons.append({"hash": key[0], "caption": caption, "source": pdf_path, "page": page_number})
+            added += 1
+        return added
+
+    def remove_source(self, source: str) -> None:
+        self.icons = [entry for entry in self.icons if entry["source"] != source]
+
+    def clear(self) -> None:
+        self.icons = []
+
+    @staticmethod
+    def _informative(value: int, min_bits: int) -> bool:
+        """
+        哈希中置位数过少或过多时（纯色、模糊或只有渐变的图片）几乎不含图形信息，
+        与任何置位数相近的图标都可能距离很小，不参与比对。
+        """
+        bits = bin(value).count("1")
+        return min_bits <= bits <= HASH_BITS - min_bits
+
+    def match(self, image_bytes: bytes, max_distance: int = 10, top_k: int = 3,
+              sources: Optional[Collection[str]] = None, min_bits: int = 8) -> List[Dict]:
+        """
+        查找与上传图片匹配的图标，按汉明距离从小到大返回不同说明文字的条目（附带 distance 字段）。
+        sources 不为 None 时只比对来自这些文件的图标（例如所选车型的手册）。
+
+        除整张图片外还会比对中心区域的裁剪，便于匹配以警告灯为主体、但带有边框或背景的近拍照片。
+        每个区域同时计算原图与反相图片的 dHash；置位数少于 min_bits（或多于 64 - min_bits）的哈希被视为
+        没有图形信息而跳过，图片的所有区域都是这种情况时直接返回空列表。
+        """
+        if not self.icons:
+            return []
+        try:
+            image = open_image(image_bytes)
+        except Exception as e:
+            print(f"无法解析图片，跳过图标匹配：{e}")
+            return []
+        width, height = image.size
+        views = [image, image.crop((width // 5, height // 5, width * 4 // 5, height * 4 // 5))]
+        hashes = []
+        for view in views:
+            gray = view.convert("L")
+            # 反相后原来相等的相邻像素仍然相等（位为 0），因此必须重新计算哈希，不能对原哈希按位取反
+            hashes.extend(value for value in (dhash(gray), dhash(ImageOps.invert(gray)))
+                          if self._informative(value, min_bits))
+        if not hashes:
+            print("图片缺少可辨认的图形（纯色或过于模糊），跳过图标匹配。")
+            return []
+
+        best: Dict[str, Dict] = {}
+        for entry in self.icons:
+            if sources is not None and entry["source"] not in sources:
+                continue
+            icon_hash = int(entry["hash"], 16)
+            if not self._informative(icon_hash, min_bits):
+                continue
+            distance = min(hamming_distance(icon_hash, value) for value in hashes)
+            if distance > max_distance:
+                continue
+            current = best.get(entry["caption"])
+            if current is None or distance < current["distance"]:
+                best[entry["caption"]] = {**entry, "distance": distance}
+        return sorted(best.values(), key=lambda entry: entry["distance"])[:top_k]
+
+    def __len__(self) -> int:
+        return len(self.icons)
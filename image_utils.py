@@ -0,0 +1,88 @@
+import io
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+_MAGIC_MIME_TYPES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+    (b"BM", "image/bmp"),
+]
+
+
+def guess_mime_type(image_bytes: bytes) -> str:
+    """
+    根据文件头判断图片的 MIME 类型，无法识别时返回 "image/png"。
+    """
+    for magic, mime_type in _MAGIC_MIME_TYPES:
+        if image_bytes.startswith(magic):
+            return mime_type
+    return "image/png"
+
+
+def open_image(image_bytes: bytes) -> Image.Image:
+    """
+    打开图片并按 EXIF 方向信息旋转（手机照片常以 EXIF 记录方向）。
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    return ImageOps.exif_transpose(image)
+
+
+def preprocess_image(image_bytes: bytes, max_size: int = 1024, quality: int = 85) -> Tuple[bytes, str]:
+    """
+    缩小并重新编码图片：最长边不超过 max_size，去掉 EXIF 等元数据，统一编码为 JPEG。
+    带透明通道的图片先铺在白色背景上。无法解析的数据原样返回。
+
+    参数：
+        image_bytes: 图片的原始字节数据。
+        max_size: 最长边的最大像素数。
+        quality: JPEG 编码质量。
+
+    返回：
+        (处理后的字节数据, MIME 类型)。
+    """
+    try:
+        image = open_image(image_bytes)
+    except Exception as e:
+        print(f"无法解析图片，按原始数据发送：{e}")
+        return image_bytes, guess_mime_type(image_bytes)
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    original_size = image.size
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)  # 不传 exif 参数即不写入元数据
+    processed = buffer.getvalue()
+    print(f"图片预处理：{original_size[0]}x{original_size[1]} -> {image.size[0]}x{image.size[1]}，"
+          f"{len(image_bytes) // 1024}KB -> {len(processed) // 1024}KB")
+    return processed, "image/jpeg"
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """
+    计算图片的差值感知哈希（dHash）：缩放为 (hash_size + 1) x hash_size 的灰度图，
+    比较水平相邻像素的明暗，得到 hash_size * hash_size 位的整数。
+    缩放、重新编码后的同一张图片哈希几乎不变。
+    """
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = gray.tobytes()  # "L" 模式每个像素一个字节，按行排列
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
@@ -0,0 +1,154 @@
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from chunk import extract_fault_codes
+
+VEHICLE_EXAMPLES = [
+    "我的车仪表盘亮黄灯是什么意思？",
+    "如何更换电动汽车电池？",
+    "我的车最近续航掉了20%，可能是什么原因？",
+    "如何为我的车辆进行首次保养？",
+    "仪表盘上出现一个黄色的电池图标是什么意思？",
+    "空调制冷效果不佳怎么办？",
+    "冬季如何维护电池？",
+    "充电桩充不进电怎么回事？",
+    "胎压报警灯亮了还能继续开吗？",
+    "刹车的时候有异响是什么问题？",
+    "混动车型的发动机什么时候会启动？",
+    "能量回收强度怎么调节？",
+]
+
+GENERAL_EXAMPLES = [
+    "明天天气怎么样？",
+    "什么是量子计算？",
+    "帮我写一首关于春天的诗。",
+    "Python 里列表和元组有什么区别？",
+    "推荐几本好看的小说。",
+    "今天股市行情如何？",
+    "怎么做红烧肉？",
+    "世界上最高的山是哪座？",
+    "帮我把这段话翻译成英文。",
+    "如何提高睡眠质量？",
+]
+
+VEHICLE_KEYWORDS = [
+    "汽车", "车辆", "爱车", "新能源", "电动车", "混动", "dm-i", "续航", "充电", "电池", "仪表", "故障",
+    "保养", "胎压", "轮胎", "刹车", "制动", "空调", "电机", "发动机", "变速", "能量回收", "雨刮", "车门",
+    "座椅", "大灯", "警告灯", "指示灯", "obd", "方向盘", "里程", "车机", "驾驶",
+]
+
+GENERAL_KEYWORDS = [
+    "天气", "股票", "股市", "诗", "小说", "翻译", "菜谱", "做饭", "电影", "音乐", "编程", "python",
+    "数学", "历史", "旅游", "健康", "睡眠",
+]
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class IntentClassifier:
+    def __init__(self,
+                 embed_fn: Callable[[str], List[float]],
+                 embed_batch_fn: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                 vehicle_examples: List[str] = None,
+                 general_examples: List[str] = None,
+                 vehicle_keywords: List[str] = None,
+                 general_keywords: List[str] = None,
+                 keyword_weight: float = 0.05,
+                 decision_threshold: float = 0.06,
+                 top_k: int = 3):
+        """
+        本地意图分类器：结合关键词词典与问题向量到示例问题的相似度，判断“车辆问题”还是“通用问题”。
+
+        综合得分 = (与车辆示例的相似度 - 与通用示例的相似度) + keyword_weight * (车辆关键词数 - 通用关键词数)，
+        其中相似度取与各类示例最相近的 top_k 个的平均值。得分绝对值达到 decision_threshold 时直接给出结论，
+        否则返回 None，交由意图识别大模型兜底。问题中出现故障码时直接判为车辆问题。
+
+        参数：
+            embed_fn: 文本嵌入函数（应与检索共用带缓存的 embed_text，这样不会多一次嵌入请求）。
+            embed_batch_fn: 批量嵌入函数（如 embed_texts），用于一次嵌入一类的全部示例问题；未提供时逐条调用 embed_fn。
+            vehicle_examples / general_examples: 两类意图的示例问题。
+            vehicle_keywords / general_keywords: 两类意图的关键词词典（小写匹配）。
+            keyword_weight: 每个关键词命中对综合得分的贡献。
+            decision_threshold: 直接给出结论所需的最小综合得分绝对值，调大则更多问题交给大模型。
+            top_k: 计算类别相似度时取最相近的示例个数。
+        """
+        self.embed_fn = embed_fn
+        self.embed_batch_fn = embed_batch_fn
+        self.vehicle_examples = vehicle_examples or VEHICLE_EXAMPLES
+        self.general_examples = general_examples or GENERAL_EXAMPLES
+        self.vehicle_keywords = vehicle_keywords or VEHICLE_KEYWORDS
+        self.general_keywords = general_keywords or GENERAL_KEYWORDS
+        self.keyword_weight = keyword_weight
+        self.decision_threshold = decision_threshold
+        self.top_k = top_k
+        self._prototypes: Optional[Dict[str, np.ndarray]] = None
+
+    def _embed_examples(self, questions: List[str]) -> np.ndarray:
+        if self.embed_batch_fn is not None:
+            vectors = self.embed_batch_fn(questions)  # 每类示例问题只发一次批量嵌入请求
+        else:
+            vectors = [self.embed_fn(q) for q in questions]
+        return _normalize(np.array(vectors, dtype=np.float32))
+
+    def _get_prototypes(self) -> Dict[str, np.ndarray]:
+        # 首次分类时才嵌入示例问题，避免初始化时依赖 Ollama
+        if self._prototypes is None:
+            self._prototypes = {
+                "vehicle": self._embed_examples(self.vehicle_examples),
+                "general": self._embed_examples(self.general_examples),
+            }
+        return self._prototypes
+
+    def warm_up(self) -> None:
+        """
+        预先嵌入示例问题，使首次分类不再承担这部分延迟。
+        """
+        self._get_prototypes()
+
+    def _class_similarity(self, query: np.ndarray, prototypes: np.ndarray) -> float:
+        similarities = np.sort(prototypes @ query)[::-1]
+        return float(similarities[:self.top_k].mean())
+
+    def _keyword_hits(self, question: str, keywords: List[str]) -> int:
+        lowered = question.lower()
+        return sum(1 for keyword in keywords if keyword in lowered)
+
+    def classify(self, question: str, query_embedding: List[float] = None) -> Dict:
+        """
+        返回分类结果字典：intent 为 "vehicle"、"general" 或 None（置信度不足），
+        以及 score、method 和各项中间量，便于记录每次决策。
+        """
+        if extract_fault_codes(question):
+            return {"intent": "vehicle", "score": 1.0, "method": "fault_code"}
+
+        vehicle_hits = self._keyword_hits(question, self.vehicle_keywords)
+        general_hits = self._keyword_hits(question, self.general_keywords)
+        score = self.keyword_weight * (vehicle_hits - general_hits)
+        decision = {"vehicle_keywords": vehicle_hits, "general_keywords": general_hits, "method": "keyword"}
+
+        try:
+            if query_embedding is None:
+                query_embedding = self.embed_fn(question)
+            prototypes = self._get_prototypes()
+            query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+            vehicle_similarity = self._class_similarity(query, prototypes["vehicle"])
+            general_similarity = self._class_similarity(query, prototypes["general"])
+            score += vehicle_similarity - general_similarity
+            decision.update(vehicle_similarity=round(vehicle_similarity, 4),
+                            general_similarity=round(general_similarity, 4),
+                            method="embedding+keyword")
+        except Exception as e:
+            print(f"意图分类器嵌入失败，仅使用关键词: {e}")
+
+        decision["score"] = round(score, 4)
+        if score >= self.decision_threshold:
+            decision["intent"] = "vehicle"
+        elif score <= -self.decision_threshold:
+            decision["intent"] = "general"
+        else:
+            decision["intent"] = None
+        return decision
@@ -1,20 +1,70 @@
 import base64
+import hashlib
+from typing import Optional, Tuple
+
 from langchain_core.messages import HumanMessage
 from langchain_community.chat_models import ChatOllama
 
+from cache import LRUCache
+from image_utils import preprocess_image
+
 
 class MultimodalModel:
-    def __init__(self, model_name: str = "qwen2.5vl:3b", base_url: str = "http://localhost:11434"):
+    def __init__(self, model_name: str = "qwen2.5vl:3b", base_url: str = "http://localhost:11434",
+                 max_image_size: int = 1024, jpeg_quality: int = 85,
+                 cache_size: int = 128, cache_ttl: Optional[float] = 3600):
         """
         初始化用于图像描述的多模态模型。
 
+        上传的图片先缩小到最长边不超过 max_image_size、去掉 EXIF 并重新编码为 JPEG，
+        视觉模型的 prefill 耗时和上传体积都随像素数增长，手机照片缩小后明显更快。
+        描述结果按预处理后图片字节的 sha256 缓存，同一张图片在后续轮次中不再重复调用模型。
+        不使用感知哈希的近似匹配：同一块仪表盘亮起不同警告灯的两张照片哈希非常接近，会被误判为同一张图片。
+
         参数：
             model_name: Ollama 多模态模型的名称（例如 "qwen2.5vl:3b"、"llava:latest"）。
             base_url: Ollama 服务的基础 URL。
+            max_image_size: 发送给模型的图片最长边像素数。
+            jpeg_quality: 重新编码的 JPEG 质量。
+            cache_size: 最多缓存的图片描述数量，0 表示不缓存。
+            cache_ttl: 图片描述的缓存有效期（秒）。
         """
         self.model = ChatOllama(model=model_name, base_url=base_url, temperature=0.0)  # 使用较低温度以获得一致性描述
+        self.model_name = model_name
+        self.max_image_size = max_image_size
+        self.jpeg_quality = jpeg_quality
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl, name="image_description") if cache_size else None
         print(f"已初始化多模态模型：{model_name}")
 
+    def _preprocess(self, image_bytes: bytes) -> Tuple[bytes, str, str]:
+        """
+        预处理图片并计算其 sha256，返回 (图片字节, MIME 类型, 摘要)。
+        """
+        processed, mime_type = preprocess_image(image_bytes, max_size=self.max_image_size, quality=self.jpeg_quality)
+        return processed, mime_type, hashlib.sha256(processed).hexdigest()
+
+    def _cached_description(self, image_digest: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        description = self.cache.get(image_digest)
+        if description is not None:
+            print("图像描述命中缓存。")
+        return description
+
+    def _remember_description(self, image_digest: str, description: str) -> None:
+        if self.cache is not None:
+            self.cache.set(image_digest, description)
+
+    @staticmethod
+    def _build_message(image_bytes: bytes, mime_type: str = "image/png") -> HumanMessage:
+        encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+        return HumanMessage(
+            content=[
+                {"type": "text", "text": "请概述这张图片的内容。"},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
+            ]
+        )
+
     def describe_image(self, image_bytes: bytes) -> str:
         """
         使用多模态模型生成图像的文字描述。
@@ -29,16 +79,37 @@ class MultimodalModel:
         if not image_bytes:
             return "没有图片数据可供描述。"
 
+        image_bytes, mime_type, image_digest = self._preprocess(image_bytes)
+        cached = self._cached_description(image_digest)
+        if cached is not None:
+            return cached
+
+        try:
+            response = self.model.invoke([self._build_message(image_bytes, mime_type)])
+            print("图像描述生成成功。")
+            self._remember_description(image_digest, response.content)
+            return response.content
+        except Exception as e:
+            print(f"生成图像描述时出错：{e}")
+            return f"无法生成图片描述：{e}"
+
+    async def adescribe_image(self, image_bytes: bytes) -> str:
+        """
+        describe_image 的异步版本。
+        """
+        print("正在使用多模态模型生成图像描述...")
+        if not image_bytes:
+            return "没有图片数据可供描述。"
+
+        image_bytes, mime_type, image_digest = self._preprocess(image_bytes)
+        cached = self._cached_description(image_digest)
+        if cached is not None:
+            return cached
+
         try:
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
-            message = HumanMessage(
-                content=[
-                    {"type": "text", "text": "请概述这张图片的内容。"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encoded_image}"}}
-                ]
-            )
-            response = self.model.invoke([message])
+            response = await self.model.ainvoke([self._build_message(image_bytes, mime_type)])
             print("图像描述生成成功。")
+            self._remember_description(image_digest, response.content)
             return response.content
         except Exception as e:
             print(f"生成图像描述时出错：{e}")
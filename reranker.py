@@ -0,0 +1,289 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from cache import LRUCache
+from embed import normalize_query
+from tracing import record_cache, trace_stage
+
+
+class TorchRerankerBackend:
+    """基于 PyTorch 的 sentence-transformers CrossEncoder（fp32）。"""
+
+    def __init__(self, model_name: str, num_threads: Optional[int] = None):
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.name = "torch"
+        self.model = CrossEncoder(model_name)
+
+    def predict(self, pairs: List[List[str]], batch_size: int = 32) -> np.ndarray:
+        return np.asarray(self.model.predict(pairs, batch_size=batch_size), dtype=np.float32)
+
+
+def _logits_only(model, input_names: List[str]):
+    """导出 ONNX 时只保留 logits 输出，并把位置参数映射回模型的关键字参数。"""
+    import torch
+
+    class LogitsOnly(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).logits
+
+    return LogitsOnly()
+
+
+class OnnxRerankerBackend:
+    def __init__(self, model_name: str, model_dir: str = "./models/bge-reranker-base-onnx",
+                 quantize: bool = True, num_threads: Optional[int] = None, max_length: int = 512):
+        """
+        基于 ONNX Runtime 的 CrossEncoder 后端，可选动态 int8 量化，适合仅有 CPU 的节点。
+
+        首次使用时把模型导出为 ONNX（model.onnx），量化版本保存为 model.int8.onnx，之后直接加载。
+        输出经过 Sigmoid，与 CrossEncoder 对单标签模型的默认激活一致，得分可与 PyTorch 后端直接比较。
+
+        参数：
+            model_name: Hugging Face 模型名称。
+            model_dir: 导出的 ONNX 模型与分词器的保存目录。
+            quantize: 是否使用动态 int8 量化后的模型。
+            num_threads: ONNX Runtime 的算子内线程数，None 表示由运行时决定。
+            max_length: 分词截断长度。
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.name = "onnx-int8" if quantize else "onnx"
+        self.model_name = model_name
+        self.model_dir = model_dir
+        self.max_length = max_length
+        fp32_path = os.path.join(model_dir, "model.onnx")
+        int8_path = os.path.join(model_dir, "model.int8.onnx")
+        if not os.path.exists(fp32_path):
+            self.export(fp32_path)
+        if quantize and not os.path.exists(int8_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print("正在对重排模型进行动态 int8 量化...")
+            quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(int8_path if quantize else fp32_path, options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        print(f"ONNX 重排模型已加载：{self.name}，线程数 {num_threads or '自动'}")
+
+    def export(self, onnx_path: str) -> None:
+        """
+        把 Hugging Face 模型导出为带动态 batch/序列长度维度的 ONNX 文件，并保存分词器。
+        """
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        print(f"正在把 {self.model_name} 导出为 ONNX：{onnx_path}")
+        os.makedirs(self.model_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name).eval()
+        dummy = tokenizer(["示例问题"], ["示例文档"], return_tensors="pt")
+        input_names = list(dummy.keys())
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+        with torch.no_grad():
+            torch.onnx.export(_logits_only(model, input_names), tuple(dummy[name] for name in input_names),
+                              onnx_path, input_names=input_names, output_names=["logits"],
+                              dynamic_axes=dynamic_axes, opset_version=14)
+        tokenizer.save_pretrained(self.model_dir)
+
+    def predict(self, pairs: List[List[str]], batch_size: int = 32) -> np.ndarray:
+        scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            encoded = self.tokenizer([q for q, _ in batch], [d for _, d in batch], padding=True, truncation=True,
+                                     max_length=self.max_length, return_tensors="np")
+            feeds = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            logits = self.session.run(["logits"], feeds)[0][:, 0]
+            scores.append(1.0 / (1.0 + np.exp(-logits)))
+        return np.concatenate(scores).astype(np.float32) if scores else np.zeros(0, dtype=np.float32)
+
+
+def create_reranker_backend(backend: str, model_name: str, num_threads: Optional[int] = None):
+    """
+    按名称创建重排后端："torch"（PyTorch fp32）、"onnx"（ONNX fp32）或 "onnx-int8"（ONNX 动态 int8 量化）。
+    """
+    if backend == "torch":
+        return TorchRerankerBackend(model_name, num_threads=num_threads)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxRerankerBackend(model_name, quantize=backend == "onnx-int8", num_threads=num_threads)
+    raise ValueError(f"未知的重排后端：{backend}")
+
+
+def check_parity(pairs: List[List[str]], model_name: str = "BAAI/bge-reranker-base",
+                 backend: str = "onnx-int8", num_threads: Optional[int] = None) -> Dict[str, float]:
+    """
+    对比指定后端与 PyTorch 后端在同一批样本对上的得分漂移与耗时。
+
+    返回最大/平均绝对误差、两者排序的 Top-1 是否一致以及各自的推理耗时。
+    """
+    reference = TorchRerankerBackend(model_name, num_threads=num_threads)
+    candidate = create_reranker_backend(backend, model_name, num_threads=num_threads)
+
+    start = time.perf_counter()
+    reference_scores = reference.predict(pairs)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    candidate_scores = candidate.predict(pairs)
+    candidate_seconds = time.perf_counter() - start
+
+    drift = np.abs(reference_scores - candidate_scores)
+    report = {
+        "backend": candidate.name,
+        "pairs": len(pairs),
+        "max_abs_drift": float(drift.max()),
+        "mean_abs_drift": float(drift.mean()),
+        "top1_agree": bool(np.argmax(reference_scores) == np.argmax(candidate_scores)),
+        "torch_seconds": round(reference_seconds, 4),
+        "candidate_seconds": round(candidate_seconds, 4),
+    }
+    print(f"重排后端一致性检查：{report}")
+    return report
+
+
+class _RerankRequest:
+    def __init__(self, pairs: List[List[str]]):
+        self.pairs = pairs
+        self.future: Future = Future()
+
+
+class RerankerService:
+    def __init__(self,
+                 model_name: str = "BAAI/bge-reranker-base",
+                 backend: str = "torch",
+                 num_threads: Optional[int] = None,
+                 cache_size: int = 8192,
+                 cache_ttl: Optional[float] = 3600,
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0):
+        """
+        CrossEncoder 重排服务：得分缓存 + 跨请求微批处理。
+
+        得分按（规范化问题, 片段ID）缓存，刚刚计算过的组合不会重复推理；
+        未命中的（问题, 片段）对进入队列，由后台线程在 max_wait_ms 的等待窗口内
+        把多个并发会话的请求合并成一次前向计算（最多 max_batch_size 对）。
+
+        参数：
+            model_name: CrossEncoder 模型名称。
+            backend: 推理后端，"torch"、"onnx" 或 "onnx-int8"（见 create_reranker_backend）。
+            num_threads: 推理使用的CPU线程数，None 表示由后端决定。
+            cache_size: 得分缓存的最大条目数。
+            cache_ttl: 得分缓存的有效期（秒）。
+            max_batch_size: 单次前向计算的最大样本对数。
+            max_wait_ms: 第一个请求到达后，等待更多请求加入同一批次的最长时间（毫秒）。
+        """
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.backend = create_reranker_backend(backend, model_name, num_threads=num_threads)
+        self.score_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl, name="rerank_score")
+        self._requests: "queue.Queue[_RerankRequest]" = queue.Queue()
+        self._worker = threading.Thread(target=self._batch_loop, name="rerank-batcher", daemon=True)
+        self._worker.start()
+
+    def _cache_key(self, question: str, doc: str, chunk_id: Optional[str]) -> str:
+        # 没有片段ID时退化为使用文档内容的摘要
+        doc_key = chunk_id or hashlib.sha1(doc.encode("utf-8")).hexdigest()
+        return f"{self.model_name}\x00{self.backend.name}\x00{normalize_query(question)}\x00{doc_key}"
+
+    def _collect_batch(self) -> List[_RerankRequest]:
+        batch = [self._requests.get()]
+        size = len(batch[0].pairs)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.pairs)
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            pairs = [pair for request in batch for pair in request.pairs]
+            try:
+                scores = self.backend.predict(pairs, batch_size=self.max_batch_size)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            if len(batch) > 1:
+                print(f"重排微批处理：合并 {len(batch)} 个请求，共 {len(pairs)} 对。")
+            offset = 0
+            for request in batch:
+                request.future.set_result([float(score) for score in scores[offset:offset + len(request.pairs)]])
+                offset += len(request.pairs)
+
+    def score(self, question: str, docs: List[str], chunk_ids: Optional[List[str]] = None) -> List[float]:
+        """
+        返回问题与每个文档的相关性得分，顺序与 docs 一致。
+        """
+        chunk_ids = chunk_ids or [None] * len(docs)
+        keys = [self._cache_key(question, doc, cid) for doc, cid in zip(docs, chunk_ids)]
+        scores: List[Optional[float]] = [self.score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        record_cache("rerank_score", True, len(docs) - len(missing))
+        record_cache("rerank_score", False, len(missing))
+        if missing:
+            with trace_stage("rerank", candidates=len(docs), computed=len(missing), backend=self.backend.name):
+                request = _RerankRequest([[question, docs[i]] for i in missing])
+                self._requests.put(request)
+                for i, score in zip(missing, request.future.result()):
+                    scores[i] = score
+                    self.score_cache.set(keys[i], score)
+        print(f"重排得分：{len(docs) - len(missing)} 个命中缓存，{len(missing)} 个重新计算。")
+        return scores
+
+    def predict(self, pairs: List[List[str]]) -> List[float]:
+        """
+        与 CrossEncoder.predict 兼容的接口（无片段ID，按文档内容缓存）。
+        """
+        if not pairs:
+            return []
+        question = pairs[0][0]
+        if all(pair[0] == question for pair in pairs):
+            return self.score(question, [pair[1] for pair in pairs])
+        return [self.score(q, [doc])[0] for q, doc in pairs]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare a reranker backend against the PyTorch CrossEncoder.")
+    parser.add_argument("--backend", type=str, default="onnx-int8", help="Backend to check: onnx or onnx-int8")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads used by both backends")
+    args = parser.parse_args()
+
+    sample_question = "仪表盘上出现一个黄色的电池图标是什么意思？"
+    sample_docs = [
+        "动力电池故障警告灯：该指示灯点亮表示动力电池系统出现故障，请尽快联系授权服务店检查。",
+        "胎压监测系统：当轮胎气压过低时，胎压警告灯会点亮。",
+        "冬季使用车辆时，建议提前预热动力电池以保证续航。",
+        "空调滤芯应定期更换，以保证车内空气质量。",
+    ]
+    check_parity([[sample_question, doc] for doc in sample_docs], backend=args.backend, num_threads=args.threads)
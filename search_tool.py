@@ -0,0 +1,57 @@
+from typing import Any, Optional
+
+from langchain_community.tools import TavilySearchResults
+from langchain_core.tools import BaseTool, StructuredTool
+
+from cache import LRUCache
+from embed import normalize_query
+
+
+def build_cached_tavily_tool(max_results: int = 3, ttl: Optional[float] = 1800, maxsize: int = 512) -> BaseTool:
+    """
+    构建带缓存的 Tavily 搜索工具。
+
+    名称、描述和参数与 TavilySearchResults 完全一致，Agent 看到的是同一个工具；
+    搜索结果按规范化后的查询文本缓存 ttl 秒，重复的查询不再访问网络。
+    只缓存成功的结果（结果列表）：网络或 API 出错时 TavilySearchResults 返回错误字符串，不缓存，下次重新搜索。
+
+    参数：
+        max_results: 每次搜索返回的最大结果数。
+        ttl: 搜索结果的缓存有效期（秒）。
+        maxsize: 最多缓存的查询数。
+    """
+    tavily = TavilySearchResults(max_results=max_results)
+    cache = LRUCache(maxsize=maxsize, ttl=ttl, name="tavily_search")
+
+    def cache_key(query: str) -> str:
+        return f"{max_results}\x00{normalize_query(query)}"
+
+    def search(query: str) -> Any:
+        key = cache_key(query)
+        results = cache.get(key)
+        if results is None:
+            results = tavily.invoke({"query": query})
+            if isinstance(results, list):
+                cache.set(key, results)
+        else:
+            print(f"Tavily 搜索命中缓存：{query}")
+        return results
+
+    async def asearch(query: str) -> Any:
+        key = cache_key(query)
+        results = cache.get(key)
+        if results is None:
+            results = await tavily.ainvoke({"query": query})
+            if isinstance(results, list):
+                cache.set(key, results)
+        else:
+            print(f"Tavily 搜索命中缓存：{query}")
+        return results
+
+    return StructuredTool.from_function(
+        func=search,
+        coroutine=asearch,
+        name=tavily.name,
+        description=tavily.description,
+        args_schema=tavily.args_schema,
+    )
@@ -0,0 +1,34 @@
+import sqlite3
+import time
+
+from cache import LRUCache
+
+
+def _disk_keys(path):
+    with sqlite3.connect(path) as db:
+        return {row[0] for row in db.execute("SELECT key FROM cache")}
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LRUCache(maxsize=10, persist_path=path, disk_maxsize=20)
+    for i in range(100):
+        cache.set(f"k{i}", i)
+    keys = _disk_keys(path)
+    assert len(keys) <= 20
+    assert "k99" in keys and "k0" not in keys  # 淘汰最早写入的条目
+
+    # 重新打开后仍能从磁盘层命中最近写入的条目
+    reopened = LRUCache(maxsize=10, persist_path=path, disk_maxsize=20)
+    assert reopened.get("k99") == 99
+    assert reopened.get("k0") is None
+
+
+def test_expired_rows_are_purged(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LRUCache(maxsize=10, ttl=60, persist_path=path)
+    cache.set("old", 1)
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE cache SET created = ?", (time.time() - 120,))
+    LRUCache(maxsize=10, ttl=60, persist_path=path)  # 打开时清除过期条目
+    assert _disk_keys(path) == set()
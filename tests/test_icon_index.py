@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+ImageOps = pytest.importorskip("PIL.ImageOps")
+
+from icon_index import IconIndex  # noqa: E402
+from image_utils import dhash  # noqa: E402
+
+
+def _draw_icon(size: int = 64) -> "Image.Image":
+    """手册风格的图标：白底黑色的不对称图形（三角形警告标志加一个竖条）。"""
+    icon = Image.new("L", (size, size), 255)
+    draw = ImageDraw.Draw(icon)
+    draw.polygon([(size * 0.1, size * 0.9), (size * 0.5, size * 0.1), (size * 0.9, size * 0.9)], fill=0)
+    draw.rectangle([size * 0.45, size * 0.35, size * 0.55, size * 0.7], fill=255)
+    draw.ellipse([size * 0.05, size * 0.05, size * 0.3, size * 0.3], fill=0)
+    return icon.convert("RGB")
+
+
+def _jpeg_bytes(image: "Image.Image") -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _index_with(*entries) -> IconIndex:
+    index = IconIndex("unused.json")
+    for caption, image in entries:
+        index.icons.append({"hash": format(dhash(image), "016x"), "caption": caption,
+                            "source": "manual.pdf", "page": 3})
+    return index
+
+
+def test_flat_image_does_not_match_any_icon():
+    # 几乎没有置位的图标最容易被纯色图片误匹配
+    sparse = Image.new("RGB", (64, 64), (255, 255, 255))
+    ImageDraw.Draw(sparse).rectangle([30, 0, 33, 63], fill=(0, 0, 0))
+    index = _index_with(("电池故障警告灯", _draw_icon()), ("稀疏图标", sparse))
+
+    flat = Image.new("RGB", (400, 300), (20, 20, 20))
+    assert index.match(_jpeg_bytes(flat)) == []
+
+
+def test_light_on_dark_photo_matches_dark_on_light_icon():
+    icon = _draw_icon()
+    index = _index_with(("电池故障警告灯", icon))
+
+    # 仪表盘照片：黑底亮色图案，尺寸不同且经过 JPEG 压缩
+    photo = ImageOps.invert(icon.convert("L")).convert("RGB").resize((300, 300))
+    matches = index.match(_jpeg_bytes(photo))
+
+    assert matches and matches[0]["caption"] == "电池故障警告灯"
+    assert matches[0]["distance"] <= 10
+
+
+def test_inverted_hash_is_recomputed_not_bit_flipped():
+    icon = _draw_icon().convert("L")
+    inverted = dhash(ImageOps.invert(icon))
+    assert inverted != ~dhash(icon) & ((1 << 64) - 1)
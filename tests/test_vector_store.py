@@ -0,0 +1,148 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from vector_store import NumpyVectorStore, check_recall_parity, matches_where  # noqa: E402
+
+DIM = 32
+MODELS = ["秦PLUS DM-i", "汉EV", ""]
+
+
+class BruteForceStore:
+    """float32 精确检索的参考实现，与 NumpyVectorStore 的结果对比召回。"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def upsert(self, ids, documents, embeddings, metadatas):
+        for cid, document, vector, metadata in zip(ids, documents, embeddings, metadatas):
+            vector = np.asarray(vector, dtype=np.float32)
+            self.rows[cid] = (document, vector / np.linalg.norm(vector), metadata)
+
+    def delete(self, ids):
+        for cid in ids:
+            self.rows.pop(cid, None)
+
+    def all_ids(self):
+        return list(self.rows)
+
+    def get(self, ids=None, include_embeddings=False):
+        ids = self.all_ids() if ids is None else ids
+        result = {"ids": ids, "documents": [self.rows[cid][0] for cid in ids],
+                  "metadatas": [self.rows[cid][2] for cid in ids]}
+        if include_embeddings:
+            result["embeddings"] = [self.rows[cid][1].tolist() for cid in ids]
+        return result
+
+    def query(self, query_embeddings, n_results=3, where=None):
+        ids = [cid for cid in self.rows if matches_where(self.rows[cid][2], where)]
+        matrix = np.stack([self.rows[cid][1] for cid in ids])
+        result = {"ids": [], "distances": []}
+        for query in np.asarray(query_embeddings, dtype=np.float32):
+            similarities = matrix @ (query / np.linalg.norm(query))
+            top = np.argsort(-similarities)[:n_results]
+            result["ids"].append([ids[i] for i in top])
+            result["distances"].append([float(2.0 - 2.0 * similarities[i]) for i in top])
+        return result
+
+
+def _synthetic_rows(start, count, seed):
+    rng = np.random.default_rng(seed)
+    ids = [f"chunk-{i}" for i in range(start, start + count)]
+    documents = [f"片段 {i}" for i in range(start, start + count)]
+    embeddings = rng.normal(size=(count, DIM)).astype(np.float32).tolist()
+    metadatas = [{"source": f"manual-{i % 7}.pdf", "vehicle_model": MODELS[i % 3]} for i in range(start, start + count)]
+    return ids, documents, embeddings, metadatas
+
+
+def _build(path, dtype):
+    store, reference = NumpyVectorStore(str(path), dtype=dtype), BruteForceStore()
+    for batch, start in enumerate(range(0, 600, 150)):
+        rows = _synthetic_rows(start, 150, seed=batch)
+        store.upsert(*rows)
+        reference.upsert(*rows)
+    return store, reference
+
+
+@pytest.mark.parametrize("dtype, min_recall", [("float16", 0.99), ("int8", 0.9)])
+def test_recall_matches_brute_force(tmp_path, dtype, min_recall):
+    store, reference = _build(tmp_path / "store", dtype)
+    assert store.count() == 600
+
+    report = check_recall_parity(reference, store, n_results=10, sample=100)
+    assert report["recall"] >= min_recall
+
+    # 重新打开后从 mmap 读取，结果不变
+    reopened = check_recall_parity(reference, NumpyVectorStore(str(tmp_path / "store"), dtype=dtype),
+                                   n_results=10, sample=100)
+    assert reopened["recall"] == report["recall"]
+
+
+def test_upsert_appends_only_the_new_batch(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "store"))
+    store.upsert(*_synthetic_rows(0, 100, seed=0))
+    vectors_file = store._data_file("vectors")
+    size = os.path.getsize(vectors_file)
+    store.upsert(*_synthetic_rows(100, 50, seed=1))
+    assert os.path.getsize(vectors_file) == size + 50 * DIM * 2  # float16：每行 DIM * 2 字节
+
+    # 更新已有ID：旧行登记为删除，新内容追加到末尾
+    ids, documents, embeddings, metadatas = _synthetic_rows(0, 1, seed=2)
+    store.upsert(ids, ["新内容"], embeddings, metadatas)
+    assert store.count() == 150
+    assert store.get(ids=ids)["documents"] == ["新内容"]
+    top = store.query(embeddings, n_results=1)
+    assert top["ids"] == [ids] and top["documents"] == [["新内容"]]
+
+
+def test_delete_marks_rows_and_compacts(tmp_path):
+    store, reference = _build(tmp_path / "store", "float16")
+    removed = [f"chunk-{i}" for i in range(0, 600, 5)]  # 20%，低于压缩阈值
+    store.delete(removed)
+    reference.delete(removed)
+    assert store._deleted and store.count() == 480
+
+    reopened = NumpyVectorStore(str(tmp_path / "store"))
+    assert reopened.count() == 480
+    assert not set(removed) & set(reopened.all_ids())
+    results = reopened.query(np.random.default_rng(3).normal(size=(20, DIM)), n_results=600)
+    assert all(not set(removed) & set(ids) for ids in results["ids"])
+    assert check_recall_parity(reference, reopened, n_results=10, sample=100)["recall"] >= 0.99
+
+    # 删除超过阈值后整体重写为新一代文件，旧文件被移除
+    old_vectors = reopened._data_file("vectors")
+    more = [f"chunk-{i}" for i in range(1, 600, 5)]
+    reopened.delete(more)
+    reference.delete(more)
+    assert not reopened._deleted and len(reopened.ids) == reopened.count() == 360
+    assert not os.path.exists(old_vectors)
+    compacted = NumpyVectorStore(str(tmp_path / "store"))
+    assert check_recall_parity(reference, compacted, n_results=10, sample=100)["recall"] >= 0.99
+
+
+def test_where_filter(tmp_path):
+    store, reference = _build(tmp_path / "store", "float16")
+    store.delete(["chunk-1"])
+    reference.delete(["chunk-1"])
+    where = {"vehicle_model": {"$in": ["汉EV", ""]}}
+    queries = np.random.default_rng(4).normal(size=(10, DIM)).tolist()
+    results = store.query(queries, n_results=5, where=where)
+    expected = reference.query(queries, n_results=5, where=where)
+    for ids, metadatas, reference_ids in zip(results["ids"], results["metadatas"], expected["ids"]):
+        assert all(metadata["vehicle_model"] in ("汉EV", "") for metadata in metadatas)
+        assert "chunk-1" not in ids
+        assert len(set(ids) & set(reference_ids)) >= 4
+
+
+def test_uncommitted_append_is_discarded(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "store"))
+    store.upsert(*_synthetic_rows(0, 10, seed=0))
+    # 模拟追加数据文件后、写 meta.json 之前崩溃
+    ids, documents, embeddings, metadatas = _synthetic_rows(10, 5, seed=1)
+    store._write_rows(ids, documents, np.asarray(embeddings, dtype=np.float32), metadatas)
+    reopened = NumpyVectorStore(str(tmp_path / "store"))
+    assert reopened.count() == 10
+    reopened.upsert(*_synthetic_rows(10, 5, seed=1))
+    assert NumpyVectorStore(str(tmp_path / "store")).count() == 15
@@ -0,0 +1,290 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("rag_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str = "rag_chat"):
+        """
+        单次请求的结构化追踪：记录各阶段耗时、token 数与缓存命中情况。
+
+        通过 activate() 设为当前上下文的追踪后，embed_text、query_db、重排服务等底层函数
+        会用 trace_stage / record_cache 自动把耗时记入其中，无需逐层传参。
+        追踪随 contextvars 传播：asyncio 任务与 asyncio.to_thread 会自动继承，
+        普通线程池需用 contextvars.copy_context().run 提交。
+
+        参数：
+            name: 请求类型，例如 "rag_chat"、"rag_chat_stream"。
+        """
+        self.name = name
+        self.request_id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.stages: List[Dict[str, Any]] = []
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.cache: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hit": 0, "miss": 0})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self) -> Iterator["Trace"]:
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            try:
+                _current_trace.reset(token)
+            except ValueError:  # 流式生成器在其他上下文中被关闭
+                _current_trace.set(None)
+
+    def record(self, name: str, duration_ms: float, start_ms: Optional[float] = None, **attrs: Any) -> None:
+        if start_ms is None:
+            start_ms = (time.perf_counter() - self._start) * 1000 - duration_ms
+        with self._lock:
+            self.stages.append({"name": name, "start_ms": round(start_ms, 2),
+                                "duration_ms": round(duration_ms, 2), **attrs})
+
+    @contextmanager
+    def stage(self, name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """
+        计时一个阶段；可在 with 块中向产出的字典写入额外属性（如候选数、是否命中缓存）。
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            self.record(name, (end - start) * 1000, start_ms=(start - self._start) * 1000, **attrs)
+
+    def record_cache(self, cache: str, hit: bool, count: int = 1) -> None:
+        with self._lock:
+            self.cache[cache]["hit" if hit else "miss"] += count
+
+    def add_tokens(self, prompt: int = 0, completion: int = 0) -> None:
+        with self._lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+
+    def finish(self) -> "Trace":
+        if self.duration_ms is None:
+            self.duration_ms = round((time.perf_counter() - self._start) * 1000, 2)
+        return self
+
+    def stage_totals(self) -> Dict[str, float]:
+        """
+        按阶段名汇总耗时（同一阶段出现多次时累加，例如 Agent 的多次模型调用）。
+        """
+        totals: Dict[str, float] = defaultdict(float)
+        with self._lock:
+            for stage in self.stages:
+                totals[stage["name"]] += stage["duration_ms"]
+        return dict(totals)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "request_id": self.request_id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration_ms": self.duration_ms,
+                "stages": sorted(self.stages, key=lambda stage: stage["start_ms"]),
+                "tokens": dict(self.tokens),
+                "cache": {name: dict(counts) for name, counts in self.cache.items()},
+            }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_stage(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """
+    在当前追踪中计时一个阶段；没有活动的追踪时不做任何记录。
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    with trace.stage(name, **attrs) as stage_attrs:
+        yield stage_attrs
+
+
+def record_cache(cache: str, hit: bool, count: int = 1) -> None:
+    trace = _current_trace.get()
+    if trace is not None and count:
+        trace.record_cache(cache, hit, count)
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """把 LangChain 中的模型调用与工具调用记入追踪：耗时、token 数。"""
+
+    def __init__(self, trace: Trace, llm_stage: str = "llm"):
+        self.trace = trace
+        self.llm_stage = llm_stage
+        self._starts: Dict[UUID, tuple] = {}
+        self._streamed: Dict[UUID, int] = defaultdict(int)
+
+    def _start(self, run_id: UUID, name: str) -> None:
+        self._starts[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id: UUID, **attrs: Any) -> None:
+        name, start = self._starts.pop(run_id, (None, None))
+        if name is not None:
+            self.trace.record(name, (time.perf_counter() - start) * 1000,
+                              start_ms=(start - self.trace._start) * 1000, **attrs)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            **kwargs: Any) -> None:
+        self._start(run_id, self.llm_stage)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, self.llm_stage)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._streamed[run_id] += 1
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        prompt_tokens, completion_tokens = 0, 0
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", 0) or 0
+            completion_tokens = usage.get("completion_tokens", 0) or 0
+        else:
+            # 流式调用时 One API 通常不返回用量，改用消息上的 usage_metadata 或流式 token 数
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+            if not completion_tokens:
+                completion_tokens = self._streamed.get(run_id, 0)
+        self._streamed.pop(run_id, None)
+        self.trace.add_tokens(prompt_tokens, completion_tokens)
+        self._end(run_id, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._streamed.pop(run_id, None)
+        self._end(run_id, error=str(error))
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, f"tool:{(serialized or {}).get('name', 'tool')}")
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=str(error))
+
+
+class LatencyRecorder:
+    def __init__(self, window: int = 5000, trace_log_path: Optional[str] = None):
+        """
+        汇总多次请求的追踪，计算各阶段耗时的 p50/p95/p99，并导出为 JSONL 或 Prometheus 文本格式。
+
+        参数：
+            window: 每个阶段保留的最近样本数。
+            trace_log_path: 提供时，每条完成的追踪以一行 JSON 追加写入该文件。
+        """
+        self.window = window
+        self.trace_log_path = trace_log_path
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.window))
+        self._sums: Dict[str, float] = defaultdict(float)
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._cache: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hit": 0, "miss": 0})
+        self._tokens = {"prompt": 0, "completion": 0}
+        self._lock = threading.Lock()
+
+    def observe(self, trace: Trace) -> None:
+        trace.finish()
+        totals = trace.stage_totals()
+        totals["total"] = trace.duration_ms
+        with self._lock:
+            for stage, duration_ms in totals.items():
+                self._samples[stage].append(duration_ms)
+                self._sums[stage] += duration_ms
+                self._counts[stage] += 1
+            for cache, counts in trace.cache.items():
+                self._cache[cache]["hit"] += counts["hit"]
+                self._cache[cache]["miss"] += counts["miss"]
+            for kind, count in trace.tokens.items():
+                self._tokens[kind] += count
+        if self.trace_log_path:
+            self._append_jsonl(self.trace_log_path, [trace.to_dict()])
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        """
+        返回各阶段最近样本的 p50/p95/p99（毫秒）以及累计次数与平均值。
+        """
+        with self._lock:
+            snapshot = {stage: (list(samples), self._counts[stage], self._sums[stage])
+                        for stage, samples in self._samples.items()}
+        report = {}
+        for stage, (samples, count, total) in snapshot.items():
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            report[stage] = {"count": count, "mean_ms": round(total / count, 2),
+                             "p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2),
+                             "p99_ms": round(float(p99), 2)}
+        return report
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._cache.items()}
+
+    @staticmethod
+    def _append_jsonl(path: str, records: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def export_jsonl(self, path: str) -> None:
+        """
+        把当前的各阶段汇总追加写入 JSONL 文件，每个阶段一行，带时间戳。
+        """
+        timestamp = time.time()
+        records = [{"timestamp": timestamp, "stage": stage, **stats} for stage, stats in self.percentiles().items()]
+        self._append_jsonl(path, records)
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        """
+        以 Prometheus 文本格式导出：各阶段耗时的 summary、缓存命中计数与 token 计数。
+        """
+        lines = [f"# HELP {prefix}_stage_latency_seconds Latency of each RAG pipeline stage.",
+                 f"# TYPE {prefix}_stage_latency_seconds summary"]
+        for stage, stats in sorted(self.percentiles().items()):
+            for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lines.append(f'{prefix}_stage_latency_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f"{stats[key] / 1000:.6f}")
+            with self._lock:
+                total_seconds = self._sums[stage] / 1000
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{stage="{stage}"}} {total_seconds:.6f}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{stage="{stage}"}} {stats["count"]}')
+
+        lines += [f"# HELP {prefix}_cache_requests_total Cache lookups by cache and result.",
+                  f"# TYPE {prefix}_cache_requests_total counter"]
+        for cache, counts in sorted(self.cache_stats().items()):
+            for result in ("hit", "miss"):
+                lines.append(f'{prefix}_cache_requests_total{{cache="{cache}",result="{result}"}} {counts[result]}')
+
+        lines += [f"# HELP {prefix}_llm_tokens_total LLM tokens by type.",
+                  f"# TYPE {prefix}_llm_tokens_total counter"]
+        with self._lock:
+            tokens = dict(self._tokens)
+        for kind, count in tokens.items():
+            lines.append(f'{prefix}_llm_tokens_total{{type="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,469 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# 查询结果与 Chroma 的 collection.query 保持相同结构：每个键对应“每个查询一个列表”
+QueryResult = Dict[str, List[List[Any]]]
+
+
+def matches_where(metadata: Dict, where: Optional[Dict]) -> bool:
+    """
+    判断元数据是否满足 Chroma 风格的 where 条件，支持字段相等、$eq/$ne/$in/$nin 以及 $and/$or 组合。
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, expected in condition.items():
+                if op == "$eq" and value != expected:
+                    return False
+                if op == "$ne" and value == expected:
+                    return False
+                if op == "$in" and value not in expected:
+                    return False
+                if op == "$nin" and value in expected:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class ChromaVectorStore:
+    """ChromaDB 持久化集合（HNSW + SQLite）。"""
+
+    name = "chroma"
+
+    def __init__(self, path: str = "./chroma_db", collection_name: str = "my_collection"):
+        import chromadb  # chromadb 导入较慢，只在选用该后端时导入
+
+        self.path = path
+        self.client = chromadb.PersistentClient(path)
+        self.collection = self.client.get_or_create_collection(collection_name)
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def upsert(self, ids: List[str], documents: List[str], embeddings: List[List[float]],
+               metadatas: List[Dict]) -> None:
+        self.collection.upsert(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+
+    def delete(self, ids: List[str]) -> None:
+        if ids:
+            self.collection.delete(ids=ids)
+
+    def get(self, ids: Optional[List[str]] = None, include_embeddings: bool = False) -> Dict[str, List]:
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        fetched = self.collection.get(ids=ids, include=include)
+        result = {"ids": fetched["ids"], "documents": fetched["documents"], "metadatas": fetched["metadatas"]}
+        if include_embeddings:
+            result["embeddings"] = [list(vector) for vector in fetched["embeddings"]]
+        return result
+
+    def all_ids(self) -> List[str]:
+        return self.collection.get(include=[])["ids"]
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 3,
+              where: Optional[Dict] = None) -> QueryResult:
+        return self.collection.query(query_embeddings=[list(q) for q in query_embeddings],
+                                     n_results=n_results, where=where or None)
+
+
+class NumpyVectorStore:
+    block_rows = 16384  # 查询时每次升精度参与乘法的行数
+    compact_ratio = 0.3  # 已删除的行超过该比例时在删除后压缩存储
+
+    def __init__(self, path: str = "./vector_store", dtype: str = "float16"):
+        """
+        基于内存映射 NumPy 矩阵的精确检索后端，适合几千到几十万片段的固定语料。
+
+        向量归一化后以 float16（或按行缩放的 int8）追加写入 vectors.bin，通过 mmap 只读打开，
+        启动时无需把整个矩阵读入内存；片段ID、文本和元数据逐行追加到 rows.jsonl，
+        meta.json 记录已提交的行数与被删除的行号。写入只追加新的一批，删除只登记行号，
+        已删除的行超过 compact_ratio 时才整体重写一次，因此入库的 I/O 与内存只与批大小有关。
+        查询时一次矩阵乘法算出所有片段的相似度，再用 argpartition 取 top-k，支持多个查询同时计算。
+        返回的距离为 2 - 2·cos，对归一化向量等于 Chroma 默认的平方 L2 距离，检索策略的阈值可以通用。
+
+        参数：
+            path: 存储目录。
+            dtype: 向量的存储精度，"float16" 或 "int8"。
+        """
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"不支持的向量精度：{dtype}（可选 float16 / int8）")
+        self.path = path
+        self.dtype = dtype
+        self.name = f"numpy-{dtype}"
+        self._lock = threading.RLock()
+        self._dim: Optional[int] = None
+        self._generation = 0
+        self._vectors: Optional[np.ndarray] = None  # (N, D)，float16 或 int8，只读 mmap
+        self._scales: Optional[np.ndarray] = None  # int8 时每行的反量化系数
+        # 以下列表与矩阵的行一一对应（包括已删除的行），_positions 只包含有效的行
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self._deleted: set = set()
+        self._positions: Dict[str, int] = {}
+        self._row_filters: Dict[str, Optional[np.ndarray]] = {}  # where 条件 -> 匹配的有效行号，写入后失效
+        self._load()
+
+    # --- 文件读写 ---
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _data_file(self, kind: str, generation: Optional[int] = None) -> str:
+        """
+        数据文件按压缩的代数命名（vectors-0.bin、rows-0.jsonl ...），压缩时写入新一代文件，
+        meta.json 切换到新一代后才删除旧文件，中途崩溃不会丢失数据。
+        """
+        generation = self._generation if generation is None else generation
+        extension = "jsonl" if kind == "rows" else "bin"
+        return self._file(f"{kind}-{generation}.{extension}")
+
+    @property
+    def _np_dtype(self):
+        return np.float16 if self.dtype == "float16" else np.int8
+
+    def _load(self) -> None:
+        meta_file = self._file("meta.json")
+        if not os.path.exists(meta_file):
+            return
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        stored_dtype, rows, self._dim = meta["dtype"], meta["rows"], meta["dim"]
+        self._generation = meta["generation"]
+        self._deleted = set(meta["deleted"])
+
+        # 只读取已提交的行；追加到一半时崩溃留下的多余内容会被截掉，之后的追加从提交处继续
+        committed = 0
+        if rows:
+            with open(self._data_file("rows"), "rb") as f:
+                for _ in range(rows):
+                    record = json.loads(f.readline())
+                    self.ids.append(record["id"])
+                    self.documents.append(record["document"])
+                    self.metadatas.append(record["metadata"])
+                committed = f.tell()
+        itemsize = np.dtype(np.float16 if stored_dtype == "float16" else np.int8).itemsize
+        sizes = {"rows": committed, "vectors": rows * (self._dim or 0) * itemsize, "scales": rows * 4}
+        for kind, size in sizes.items():
+            if os.path.exists(self._data_file(kind)):
+                os.truncate(self._data_file(kind), size)
+        self._positions = {cid: i for i, cid in enumerate(self.ids) if i not in self._deleted}
+
+        configured_dtype, self.dtype = self.dtype, stored_dtype
+        self._open()
+        if stored_dtype != configured_dtype:
+            print(f"向量存储精度为 {stored_dtype}，与配置的 {configured_dtype} 不一致，按 {configured_dtype} 重新保存。")
+            matrix = self._matrix()
+            self.dtype = configured_dtype
+            self._compact(matrix)
+
+    def _open(self) -> None:
+        """
+        以 mmap 重新打开向量文件（追加写入后矩阵的行数发生变化）。
+        """
+        rows = len(self.ids)
+        if not rows:
+            self._vectors, self._scales = None, None
+        else:
+            self._vectors = np.memmap(self._data_file("vectors"), dtype=self._np_dtype, mode="r",
+                                      shape=(rows, self._dim))
+            self._scales = np.memmap(self._data_file("scales"), dtype=np.float32, mode="r", shape=(rows,)) \
+                if self.dtype == "int8" else None
+        self._row_filters = {}
+
+    def _write_meta(self) -> None:
+        """
+        原子地写入 meta.json，它是行数与删除记录的唯一依据。
+        """
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dtype": self.dtype, "dim": self._dim, "generation": self._generation,
+                       "rows": len(self.ids), "deleted": sorted(self._deleted)}, f)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    @staticmethod
+    def _dequantize(vectors: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        return matrix * np.asarray(scales)[:, None] if scales is not None else matrix
+
+    def _quantize(self, matrix: np.ndarray):
+        if self.dtype == "float16":
+            return matrix.astype(np.float16), None
+        scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _write_rows(self, ids: List[str], documents: List[str], matrix: np.ndarray, metadatas: List[Dict]) -> None:
+        """
+        把一批行追加到当前一代数据文件的末尾（meta.json 提交之前不会被读取）。
+        """
+        os.makedirs(self.path, exist_ok=True)
+        vectors, scales = self._quantize(matrix)
+        with open(self._data_file("vectors"), "ab") as f:
+            vectors.tofile(f)
+        if scales is not None:
+            with open(self._data_file("scales"), "ab") as f:
+                scales.tofile(f)
+        with open(self._data_file("rows"), "a", encoding="utf-8") as f:
+            for cid, document, metadata in zip(ids, documents, metadatas):
+                record = {"id": cid, "document": document, "metadata": metadata}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _append(self, ids: List[str], documents: List[str], matrix: np.ndarray, metadatas: List[Dict]) -> None:
+        """
+        追加一批新行并写 meta.json 提交，I/O 只与这一批的大小有关。
+        """
+        self._write_rows(ids, documents, matrix, metadatas)
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self._positions.update({cid: start + i for i, cid in enumerate(ids)})
+        self._write_meta()
+        self._open()
+
+    def _compact(self, matrix: Optional[np.ndarray] = None) -> None:
+        """
+        去掉已删除的行，把存储整体重写为新一代文件（只在删除积累到一定比例或精度变化时执行）。
+        """
+        if matrix is None:
+            matrix = self._matrix()
+        keep = [i for i in range(len(self.ids)) if i not in self._deleted]
+        ids = [self.ids[i] for i in keep]
+        documents = [self.documents[i] for i in keep]
+        metadatas = [self.metadatas[i] for i in keep]
+        old_generation = self._generation
+        self._generation += 1
+        for kind in ("vectors", "scales", "rows"):
+            if os.path.exists(self._data_file(kind)):
+                os.remove(self._data_file(kind))  # 上次压缩中途崩溃留下的半成品
+        if ids:
+            self._write_rows(ids, documents, matrix[keep], metadatas)
+        self.ids, self.documents, self.metadatas = ids, documents, metadatas
+        self._deleted = set()
+        self._positions = {cid: i for i, cid in enumerate(ids)}
+        self._write_meta()
+        self._open()
+        for kind in ("vectors", "scales", "rows"):
+            if os.path.exists(self._data_file(kind, old_generation)):
+                os.remove(self._data_file(kind, old_generation))
+
+    def _matrix(self) -> np.ndarray:
+        if self._vectors is None:
+            return np.zeros((0, self._dim or 0), dtype=np.float32)
+        return self._dequantize(self._vectors, self._scales)
+
+    # --- 与 ChromaVectorStore 相同的接口 ---
+    def count(self) -> int:
+        return len(self._positions)
+
+    def upsert(self, ids: List[str], documents: List[str], embeddings: List[List[float]],
+               metadatas: List[Dict]) -> None:
+        """
+        追加一批片段。已存在的ID先登记为删除，再以新内容追加到末尾。
+        """
+        new = np.asarray(embeddings, dtype=np.float32)
+        new = new / np.maximum(np.linalg.norm(new, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self._dim is None:
+                self._dim = new.shape[1]
+            elif new.shape[1] != self._dim:
+                raise ValueError(f"向量维度 {new.shape[1]} 与存储中的 {self._dim} 不一致")
+            for cid in ids:
+                position = self._positions.pop(cid, None)
+                if position is not None:
+                    self._deleted.add(position)
+            self._append(ids, documents, new, metadatas)
+
+    def delete(self, ids: List[str]) -> None:
+        """
+        只登记被删除的行号，已删除的行超过 compact_ratio 时再压缩存储。
+        """
+        with self._lock:
+            positions = [self._positions.pop(cid) for cid in ids if cid in self._positions]
+            if not positions:
+                return
+            self._deleted.update(positions)
+            if len(self._deleted) > self.compact_ratio * len(self.ids):
+                self._compact()
+            else:
+                self._write_meta()
+                self._row_filters = {}
+
+    def get(self, ids: Optional[List[str]] = None, include_embeddings: bool = False) -> Dict[str, List]:
+        with self._lock:
+            positions = sorted(self._positions.values()) if ids is None else \
+                [self._positions[cid] for cid in ids if cid in self._positions]
+            result = {"ids": [self.ids[i] for i in positions],
+                      "documents": [self.documents[i] for i in positions],
+                      "metadatas": [self.metadatas[i] for i in positions]}
+            if include_embeddings:
+                result["embeddings"] = self._dequantize(
+                    self._vectors[positions], self._scales[positions] if self._scales is not None else None
+                ).tolist() if positions else []
+        return result
+
+    def all_ids(self) -> List[str]:
+        with self._lock:
+            return [self.ids[i] for i in sorted(self._positions.values())]
+
+    def _filter_rows(self, where: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        返回未删除且满足 where 条件的行号；没有条件也没有删除时返回 None（使用全部行）。
+        同一条件（例如某个车型）的结果会被缓存，直到下次写入。
+        """
+        if not where and not self._deleted:
+            return None
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        if key not in self._row_filters:
+            if len(self._row_filters) >= 256:
+                self._row_filters.clear()
+            self._row_filters[key] = np.array(
+                [i for i, metadata in enumerate(self.metadatas)
+                 if i not in self._deleted and matches_where(metadata or {}, where)], dtype=np.int64)
+        return self._row_filters[key]
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 3,
+              where: Optional[Dict] = None) -> QueryResult:
+        """
+        精确 top-k 检索：所有查询与所有片段的相似度由一次矩阵乘法得到。
+        带 where 条件时只取出匹配的行参与计算（例如只搜索所选车型的手册），耗时与匹配的片段数成正比，
+        不随整个知识库的规模增长。
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        with self._lock:
+            vectors, scales = self._vectors, self._scales
+            ids, documents, metadatas = self.ids, self.documents, self.metadatas
+            rows = self._filter_rows(where) if vectors is not None else None
+        if vectors is None:
+            for _ in range(len(queries)):
+                for key in result:
+                    result[key].append([])
+            return result
+
+        # (N, D) @ (D, Q)：float16/int8 分块升为 float32 后相乘，峰值内存不随语料规模增长；int8 先按行反量化
+        # 行数以矩阵为准：并发的 upsert 可能已经在 ids 末尾追加了尚未写入矩阵的片段
+        count = len(vectors) if rows is None else len(rows)
+        similarities = np.empty((count, len(queries)), dtype=np.float32)
+        for start in range(0, count, self.block_rows):
+            index = slice(start, start + self.block_rows) if rows is None else rows[start:start + self.block_rows]
+            block = np.asarray(vectors[index], dtype=np.float32)
+            if scales is not None:
+                block *= np.asarray(scales[index])[:, None]
+            similarities[start:start + len(block)] = block @ queries.T
+        k = min(n_results, count)
+
+        for column in similarities.T:
+            if k <= 0:
+                top = np.array([], dtype=np.int64)
+            elif k < len(column):
+                top = np.argpartition(-column, k - 1)[:k]
+                top = top[np.argsort(-column[top])]
+            else:
+                top = np.argsort(-column)[:k]
+            positions = top if rows is None else rows[top]
+            result["ids"].append([ids[i] for i in positions])
+            result["documents"].append([documents[i] for i in positions])
+            result["metadatas"].append([metadatas[i] for i in positions])
+            result["distances"].append([float(2.0 - 2.0 * column[i]) for i in top])
+        return result
+
+
+def create_vector_store(backend: str = "chroma", path: Optional[str] = None, **kwargs: Any):
+    """
+    按名称创建向量存储后端："chroma"、"numpy"（float16）或 "numpy-int8"。
+    """
+    if backend == "chroma":
+        return ChromaVectorStore(path or "./chroma_db", **kwargs)
+    if backend in ("numpy", "numpy-float16"):
+        return NumpyVectorStore(path or "./vector_store", dtype="float16")
+    if backend == "numpy-int8":
+        return NumpyVectorStore(path or "./vector_store", dtype="int8")
+    raise ValueError(f"未知的向量存储后端：{backend}（可选 chroma / numpy / numpy-int8）")
+
+
+def copy_vector_store(source, target, batch_size: int = 1024) -> int:
+    """
+    把 source 中的全部片段（含向量）复制到 target，无需重新嵌入。返回复制的片段数。
+    """
+    ids = source.all_ids()
+    for start in range(0, len(ids), batch_size):
+        batch = source.get(ids=ids[start:start + batch_size], include_embeddings=True)
+        target.upsert(batch["ids"], batch["documents"], batch["embeddings"], batch["metadatas"])
+    return len(ids)
+
+
+def check_recall_parity(reference, candidate, query_embeddings: Optional[List[List[float]]] = None,
+                        n_results: int = 10, sample: int = 200, seed: int = 0) -> Dict[str, float]:
+    """
+    对比候选后端与参考后端（通常为 Chroma）在同一批查询上的 top-k 召回一致性与耗时。
+
+    query_embeddings 为空时，从参考后端中随机抽取 sample 个片段向量并加入少量噪声作为查询，
+    不需要嵌入服务即可运行。recall 为候选结果覆盖参考结果的比例，top1_agree 为首个结果一致的比例。
+    """
+    if query_embeddings is None:
+        rng = np.random.default_rng(seed)
+        ids = reference.all_ids()
+        chosen = [ids[i] for i in rng.choice(len(ids), size=min(sample, len(ids)), replace=False)]
+        vectors = np.asarray(reference.get(ids=chosen, include_embeddings=True)["embeddings"], dtype=np.float32)
+        vectors += rng.normal(scale=0.01, size=vectors.shape).astype(np.float32)
+        query_embeddings = vectors.tolist()
+
+    start = time.perf_counter()
+    expected = reference.query(query_embeddings, n_results=n_results)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = candidate.query(query_embeddings, n_results=n_results)
+    candidate_seconds = time.perf_counter() - start
+
+    recalls, top1 = [], []
+    for want, got in zip(expected["ids"], actual["ids"]):
+        if want:
+            recalls.append(len(set(want) & set(got)) / len(want))
+            top1.append(bool(got) and got[0] == want[0])
+    report = {
+        "reference": getattr(reference, "name", type(reference).__name__),
+        "candidate": getattr(candidate, "name", type(candidate).__name__),
+        "queries": len(query_embeddings),
+        "n_results": n_results,
+        "recall": round(float(np.mean(recalls)), 4) if recalls else 0.0,
+        "top1_agree": round(float(np.mean(top1)), 4) if top1 else 0.0,
+        "reference_seconds": round(reference_seconds, 4),
+        "candidate_seconds": round(candidate_seconds, 4),
+    }
+    print(f"向量存储召回一致性检查：{report}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a NumPy vector store from Chroma and check recall parity.")
+    parser.add_argument("--chroma-path", type=str, default="./chroma_db", help="Chroma persistent directory")
+    parser.add_argument("--numpy-path", type=str, default="./vector_store", help="Target NumPy store directory")
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "int8"])
+    parser.add_argument("--copy", action="store_true", help="Copy all chunks from Chroma into the NumPy store first")
+    parser.add_argument("--n-results", type=int, default=10)
+    parser.add_argument("--sample", type=int, default=200, help="Number of sampled query vectors")
+    parser.add_argument("--min-recall", type=float, default=0.99, help="Exit non-zero when recall falls below this")
+    args = parser.parse_args()
+
+    chroma_store = ChromaVectorStore(args.chroma_path)
+    numpy_store = NumpyVectorStore(args.numpy_path, dtype=args.dtype)
+    if args.copy:
+        print(f"已复制 {copy_vector_store(chroma_store, numpy_store)} 个片段到 {args.numpy_path}")
+    parity = check_recall_parity(chroma_store, numpy_store, n_results=args.n_results, sample=args.sample)
+    raise SystemExit(0 if parity["recall"] >= args.min_recall else 1)